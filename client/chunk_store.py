@@ -0,0 +1,106 @@
+import os
+import re
+import logging
+import threading
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Chunks are named by their lower-case hex SHA-256 digest. Digests come from
+# peers, so anything else is rejected rather than used as a path.
+_DIGEST_PATTERN: re.Pattern[str] = re.compile(r"^[0-9a-f]{64}$")
+
+
+def valid_digest(digest: object) -> bool:
+    return isinstance(digest, str) and bool(_DIGEST_PATTERN.match(digest))
+
+
+class ChunkStore:
+    """
+    A content-addressed store of file chunks received from peers, so that
+    chunks the client already has needn't be transferred again.
+
+    Each chunk is a file named by its digest, in a subdirectory named by
+    the digest's first two characters. Reading a chunk marks it as recently
+    used; `trim` deletes the least recently used chunks once the store
+    grows past `max_bytes`.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int) -> None:
+        """
+        Args:
+            directory: Directory holding the chunks.
+            max_bytes: Size the store is trimmed to.
+        """
+        self.directory: Path = directory
+        self.max_bytes: int = max_bytes
+        self._trim_lock: threading.Lock = threading.Lock()
+
+    def _path(self, digest: str) -> Path:
+        if not valid_digest(digest):
+            raise ValueError(f"Invalid chunk digest: {digest!r}")
+        return self.directory / digest[:2] / digest
+
+    def has(self, digest: str) -> bool:
+        return self._path(digest).is_file()
+
+    def read(self, digest: str) -> bytes:
+        """
+        Read a chunk and mark it as recently used.
+
+        Raises:
+            FileNotFoundError: If the chunk isn't in the store.
+        """
+        path: Path = self._path(digest)
+        data: bytes = path.read_bytes()
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return data
+
+    def put(self, digest: str, data: bytes | memoryview) -> None:
+        """Add a chunk, whose digest the caller has already checked."""
+        path: Path = self._path(digest)
+        if path.is_file():
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write under a unique name, so concurrent transfers of the same
+        # chunk don't interleave, and readers never see a partial chunk
+        temp_path: Path = path.with_name(f"{digest}.{threading.get_ident()}.tmp")
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    def discard(self, digest: str) -> None:
+        try:
+            self._path(digest).unlink()
+        except FileNotFoundError:
+            pass
+
+    def trim(self) -> None:
+        """Delete the least recently used chunks until the store fits in `max_bytes`."""
+        with self._trim_lock:
+            chunks: list[tuple[float, int, Path]] = []
+            total: int = 0
+            for path in self.directory.glob("??/*"):
+                try:
+                    stat: os.stat_result = path.stat()
+                except OSError:
+                    continue
+                chunks.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+            if total <= self.max_bytes:
+                return
+            chunks.sort()
+            removed: int = 0
+            for _, size, path in chunks:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    path.unlink()
+                except OSError:
+                    continue
+                total -= size
+                removed += 1
+            logger.debug(f"Trimmed {removed} chunks from the chunk store")
@@ -1,6 +1,7 @@
 import os
 import logging
 from dotenv import load_dotenv
+from pathlib import Path
 from typing import Optional
 from tkinter import messagebox
 from client.network_manager import NetworkManager
@@ -11,9 +12,17 @@ from utils.logger import configure_logger
 
 load_dotenv(override=True)
 LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text").lower()
+LOG_FRAME_SAMPLE_RATE = int(os.environ.get("LOG_FRAME_SAMPLE_RATE", 1))
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10_000))
+SEND_COALESCE_MS = float(os.environ.get("SEND_COALESCE_MS", 2))
+CLIENT_CACHE_DIR = os.environ.get("CLIENT_CACHE_DIR") or os.path.join(
+    os.path.expanduser("~"), ".ncr-client"
+)
+CHUNK_STORE_MAX_BYTES = int(os.environ.get("CHUNK_STORE_MAX_BYTES", 1024**3))
 
 # Set up logger
-configure_logger(LOG_LEVEL)
+configure_logger(LOG_LEVEL, LOG_FORMAT == "json", LOG_FRAME_SAMPLE_RATE, LOG_QUEUE_SIZE)
 
 # Get a logger for this module
 logger = logging.getLogger(__name__)
@@ -23,8 +32,12 @@ class Client:
     def __init__(self, server_ip: str, server_port: int):
         self.login_window: Optional[LoginWindow] = None
         self.main_window: Optional[MainWindow] = None
-        self.network_manager = NetworkManager(server_ip, server_port)
-        self.file_manager = FileManager(self.network_manager)
+        self.network_manager = NetworkManager(
+            server_ip, server_port, SEND_COALESCE_MS / 1000
+        )
+        self.file_manager = FileManager(
+            self.network_manager, Path(CLIENT_CACHE_DIR), CHUNK_STORE_MAX_BYTES
+        )
 
     def run(self) -> None:
         try:
@@ -0,0 +1,129 @@
+import queue
+import threading
+import logging
+from collections import deque
+from typing import Callable, Literal
+
+logger = logging.getLogger(__name__)
+
+# Where an event handler runs:
+# - "ui": on the Tk thread, for handlers that touch widgets or show dialogs
+# - "io": on a pool sized for blocking work, such as file transfers
+# - "cpu": on a pool sized to the machine, such as hashing
+HandlerKind = Literal["ui", "io", "cpu"]
+
+# Anything a task returns, such as a message box's answer, is ignored
+Task = Callable[[], object]
+
+
+class EventDispatcher:
+    """
+    Runs event handlers away from the thread that receives them, so a slow
+    handler never holds up receipt of further messages.
+
+    UI tasks are queued for the Tk thread, which runs them when it calls
+    `run_ui_tasks` (Tk widgets may only be used from the thread that created
+    them). IO and CPU tasks run on separate pools of daemon worker threads,
+    so blocking work can't starve computation and vice versa, and an
+    unfinished transfer doesn't keep the process alive on exit. A pool's
+    threads are only started when its first task is submitted, so an idle
+    connection costs no worker threads.
+
+    Tasks are ordered per key, usually the peer a message concerns: tasks of
+    the same kind and key run one at a time in submission order, while tasks
+    for different keys run in parallel. UI tasks always run in submission
+    order.
+    """
+
+    __slots__ = ("_workers", "_ui_tasks", "_ready", "_lanes", "_lock")
+
+    def __init__(self, io_workers: int, cpu_workers: int) -> None:
+        """
+        Args:
+            io_workers: Number of threads running IO tasks.
+            cpu_workers: Number of threads running CPU tasks.
+        """
+        # Threads to start per pool; removed once a pool is started
+        self._workers: dict[str, int] = {"io": io_workers, "cpu": cpu_workers}
+        self._ui_tasks: queue.SimpleQueue[Task] = queue.SimpleQueue()
+        # Keys with tasks waiting for a worker, per pool
+        self._ready: dict[str, queue.SimpleQueue[tuple[str, str]]] = {
+            "io": queue.SimpleQueue(),
+            "cpu": queue.SimpleQueue(),
+        }
+        # Pending tasks per (kind, key); a key is present while a worker owns it
+        self._lanes: dict[tuple[str, str], deque[Task]] = {}
+        self._lock: threading.Lock = threading.Lock()
+
+    def submit(self, kind: HandlerKind, task: Task, key: str = "") -> None:
+        """
+        Schedule a task.
+
+        Args:
+            kind: Where the task runs.
+            task: The function to run.
+            key: Tasks of the same kind and key run in submission order.
+        """
+        if kind == "ui":
+            self._ui_tasks.put(task)
+            return
+        lane_key: tuple[str, str] = (kind, key)
+        with self._lock:
+            lane: deque[Task] | None = self._lanes.get(lane_key)
+            if lane is not None:
+                # A worker already owns this key and will get to the task
+                lane.append(task)
+                return
+            self._lanes[lane_key] = deque((task,))
+            workers: int | None = self._workers.pop(kind, None)
+        if workers is not None:
+            for index in range(max(1, workers)):
+                threading.Thread(
+                    target=self._work,
+                    args=(self._ready[kind],),
+                    name=f"Client {kind} worker {index}",
+                    daemon=True,
+                ).start()
+        self._ready[kind].put(lane_key)
+
+    def run_ui_tasks(self, limit: int = 100) -> None:
+        """
+        Run queued UI tasks. Must be called from the Tk thread.
+
+        Args:
+            limit: Maximum number of tasks to run, so a flood of messages
+                can't keep the window from redrawing.
+        """
+        for _ in range(limit):
+            try:
+                task: Task = self._ui_tasks.get_nowait()
+            except queue.Empty:
+                return
+            self._run(task)
+
+    def clear_ui_tasks(self) -> None:
+        """Discard queued UI tasks, e.g. when the window they target is closed."""
+        while True:
+            try:
+                self._ui_tasks.get_nowait()
+            except queue.Empty:
+                return
+
+    def _work(self, ready: queue.SimpleQueue[tuple[str, str]]) -> None:
+        while True:
+            lane_key: tuple[str, str] = ready.get()
+            while True:
+                with self._lock:
+                    lane: deque[Task] = self._lanes[lane_key]
+                    if not lane:
+                        del self._lanes[lane_key]
+                        break
+                    task: Task = lane.popleft()
+                self._run(task)
+
+    @staticmethod
+    def _run(task: Task) -> None:
+        try:
+            task()
+        except Exception as e:
+            logger.error(f"Event handler failed: {e}")
@@ -1,22 +1,72 @@
 import os
+import json
 import time
+import struct
 import socket
+import hashlib
 import logging
 import tkinter.filedialog
 import tkinter.messagebox
-from utils.file_utilities import format_file_size, get_file_md5
+from pathlib import Path
+from typing import Any, BinaryIO
+from utils.file_utilities import (
+    CHUNK_ALGORITHM,
+    CHUNK_LIST_ALGORITHM,
+    CHUNK_SIZE,
+    ChunkListHasher,
+    FileHashCache,
+    chunk_list_digest,
+    format_file_size,
+    new_hasher,
+    preferred_hash,
+)
+from client.chunk_store import ChunkStore, valid_digest
 from client.network_manager import NetworkManager
 
 logger = logging.getLogger(__name__)
 
+# Length prefix of the JSON messages exchanged before a chunked transfer
+MESSAGE_HEADER: struct.Struct = struct.Struct(">I")
+
+# Largest manifest accepted from a peer (about 2 TiB of 1 MiB chunks)
+MAX_MESSAGE_BYTES: int = 256 * 1024 * 1024
+
+# Chunk sizes a peer may propose
+MIN_CHUNK_SIZE: int = 4 * 1024
+MAX_CHUNK_SIZE: int = 64 * 1024 * 1024
+
 
 class FileManager:
-    def __init__(self, network_manager: NetworkManager):
+    def __init__(
+        self,
+        network_manager: NetworkManager,
+        cache_dir: Path | None = None,
+        chunk_store_max_bytes: int = 0,
+    ):
+        """
+        Args:
+            network_manager: The connection to the server.
+            cache_dir: Directory for the file hash cache and the chunk store,
+                or None to only cache hashes in memory and not deduplicate.
+            chunk_store_max_bytes: Size the chunk store is trimmed to after
+                each transfer, or 0 to not deduplicate.
+        """
         self.network_manager: NetworkManager = network_manager
+        self.hash_cache: FileHashCache = FileHashCache(
+            cache_dir / "file_hashes.json" if cache_dir else None
+        )
+        self.chunk_store: ChunkStore | None = (
+            ChunkStore(cache_dir / "chunks", chunk_store_max_bytes)
+            if cache_dir and chunk_store_max_bytes
+            else None
+        )
 
         self._file_transfer_pending: bool = False
         self._filepath: str = ""
         self._filename: str = ""
+        # Size and chunk digests of the file being sent, as hashed
+        self._size: int = 0
+        self._chunks: list[str] = []
 
     def send_file_request(self, current_session: str) -> None:
         filename: str = tkinter.filedialog.askopenfilename()
@@ -26,27 +76,60 @@ class FileManager:
 
         self._filepath = filename
         self._filename = os.path.basename(filename)
-        size: int = os.path.getsize(filename)
-        size_str: str = format_file_size(size)
-        md5_checksum: str = get_file_md5(filename)
+        self._file_transfer_pending = True
 
-        logger.debug(f"Sending file request to {current_session}")
+        # Hashing a large file takes a while, so do it off the Tk thread
+        self.network_manager.dispatcher.submit(
+            "cpu", lambda: self._request_file_transfer(current_session, filename)
+        )
+
+    def _request_file_transfer(self, peer: str, filepath: str) -> None:
+        try:
+            size: int = os.path.getsize(filepath)
+            chunks: list[str] = self.hash_cache.digests(filepath)
+        except OSError as e:
+            self._reset_file_state()
+            message: str = f"Error reading file: {str(e)}"
+            self.network_manager.dispatcher.submit(
+                "ui", lambda: tkinter.messagebox.showerror("Error", message)
+            )
+            return
+        self._size = size
+        self._chunks = chunks
+
+        logger.debug(f"Sending file request to {peer}")
         self.network_manager.send(
             {
                 "command": "file_request",
-                "peer": current_session,
-                "filename": self._filename,
-                "size": size_str,
-                "md5": md5_checksum,
+                "peer": peer,
+                "filename": os.path.basename(filepath),
+                "size": format_file_size(size),
+                # The receiver verifies with the digest it prefers
+                "hashes": {CHUNK_LIST_ALGORITHM: chunk_list_digest(chunks)},
+                # Offer to send only the chunks the receiver doesn't have
+                "chunk_size": CHUNK_SIZE,
             }
         )
         logger.debug("File request sent")
 
-        self._file_transfer_pending = True
+    def accepts_chunks(self, request: dict) -> bool:
+        """Whether to ask for a chunked transfer in reply to a file request."""
+        return self.chunk_store is not None and bool(
+            valid_chunk_size(request.get("chunk_size"))
+        )
+
+    def send_file_data(self, data: dict) -> tuple[int, int, float]:
+        """
+        Send the requested file to a peer that accepted it.
+
+        Args:
+            data: The peer's file response.
 
-    def send_file_data(self, data: dict) -> tuple[int, float]:
+        Returns:
+            The file's size, the bytes of it actually sent, and the seconds
+            the transfer took.
+        """
         try:
-            total_bytes: int = 0
             # Establish a new connection to the peer and send the file data
             logger.debug(f"Opening file transfer socket to {data['ip']}")
             with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client:
@@ -54,41 +137,216 @@ class FileManager:
                 start_time: float = time.time()
 
                 with open(self._filepath, "rb") as f:
-                    while True:
-                        file_data = f.read(1024)
-                        if not file_data:
-                            break
-                        total_bytes += len(file_data)
-                        client.send(file_data)
+                    if data.get("chunked"):
+                        size: int = self._size
+                        bytes_sent: int = self._send_chunks(client, f)
+                    else:
+                        size = os.fstat(f.fileno()).st_size
+                        bytes_sent = client.sendfile(f)
 
             end_time: float = time.time()
             transfer_time: float = end_time - start_time
-            logger.debug(f"File transfer complete: {total_bytes} bytes sent")
-            return total_bytes, transfer_time
+            logger.debug(f"File transfer complete: {bytes_sent} of {size} bytes sent")
+            return size, bytes_sent, transfer_time
         finally:
             self._reset_file_state()
 
-    def receive_file_data(self, destination_path: str) -> tuple[int, float]:
-        total_bytes: int = 0
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
-            server.bind(("0.0.0.0", 1031))
-            server.listen(1)
-            client_socket, _ = server.accept()
-            start_time: float = time.time()
-
-            with open(destination_path, "wb") as f:
-                while True:
-                    file_data = client_socket.recv(1024)
-                    if not file_data:
-                        break
-                    total_bytes += len(file_data)
-                    f.write(file_data)
-
-        end_time: float = time.time()
-        transfer_time: float = end_time - start_time
-        return total_bytes, transfer_time
+    def _send_chunks(self, client: socket.socket, f: BinaryIO) -> int:
+        # Send the manifest, then the chunks the receiver asks for
+        _send_message(
+            client,
+            {"size": self._size, "chunk_size": CHUNK_SIZE, "chunks": self._chunks},
+        )
+        need: Any = _receive_message(client).get("need")
+        if not isinstance(need, list):
+            raise ValueError("Invalid chunk request from peer")
+        bytes_sent: int = 0
+        for index in need:
+            if not isinstance(index, int) or not 0 <= index < len(self._chunks):
+                raise ValueError(f"Peer requested an invalid chunk: {index!r}")
+            offset: int = index * CHUNK_SIZE
+            bytes_sent += client.sendfile(f, offset, min(CHUNK_SIZE, self._size - offset))
+        return bytes_sent
+
+    def receive_file_data(
+        self,
+        destination_path: str,
+        hashes: dict[str, Any] | None = None,
+        chunk_size: Any = 0,
+        chunked: bool = False,
+    ) -> tuple[int, int, float]:
+        """
+        Receive a file from a peer and check it against the sender's hash.
+
+        Args:
+            destination_path: Where to save the file.
+            hashes: Hex digests by algorithm from the file request.
+            chunk_size: The chunk size from the file request, if any.
+            chunked: Whether a chunked transfer was accepted, rather than
+                receiving the whole file.
+
+        Returns:
+            The file's size, the bytes of it actually received (the rest came
+            from the chunk store), and the seconds the transfer took.
+
+        Raises:
+            ValueError: If the file doesn't match the sender's hash, in which
+                case nothing is saved.
+        """
+        chunk_size = valid_chunk_size(chunk_size)
+        chunked = chunked and bool(chunk_size and self.chunk_store)
+        algorithm, expected = preferred_hash(hashes or {}, chunk_size)
+        hasher = new_hasher(algorithm, chunk_size) if algorithm else None
+        # Write to a temporary file, so a failed transfer doesn't leave a
+        # corrupt file at the destination
+        partial_path: str = destination_path + ".part"
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
+                server.bind(("0.0.0.0", 1031))
+                server.listen(1)
+                client_socket, _ = server.accept()
+                start_time: float = time.time()
+
+                with client_socket, open(partial_path, "wb") as f:
+                    if chunked and self.chunk_store:
+                        total_bytes, bytes_received = self._receive_chunks(
+                            client_socket, f, hasher, chunk_size, self.chunk_store
+                        )
+                    else:
+                        total_bytes = bytes_received = _receive_all(
+                            client_socket, f, hasher
+                        )
+
+            end_time: float = time.time()
+            transfer_time: float = end_time - start_time
+            if hasher and hasher.hexdigest().upper() != expected:
+                raise ValueError(f"File failed {algorithm} verification")
+        except BaseException:
+            try:
+                os.remove(partial_path)
+            except OSError:
+                pass
+            raise
+        finally:
+            if self.chunk_store and chunked:
+                self.chunk_store.trim()
+        os.replace(partial_path, destination_path)
+        logger.debug(
+            f"File received: {bytes_received} of {total_bytes} bytes transferred, "
+            f"verified with {algorithm or 'nothing'}"
+        )
+        return total_bytes, bytes_received, transfer_time
+
+    @staticmethod
+    def _receive_chunks(
+        client_socket: socket.socket,
+        f: BinaryIO,
+        hasher: Any,
+        chunk_size: int,
+        store: ChunkStore,
+    ) -> tuple[int, int]:
+        manifest: dict[str, Any] = _receive_message(client_socket)
+        size: Any = manifest.get("size")
+        chunks: Any = manifest.get("chunks")
+        if (
+            manifest.get("chunk_size") != chunk_size
+            or not isinstance(size, int)
+            or size < 0
+            or not isinstance(chunks, list)
+            or len(chunks) != -(-size // chunk_size)
+            or not all(valid_digest(digest) for digest in chunks)
+        ):
+            raise ValueError("Invalid chunk manifest from peer")
+
+        # Ask for each missing chunk once, however often it appears in the file
+        need: list[int] = []
+        wanted: set[str] = set()
+        for index, digest in enumerate(chunks):
+            if digest not in wanted and not store.has(digest):
+                need.append(index)
+                wanted.add(digest)
+        _send_message(client_socket, {"need": need})
+        logger.debug(f"Requested {len(need)} of {len(chunks)} chunks")
+
+        needed: set[int] = set(need)
+        buffer: memoryview = memoryview(bytearray(chunk_size))
+        bytes_received: int = 0
+        for index, digest in enumerate(chunks):
+            length: int = min(chunk_size, size - index * chunk_size)
+            chunk: bytes | memoryview
+            if index in needed:
+                received: memoryview = buffer[:length]
+                _receive_exactly(client_socket, received)
+                chunk = received
+                if hashlib.new(CHUNK_ALGORITHM, chunk).hexdigest() != digest:
+                    raise ValueError(f"Chunk {index} failed verification")
+                store.put(digest, chunk)
+                bytes_received += length
+            else:
+                chunk = store.read(digest)
+                if hashlib.new(CHUNK_ALGORITHM, chunk).hexdigest() != digest:
+                    # Drop it, so that the chunk is transferred next time
+                    store.discard(digest)
+                    raise ValueError(f"Stored chunk {digest} is corrupt")
+            f.write(chunk)
+            if isinstance(hasher, ChunkListHasher):
+                # The chunk was checked against its digest already
+                hasher.add_chunk(digest)
+            elif hasher:
+                hasher.update(chunk)
+        return size, bytes_received
 
     def _reset_file_state(self) -> None:
         self._filepath = ""
         self._filename = ""
         self._file_transfer_pending = False
+        self._size = 0
+        self._chunks = []
+
+
+def valid_chunk_size(chunk_size: Any) -> int:
+    """Get a chunk size offered by a peer, or 0 if it isn't acceptable."""
+    if isinstance(chunk_size, int) and MIN_CHUNK_SIZE <= chunk_size <= MAX_CHUNK_SIZE:
+        return chunk_size
+    return 0
+
+
+def _receive_all(client_socket: socket.socket, f: BinaryIO, hasher: Any) -> int:
+    total_bytes: int = 0
+    while True:
+        file_data = client_socket.recv(64 * 1024)
+        if not file_data:
+            break
+        total_bytes += len(file_data)
+        f.write(file_data)
+        if hasher:
+            hasher.update(file_data)
+    return total_bytes
+
+
+def _receive_exactly(sock: socket.socket, view: memoryview) -> None:
+    received: int = 0
+    while received < len(view):
+        read: int = sock.recv_into(view[received:])
+        if not read:
+            raise ConnectionError("Peer closed the connection mid-transfer")
+        received += read
+
+
+def _send_message(sock: socket.socket, message: dict[str, Any]) -> None:
+    payload: bytes = json.dumps(message, separators=(",", ":")).encode("utf-8")
+    sock.sendall(MESSAGE_HEADER.pack(len(payload)) + payload)
+
+
+def _receive_message(sock: socket.socket) -> dict[str, Any]:
+    header: memoryview = memoryview(bytearray(MESSAGE_HEADER.size))
+    _receive_exactly(sock, header)
+    (length,) = MESSAGE_HEADER.unpack(header)
+    if length > MAX_MESSAGE_BYTES:
+        raise ValueError(f"Message from peer is too large: {length} bytes")
+    payload: memoryview = memoryview(bytearray(length))
+    _receive_exactly(sock, payload)
+    message: Any = json.loads(payload.tobytes())
+    if not isinstance(message, dict):
+        raise ValueError("Invalid message from peer")
+    return message
@@ -60,6 +60,10 @@ class LoginWindow:
             self.network_manager.add_event_handler(
                 "register_result", self.handle_register_result
             )
+            self.network_manager.add_event_handler(
+                "connection_rejected", self.handle_connection_rejected
+            )
+            self.network_manager.process_ui_events(self.window)
         except Exception as e:
             messagebox.showerror("Error", f"Failed to create login window: {str(e)}")
             raise e
@@ -113,6 +117,10 @@ class LoginWindow:
         username: str = self.username.get()
         password: str = self.password.get()
         try:
+            if not self.network_manager.socket:
+                # The server drops connections that don't log in in time, or
+                # that it rejected because it was full
+                self.network_manager.connect()
             self.network_manager.send(
                 {"command": command, "username": username, "password": password}
             )
@@ -131,10 +139,16 @@ class LoginWindow:
         if data.get("response") == "ok":
             self.authed = True
             self.network_manager.username = str(data.get("username"))
+            self.network_manager.session_token = str(data.get("session_token", ""))
             self.window.quit()
         else:
             self.handle_authentication_failure(data, "login")
 
+    def handle_connection_rejected(self, data: dict) -> None:
+        messagebox.showerror(
+            "Error", f"Connection rejected: {data.get('reason', 'unknown reason')}"
+        )
+
     def handle_authentication_failure(
         self, data: dict, command: Literal["login", "register"]
     ) -> dict | None:
@@ -95,10 +95,12 @@ class MainWindow:
 
             # Register event handlers
             self.register_event_handlers()
+            self.network_manager.process_ui_events(self.window)
 
             self.network_manager.validate_connection_state(should_be_connected=True)
 
             self.get_online_users()
+            self.get_offline_messages()
 
         except Exception as e:
             messagebox.showerror("Error", f"Failed to create main window: {str(e)}")
@@ -117,6 +119,9 @@ class MainWindow:
             "peer_left": self.handle_peer_left,
             "peer_joined": self.handle_peer_joined,
             "get_users": self.handle_get_users,
+            "offline_messages": self.handle_offline_messages,
+            "throttled": self.handle_throttled,
+            "login_result": self.handle_login_result,
         }
 
         for event, handler in event_handlers.items():
@@ -205,6 +210,9 @@ class MainWindow:
     def get_online_users(self) -> None:
         self.network_manager.send({"command": "get_users"})
 
+    def get_offline_messages(self) -> None:
+        self.network_manager.send({"command": "get_offline"})
+
     def switch_chat_session(self, event: tk.Event) -> None:
         selection = self.user_list.curselection()
         if selection:
@@ -241,6 +249,7 @@ class MainWindow:
                 # Generate timestamp for the message
                 timestamp: str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
 
+                self.ensure_connected()
                 # Send the message to the server
                 self.network_manager.send(
                     {
@@ -261,12 +270,30 @@ class MainWindow:
 
     def send_file(self) -> None:
         try:
+            self.ensure_connected()
             self.file_manager.send_file_request(self.current_session)
         except Exception as e:
             messagebox.showerror("Error", f"Error sending file: {str(e)}")
 
+    def ensure_connected(self) -> None:
+        # If the connection was lost, resume the session on a new one; the
+        # server processes commands in order, so they can be sent right away
+        if not self.network_manager.socket:
+            self.network_manager.reconnect()
+            self.get_online_users()
+
     # --- Incoming event handlers ---
 
+    def handle_login_result(self, data: dict) -> None:
+        # Answer to resuming the session after a reconnect
+        if data.get("response") == "ok":
+            self.network_manager.session_token = str(data.get("session_token", ""))
+        else:
+            self.network_manager.session_token = ""
+            messagebox.showerror(
+                "Error", f"Failed to reconnect: {data.get('reason', 'unknown reason')}"
+            )
+
     def handle_get_users(self, data: dict) -> None:
         """
         Handle the event when the server sends a list of online users.
@@ -302,40 +329,88 @@ class MainWindow:
         if sender != self.current_session:
             self.update_user_list({sender: True})
 
+    def handle_offline_messages(self, data: dict) -> None:
+        """
+        Handle private messages that were sent while the user was offline.
+
+        Args:
+            data (dict): A dictionary containing a list of (sender, time, message) entries.
+        """
+        for sender, timestamp, message in data.get("data", []):
+            self.append_message(sender, timestamp, message, "private")
+
+    def handle_throttled(self, data: dict) -> None:
+        """
+        Handle the server rejecting a command for exceeding a rate limit.
+
+        Args:
+            data (dict): A dictionary containing the command and the seconds
+                until it may be retried.
+        """
+        self.append_message(
+            "System",
+            time.strftime("%Y-%m-%d %H:%M:%S"),
+            f"Slow down! Please wait {data.get('retry_after', 1):.1f}s before "
+            "sending more messages.",
+            "system",
+        )
+
     def handle_file_request(self, data: dict) -> None:
         file_receive_result: tuple[bool, str] = self.show_file_receive_dialog(
             data["peer"], data["filename"], data["size"]
         )
         accept_file, destination_path = file_receive_result
         if accept_file:
-            self.network_manager.send(
-                {"command": "file_response", "peer": data["peer"], "response": "accept"}
+            response: dict = {
+                "command": "file_response",
+                "peer": data["peer"],
+                "response": "accept",
+            }
+            chunked: bool = self.file_manager.accepts_chunks(data)
+            if chunked:
+                # Only the chunks missing from the chunk store will be sent
+                response["chunked"] = True
+            self.network_manager.send(response)
+            # Receive on an IO worker so the window stays responsive
+            self.network_manager.dispatcher.submit(
+                "io",
+                lambda: self._receive_file(data["peer"], destination_path, data, chunked),
+                data["peer"],
             )
-            try:
-                total_bytes, transfer_time = self.file_manager.receive_file_data(
-                    destination_path,
-                )
-                messagebox.showinfo(
-                    "Info",
-                    f"File received: {total_bytes} bytes from {data['peer']} in {transfer_time:.2f} seconds",
-                )
-            except Exception as e:
-                messagebox.showerror("Error", f"Error receiving file: {str(e)}")
         else:
             self.network_manager.send(
                 {"command": "file_response", "peer": data["peer"], "response": "deny"}
             )
 
+    def _receive_file(
+        self, peer: str, destination_path: str, request: dict, chunked: bool
+    ) -> None:
+        try:
+            total_bytes, bytes_received, transfer_time = (
+                self.file_manager.receive_file_data(
+                    destination_path,
+                    request.get("hashes"),
+                    request.get("chunk_size", 0),
+                    chunked,
+                )
+            )
+            self._show_from_worker(
+                messagebox.showinfo,
+                "Info",
+                f"File received: {total_bytes} bytes from {peer} in {transfer_time:.2f} seconds"
+                + _reused_note(total_bytes, bytes_received),
+            )
+        except Exception as e:
+            self._show_from_worker(
+                messagebox.showerror, "Error", f"Error receiving file: {str(e)}"
+            )
+
     def handle_file_response(self, data: dict) -> None:
         if data["response"] == "accept":
-            try:
-                bytes_sent, transfer_time = self.file_manager.send_file_data(data)
-                messagebox.showinfo(
-                    "Info",
-                    f"File sent: {bytes_sent} bytes to {data['peer']} in {transfer_time:.2f} seconds",
-                )
-            except Exception as e:
-                messagebox.showerror("Error", f"Error sending file: {str(e)}")
+            # Send on an IO worker so the window stays responsive
+            self.network_manager.dispatcher.submit(
+                "io", lambda: self._send_file(data), data["peer"]
+            )
         elif data["response"] == "deny":
             messagebox.showinfo("Info", "File transfer denied by recipient")
             self.file_manager._reset_file_state()
@@ -343,6 +418,28 @@ class MainWindow:
             messagebox.showerror("Error", f"File transfer error: {data['reason']}")
             self.file_manager._reset_file_state()
 
+    def _send_file(self, data: dict) -> None:
+        try:
+            total_bytes, bytes_sent, transfer_time = self.file_manager.send_file_data(
+                data
+            )
+            self._show_from_worker(
+                messagebox.showinfo,
+                "Info",
+                f"File sent: {total_bytes} bytes to {data['peer']} in {transfer_time:.2f} seconds"
+                + _reused_note(total_bytes, bytes_sent),
+            )
+        except Exception as e:
+            self._show_from_worker(
+                messagebox.showerror, "Error", f"Error sending file: {str(e)}"
+            )
+
+    def _show_from_worker(
+        self, show: Callable[[str, str], object], title: str, message: str
+    ) -> None:
+        """Show a message box from a worker thread by handing it to the Tk thread."""
+        self.network_manager.dispatcher.submit("ui", lambda: show(title, message))
+
     def handle_peer_joined(self, data: dict) -> None:
         """
         Handle the event when a new peer joins the chat.
@@ -392,3 +489,12 @@ class MainWindow:
             if self.current_session == peer:
                 self.current_session = ""
                 self.current_chat.set("Global Chat Room")
+
+
+def _reused_note(total_bytes: int, bytes_transferred: int) -> str:
+    if bytes_transferred >= total_bytes:
+        return ""
+    return (
+        f" ({bytes_transferred} bytes transferred; the rest was already held "
+        "by the recipient)"
+    )
@@ -1,29 +1,89 @@
+import os
 import socket
 import json
+import queue
 import threading
 import logging
 import time
+import functools
+import tkinter as tk
 from typing import Any, Callable
-from utils.encryption import send, receive
+from client.dispatcher import EventDispatcher, HandlerKind
+from utils.encryption import MAX_MESSAGE_SIZE, encode_frame, receive
+from utils.logger import frame_dump_enabled
 
 logger = logging.getLogger(__name__)
 
 
 class NetworkManager:
-    def __init__(self, host: str, port: int):
+    """
+    Manages the client's connection to the server.
+
+    Outgoing messages are queued and written by a dedicated thread, so `send`
+    never blocks the caller (usually the Tk event loop) on the network.
+    The writer waits up to `coalesce_window` seconds for further messages
+    after the first and sends everything queued in a single `sendall`, so a
+    burst of messages costs one system call. Since the writer does its own
+    batching, Nagle's algorithm is disabled to avoid delaying the last frame
+    of a burst.
+
+    Incoming messages are handed to an `EventDispatcher` rather than handled
+    on the receive thread. Handlers run on the Tk thread by default, which
+    windows drive by calling `process_ui_events`; handlers registered as
+    "io" or "cpu" run on worker pools instead. Handlers for the same peer
+    run in the order their messages arrived.
+    """
+
+    __slots__ = (
+        "host",
+        "port",
+        "socket",
+        "max_buff_size",
+        "receive_thread",
+        "coalesce_window",
+        "send_thread",
+        "outgoing",
+        "username",
+        "session_token",
+        "event_handlers",
+        "dispatcher",
+    )
+
+    # Upper bound on the bytes coalesced into one write
+    max_batch_bytes: int = 64 * 1024
+    # Milliseconds between runs of queued UI handlers
+    ui_poll_interval: int = 20
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        coalesce_window: float = 0.002,
+        io_workers: int = 4,
+        cpu_workers: int = os.cpu_count() or 1,
+    ):
         self.host: str = host
         self.port: int = port
         self.socket: socket.socket | None = None
         self.max_buff_size: int = 1024
         self.receive_thread: threading.Thread | None = None
+        self.coalesce_window: float = coalesce_window
+        self.send_thread: threading.Thread | None = None
+        self.outgoing: queue.Queue[dict[str, Any] | None] = queue.Queue()
 
         self.username: str = ""
-        self.event_handlers: dict[str, list[Callable]] = {}
+        # Token from the last login, which the server accepts in a "resume"
+        # command in place of a password
+        self.session_token: str = ""
+        self.event_handlers: dict[str, list[tuple[Callable, HandlerKind]]] = {}
+        self.dispatcher: EventDispatcher = EventDispatcher(io_workers, cpu_workers)
 
     def connect(self):
         try:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             self.socket.connect((self.host, self.port))
+            self.start_send_loop()
             self.start_receive_loop()
 
             self.validate_connection_state(should_be_connected=True)
@@ -31,6 +91,22 @@ class NetworkManager:
             logger.error(f"Failed to connect to server: {str(e)}")
             raise ConnectionError(f"Failed to connect to server: {str(e)}")
 
+    def reconnect(self) -> None:
+        """
+        Connect again after losing the connection, and resume the session
+        with the token from the last login, so the user needn't log in again.
+        The server answers with a "login_result".
+
+        Raises:
+            ConnectionError: If there is no session to resume, or the server
+                can't be reached.
+        """
+        if not self.session_token:
+            raise ConnectionError("Lost connection to server")
+        logger.info("Reconnecting to resume the session")
+        self.connect()
+        self.send({"command": "resume", "token": self.session_token})
+
     def validate_connection_state(self, should_be_connected: bool = True) -> None:
         if should_be_connected:
             if not self.socket:
@@ -66,14 +142,66 @@ class NetworkManager:
                 )
 
     def send(self, data_dict: dict[str, Any]) -> None:
-        try:
-            if not self.socket:
-                raise ConnectionError("Lost connection to server")
-            send(self.socket, data_dict)
-        except Exception as e:
-            logger.error(f"Send error: {str(e)}")
-            self.close_connection()
-            raise e
+        """
+        Queue a message for sending without blocking.
+
+        Raises:
+            ConnectionError: If the client is not connected.
+            ValueError: If the message is too large to fit in a frame.
+        """
+        if not self.socket or not self.send_thread:
+            logger.error("Send error: Lost connection to server")
+            raise ConnectionError("Lost connection to server")
+        # Reject it here, while the caller can still be told, rather than in
+        # the writer thread
+        size: int = len(json.dumps(data_dict).encode("utf-8"))
+        if size > MAX_MESSAGE_SIZE:
+            raise ValueError(f"Message too large to send: {size} bytes")
+        self.outgoing.put(data_dict)
+
+    def start_send_loop(self) -> None:
+        if not self.send_thread:
+            self.outgoing = queue.Queue()
+            self.send_thread = threading.Thread(target=self._send_loop, daemon=True)
+            self.send_thread.start()
+
+    def _send_loop(self) -> None:
+        while True:
+            message: dict[str, Any] | None = self.outgoing.get()
+            if message is None:
+                return
+            stopping: bool = False
+            try:
+                frames: list[bytes] = [encode_frame(message)]
+                size: int = len(frames[0])
+
+                # Gather whatever else arrives within the coalescing window
+                deadline: float = time.monotonic() + self.coalesce_window
+                while size < self.max_batch_bytes:
+                    try:
+                        message = self.outgoing.get(
+                            timeout=max(0.0, deadline - time.monotonic())
+                        )
+                    except queue.Empty:
+                        break
+                    if message is None:
+                        stopping = True
+                        break
+                    frames.append(encode_frame(message))
+                    size += len(frames[-1])
+
+                if not self.socket:
+                    raise ConnectionError("Lost connection to server")
+                self.socket.sendall(b"".join(frames))
+            except Exception as e:
+                # Close the connection, so later sends fail rather than queue
+                # messages that no thread will write
+                logger.error(f"Send error: {str(e)}")
+                self.send_thread = None
+                self.close_connection()
+                return
+            if stopping:
+                return
 
     def start_receive_loop(self) -> None:
         if not self.receive_thread:
@@ -82,20 +210,43 @@ class NetworkManager:
             )
             self.receive_thread.start()
 
-    def add_event_handler(self, event: str, handler: Callable) -> None:
+    def add_event_handler(
+        self, event: str, handler: Callable, kind: HandlerKind = "ui"
+    ) -> None:
+        """
+        Register a handler for a server event.
+
+        Args:
+            event: The message type to handle.
+            handler: Called with the message.
+            kind: Where the handler runs; "ui" handlers run on the Tk thread
+                and may use widgets, "io" and "cpu" handlers run on worker
+                threads and must not.
+        """
         if event not in self.event_handlers:
             self.event_handlers[event] = []
-        self.event_handlers[event].append(handler)
+        self.event_handlers[event].append((handler, kind))
 
     def clear_event_handlers(self) -> None:
         self.event_handlers = {}
+        # Handlers already queued for the Tk thread belong to the old window
+        self.dispatcher.clear_ui_tasks()
+
+    def process_ui_events(self, window: tk.Misc) -> None:
+        """
+        Run queued UI handlers, then schedule the next run on the window's
+        event loop. Call once after creating a window to start handling events.
+        """
+        self.dispatcher.run_ui_tasks()
+        window.after(self.ui_poll_interval, self.process_ui_events, window)
 
     def handle_receive_errors(self, receive_func: Callable) -> dict[str, Any] | None:
         try:
             if not self.socket:
                 raise ConnectionError("Not connected to server")
             data: dict[str, Any] = receive_func(self.socket, self.max_buff_size)
-            logger.debug(f"Decrypted data: {data}")
+            if frame_dump_enabled(logger):
+                logger.debug("Decrypted data: %s", data)
             return data
         except json.JSONDecodeError:
             logger.error("Received invalid JSON data")
@@ -118,21 +269,50 @@ class NetworkManager:
             data: dict | None = self.handle_receive_errors(receive)
             if data:
                 event: str = data.get("type", "unknown")
-                handlers: list[Callable] = self.event_handlers.get(event, [])
+                if event == "ping":
+                    # Answer server heartbeats so the connection isn't reaped
+                    try:
+                        self.send({"command": "pong"})
+                    except Exception:
+                        # send has already logged the error and closed the connection
+                        pass
+                    continue
+                handlers: list[tuple[Callable, HandlerKind]] = self.event_handlers.get(
+                    event, []
+                )
                 if not handlers:
-                    logger.debug(f"Ignored unhandled event: {data}")
+                    logger.debug("Ignored unhandled event: %s", event)
                 else:
-                    for handler in handlers:
-                        handler(data)
+                    # Only dispatch here; handlers may block or touch the UI
+                    key: str = str(data.get("peer", ""))
+                    for handler, kind in handlers:
+                        self.dispatcher.submit(
+                            kind, functools.partial(handler, data), key
+                        )
             else:
                 logger.warning(f"Empty message received from server.")
 
     def close_connection(self) -> None:
-        if self.socket:
-            self.socket.close()
+        self.close_send_thread()
+        sock: socket.socket | None = self.socket
         self.socket = None
+        if sock:
+            try:
+                # Wake the receive thread, which close() alone doesn't do
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
         self.close_receive_thread()
 
+    def close_send_thread(self) -> None:
+        if self.send_thread:
+            # Let the writer flush queued messages before the socket is closed
+            self.outgoing.put(None)
+            if self.send_thread != threading.current_thread():
+                self.send_thread.join(timeout=1.0)
+        self.send_thread = None
+
     def close_receive_thread(self) -> None:
         if self.receive_thread and self.receive_thread != threading.current_thread():
             # Wait for the receive loop to finish
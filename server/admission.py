@@ -0,0 +1,134 @@
+import socket
+import threading
+import socketserver
+import logging
+from typing import Any
+from utils.encryption import send
+from server.metrics import CONNECTIONS_REJECTED
+
+logger = logging.getLogger(__name__)
+
+# Message sent to a rejected client, by rejection reason
+REJECTION_MESSAGES: dict[str, str] = {
+    "server_full": "Server is full, please try again later",
+    "ip_limit": "Too many connections from your address",
+}
+
+
+class AdmissionControl:
+    """
+    Caps the number of concurrent connections, in total and per client IP
+    address, so a burst of connections or a stuck client can't exhaust the
+    server's threads and file descriptors.
+    """
+
+    def __init__(self, max_connections: int, max_per_ip: int) -> None:
+        """
+        Args:
+            max_connections: Maximum open connections, or 0 for no limit.
+            max_per_ip: Maximum open connections from one IP address, or 0
+                for no limit.
+        """
+        self.max_connections: int = max_connections
+        self.max_per_ip: int = max_per_ip
+        self._total: int = 0
+        self._per_ip: dict[str, int] = {}
+        self._lock: threading.Lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._total
+
+    def admit(self, ip: str) -> str:
+        """
+        Count a new connection if the limits allow it.
+
+        Args:
+            ip: The client's IP address.
+
+        Returns:
+            An empty string if the connection was admitted, or else the
+            reason it wasn't ("server_full" or "ip_limit").
+        """
+        with self._lock:
+            if self.max_connections and self._total >= self.max_connections:
+                return "server_full"
+            from_ip: int = self._per_ip.get(ip, 0)
+            if self.max_per_ip and from_ip >= self.max_per_ip:
+                return "ip_limit"
+            self._total += 1
+            self._per_ip[ip] = from_ip + 1
+        return ""
+
+    def release(self, ip: str) -> None:
+        """Stop counting a connection admitted by `admit`."""
+        with self._lock:
+            self._total -= 1
+            remaining: int = self._per_ip.get(ip, 1) - 1
+            if remaining:
+                self._per_ip[ip] = remaining
+            else:
+                self._per_ip.pop(ip, None)
+
+
+class ChatServer(socketserver.ThreadingTCPServer):
+    """
+    A `ThreadingTCPServer` that applies `AdmissionControl` to each accepted
+    connection before starting a thread for it, and listens with a
+    configurable backlog. Rejected clients are sent a `connection_rejected`
+    message and disconnected.
+    """
+
+    def __init__(
+        self,
+        server_address: tuple[str, int],
+        handler_class: Any,
+        admission: AdmissionControl,
+        backlog: int,
+    ) -> None:
+        """
+        Args:
+            server_address: The (host, port) to listen on.
+            handler_class: The request handler class.
+            admission: The connection limits to enforce.
+            backlog: Maximum connections waiting to be accepted.
+        """
+        self.admission: AdmissionControl = admission
+        # Read by server_activate when it calls listen()
+        self.request_queue_size: int = backlog
+        super().__init__(server_address, handler_class)
+
+    def verify_request(self, request: Any, client_address: Any) -> bool:
+        reason: str = self.admission.admit(client_address[0])
+        if not reason:
+            return True
+        CONNECTIONS_REJECTED.labels(reason).inc()
+        logger.warning("Rejected connection from %s: %s", client_address, reason)
+        try:
+            # A new socket's send buffer is empty, so this doesn't block the
+            # accept loop, but don't wait on a misbehaving client regardless
+            request.settimeout(1)
+            send(
+                request,
+                {"type": "connection_rejected", "reason": REJECTION_MESSAGES[reason]},
+            )
+        except OSError:
+            pass
+        return False
+
+    def process_request(
+        self, request: socket.socket | tuple[bytes, socket.socket], client_address: Any
+    ) -> None:
+        try:
+            super().process_request(request, client_address)
+        except BaseException:
+            # No thread was started to release the connection
+            self.admission.release(client_address[0])
+            raise
+
+    def process_request_thread(
+        self, request: socket.socket | tuple[bytes, socket.socket], client_address: Any
+    ) -> None:
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self.admission.release(client_address[0])
@@ -1,10 +1,22 @@
 import os
+import gzip
+import json
 import pickle
+import hashlib
+import threading
 import time
 import logging
 from dotenv import load_dotenv
 from pathlib import Path
-from threading import Lock
+from typing import Any
+from server.metrics import (
+    TimedLock,
+    LOCK_WAIT_SECONDS,
+    HISTORY_PERSIST_SECONDS,
+    HISTORY_MESSAGES_ARCHIVED,
+)
+from server.search_index import SearchIndex, ConversationKey
+from server.conversation_log import ConversationLog, Message, UserTable
 
 load_dotenv()
 
@@ -12,15 +24,56 @@ load_dotenv()
 STORAGE_DIR: Path = Path.cwd() / os.getenv("STORAGE_DIR", ".ncr-data")
 STORAGE_DIR.mkdir(exist_ok=True)
 
+SEARCH_INDEX_SAVE_INTERVAL = float(os.getenv("SEARCH_INDEX_SAVE_INTERVAL", 30))
+
+# Number of locks that conversations are spread across
+HISTORY_LOCK_STRIPES: int = 64
+
 logger = logging.getLogger(__name__)
 
 
 class ChatHistory:
+    """
+    Stores the messages of every conversation, keyed by the two users of a
+    private conversation in sorted order, ("", "") for the global chat, or
+    ("#<room>", "") for a room.
+
+    Each conversation is guarded by one of a fixed set of striped locks, so
+    appends and reads on different conversations rarely contend. `self.lock`
+    only guards adding conversations and is never held while messages are
+    copied or written to disk.
+
+    Each conversation's messages are stored in a columnar `ConversationLog`,
+    with senders interned in a `UserTable` shared by all conversations. Logs
+    are only ever appended to, or replaced wholesale when messages are
+    archived, so readers note a log's length under its lock and decode the
+    messages after releasing it.
+    """
+
     def __init__(self) -> None:
-        self.lock = Lock()
+        self.lock = TimedLock(LOCK_WAIT_SECONDS.labels("chat_history"))
+        self._stripes: list[TimedLock] = [
+            TimedLock(LOCK_WAIT_SECONDS.labels("chat_history_conversation"))
+            for _ in range(HISTORY_LOCK_STRIPES)
+        ]
         self.history_filepath: Path = STORAGE_DIR / "history.dat"
-        self.history: dict[tuple[str, str], list[tuple[str, str, str]]] = (
-            self.load_history()
+        self.archive_dir: Path = STORAGE_DIR / "archive"
+        # Number of messages archived from the start of each conversation
+        self.base_offsets: dict[tuple[str, str], int] = {}
+        self.users: UserTable = UserTable()
+        self.history: dict[tuple[str, str], ConversationLog] = self.load_history()
+        self._canonicalize_keys()
+
+        # Saves requested while one is running are coalesced into one more save
+        self._save_state_lock: threading.Lock = threading.Lock()
+        self._saving: bool = False
+        self._save_requested: bool = False
+        self.search_index: SearchIndex = SearchIndex(
+            STORAGE_DIR / "search_index.dat", SEARCH_INDEX_SAVE_INTERVAL
+        )
+        self.search_index.catch_up(
+            (key, self.base_offsets.get(key, 0), log.bodies())
+            for key, log in self.history.items()
         )
 
         # Log absolute path of history file
@@ -35,9 +88,54 @@ class ChatHistory:
             u2: Second username.
 
         Returns:
-            A tuple containing the two usernames, ordered to ensure consistency.
+            A tuple containing the two usernames in sorted order.
         """
-        return (u1, u2) if (u2, u1) not in self.history.keys() else (u2, u1)
+        return (u1, u2) if u1 <= u2 else (u2, u1)
+
+    def conversations(self) -> list[tuple[str, str]]:
+        """Get the keys of all conversations."""
+        with self.lock:
+            return list(self.history.keys())
+
+    def snapshot(self, key: tuple[str, str]) -> list[Message]:
+        """
+        Get a conversation's current messages.
+
+        Args:
+            key: The conversation.
+
+        Returns:
+            A new list of (sender, timestamp, message) tuples.
+        """
+        with self._stripe(key):
+            log: ConversationLog | None = self.history.get(key)
+            length: int = len(log) if log is not None else 0
+        return log.messages(0, length) if log is not None else []
+
+    def message_times(self, key: tuple[str, str]) -> list[float]:
+        """Get the epoch time of each of a conversation's current messages."""
+        with self._stripe(key):
+            log: ConversationLog | None = self.history.get(key)
+            return log.times().tolist() if log is not None else []
+
+    def _stripe(self, key: tuple[str, str]) -> TimedLock:
+        return self._stripes[hash(key) % HISTORY_LOCK_STRIPES]
+
+    def get_room_identifier(self, room: str) -> tuple[str, str]:
+        """
+        Get the identifier of a room's conversation.
+
+        Room conversations are keyed by the room name prefixed with "#" and an
+        empty second element, which can't collide with a conversation between
+        two users or with the global conversation.
+
+        Args:
+            room: The room name.
+
+        Returns:
+            A tuple identifying the room's conversation.
+        """
+        return (f"#{room}", "")
 
     def append_to_history(self, sender: str, receiver: str, msg: str) -> None:
         """
@@ -48,21 +146,38 @@ class ChatHistory:
             receiver: The username of the message receiver, or an empty string for broadcast messages.
             msg: The message content.
         """
-        logger.debug(f"Appending message to history: {sender} -> {receiver}: {msg}")
+        logger.debug("Appending message to history: %s -> %s", sender, receiver)
         key = ("", "") if receiver == "" else self.get_chat_identifier(sender, receiver)
+        self._append(key, sender, msg)
 
-        with self.lock:
-            if key not in self.history:
-                self.history[key] = []
+    def append_to_room_history(self, room: str, sender: str, msg: str) -> None:
+        """
+        Append a message to a room's chat history.
 
-            self.history[key].append(
-                (sender, time.strftime("%m/%d %H:%M", time.localtime()), msg)
-            )
+        Args:
+            room: The room name.
+            sender: The username of the message sender.
+            msg: The message content.
+        """
+        logger.debug("Appending message to history: %s -> #%s", sender, room)
+        self._append(self.get_room_identifier(room), sender, msg)
+
+    def _append(self, key: tuple[str, str], sender: str, msg: str) -> None:
+        with self._stripe(key):
+            log: ConversationLog | None = self.history.get(key)
+            if log is None:
+                with self.lock:
+                    log = self.history[key] = ConversationLog(self.users)
+
+            log.append(sender, time.time(), msg)
+            # Indexed under the conversation's lock so messages are indexed in order
+            self.search_index.add(key, self.base_offsets.get(key, 0) + len(log) - 1, msg)
 
         self.save_history()
-        logger.debug(f"Successfully appended message to history and released lock.")
+        self.search_index.maybe_save()
+        logger.debug("Successfully appended message to history and released lock.")
 
-    def get_history(self, sender: str, receiver: str) -> list[tuple[str, str, str]]:
+    def get_history(self, sender: str, receiver: str) -> list[Message]:
         """
         Get chat history for a conversation.
 
@@ -71,28 +186,257 @@ class ChatHistory:
             receiver: The username of the receiver, or an empty string for broadcast messages.
 
         Returns:
-            A list of tuples containing chat history entries, each containing a sender, a
+            A list of chat history entries, each containing a sender, a
             timestamp, and a message.
         """
-        with self.lock:
-            key = (
-                ("", "")
-                if receiver == ""
-                else self.get_chat_identifier(sender, receiver)
+        key = ("", "") if receiver == "" else self.get_chat_identifier(sender, receiver)
+        return self.snapshot(key)
+
+    def get_room_history(self, room: str) -> list[Message]:
+        """
+        Get chat history for a room.
+
+        Args:
+            room: The room name.
+
+        Returns:
+            A list of chat history entries, each containing a sender, a
+            timestamp, and a message.
+        """
+        return self.snapshot(self.get_room_identifier(room))
+
+    def search(
+        self,
+        query: str,
+        username: str,
+        rooms: list[str],
+        peers: list[str] | None,
+        limit: int,
+    ) -> tuple[int, list[dict[str, Any]]]:
+        """
+        Search the conversations a user can see.
+
+        Args:
+            query: The search terms.
+            username: The user searching.
+            rooms: Rooms to search; the caller must check the user is a member.
+            peers: Users whose private conversations with `username` to search,
+                with "" for the global chat, or None for the global chat and
+                all of the user's private conversations.
+            limit: Maximum number of results.
+
+        Returns:
+            The total number of matches, and the best `limit` matches, each a
+            dict with the "sender", "time" and "message", a "score", and the
+            "room" or "peer" ("" for the global chat) it was found in.
+        """
+        room_keys: set[ConversationKey] = {self.get_room_identifier(room) for room in rooms}
+        peer_keys: set[ConversationKey] = {("", "")} if peers is None or "" in peers else set()
+        for peer in peers or ():
+            if peer:
+                peer_keys.add(self.get_chat_identifier(username, peer))
+
+        def allowed(key: ConversationKey) -> bool:
+            if key in room_keys or key in peer_keys:
+                return True
+            # Private conversations have two non-empty usernames
+            return peers is None and key[1] != "" and username in key
+
+        total, hits = self.search_index.search(query, allowed, limit)
+        results: list[dict[str, Any]] = []
+        for key, number, score in hits:
+            with self._stripe(key):
+                index: int = number - self.base_offsets.get(key, 0)
+                if index < 0:
+                    # Archived since the search ran
+                    continue
+                sender, timestamp, message = self.history[key][index]
+            result: dict[str, Any] = {
+                "sender": sender,
+                "time": timestamp,
+                "message": message,
+                "score": round(score, 3),
+            }
+            if key in room_keys:
+                result["room"] = key[0][1:]
+            else:
+                result["peer"] = key[1] if key[0] == username else key[0]
+            results.append(result)
+        return total, results
+
+    def archive_before(self, key: tuple[str, str], count: int) -> int:
+        """
+        Move the oldest messages of a conversation to its compressed archive.
+
+        The archive is written and the remaining messages copied without
+        holding the conversation's lock, which is only taken to swap in the
+        shortened list, so appends and reads are not blocked while a
+        conversation is compacted.
+
+        Args:
+            key: The conversation.
+            count: Number of messages to archive from the start.
+
+        Returns:
+            The number of messages archived.
+        """
+        with self._stripe(key):
+            log: ConversationLog | None = self.history.get(key)
+            length: int = len(log) if log is not None else 0
+            base: int = self.base_offsets.get(key, 0)
+        count = min(count, length)
+        if log is None or count <= 0:
+            return 0
+        expired: list[Message] = log.messages(0, count)
+        kept: ConversationLog = log.slice(count, length)
+        self._write_archive(key, base, expired)
+
+        with self._stripe(key):
+            if self.history.get(key) is not log:
+                logger.warning(f"Conversation {key} changed while archiving; skipped")
+                return 0
+            # Keep messages appended while the archive was being written
+            kept.extend(log, length, len(log))
+            self.history[key] = kept
+            self.base_offsets[key] = base + count
+
+        self.search_index.forget_before(
+            key, base + count, [message for _, _, message in expired]
+        )
+        self.save_history()
+        HISTORY_MESSAGES_ARCHIVED.inc(count)
+        return count
+
+    def _archive_path(self, key: tuple[str, str]) -> Path:
+        # Hash the key so that usernames are always safe to use in file names
+        digest: str = hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()
+        return self.archive_dir / f"{digest}.jsonl.gz"
+
+    def _write_archive(
+        self, key: tuple[str, str], base: int, messages: list[tuple[str, str, str]]
+    ) -> None:
+        self.archive_dir.mkdir(exist_ok=True)
+        lines: str = "".join(
+            json.dumps(
+                {
+                    "conversation": key,
+                    "number": base + offset,
+                    "sender": sender,
+                    "time": timestamp,
+                    "message": message,
+                }
             )
-            return self.history.get(key, [])
+            + "\n"
+            for offset, (sender, timestamp, message) in enumerate(messages)
+        )
+        # Each write adds a gzip member; readers see the members as one stream
+        with gzip.open(self._archive_path(key), "at", encoding="utf-8") as f:
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _read_archive(self, key: tuple[str, str]) -> list[tuple[str, str, str]]:
+        messages: dict[int, tuple[str, str, str]] = {}
+        try:
+            with gzip.open(self._archive_path(key), "rt", encoding="utf-8") as f:
+                for line in f:
+                    record = json.loads(line)
+                    # A message archived twice (after a crash) is only returned once
+                    messages[record["number"]] = (
+                        record["sender"],
+                        record["time"],
+                        record["message"],
+                    )
+        except FileNotFoundError:
+            return []
+        except (OSError, EOFError, ValueError, KeyError) as e:
+            logger.error(f"Failed to read archive for {key}: {e}")
+        return [messages[number] for number in sorted(messages)]
+
+    def get_archived_history(
+        self, sender: str, receiver: str
+    ) -> list[tuple[str, str, str]]:
+        """
+        Get the archived messages of a conversation, oldest first.
+
+        Args:
+            sender: The username of the sender.
+            receiver: The username of the receiver, or an empty string for broadcast messages.
+
+        Returns:
+            A list of (sender, timestamp, message) tuples.
+        """
+        key = ("", "") if receiver == "" else self.get_chat_identifier(sender, receiver)
+        return self._read_archive(key)
+
+    def get_archived_room_history(self, room: str) -> list[tuple[str, str, str]]:
+        """
+        Get the archived messages of a room, oldest first.
+
+        Args:
+            room: The room name.
+
+        Returns:
+            A list of (sender, timestamp, message) tuples.
+        """
+        return self._read_archive(self.get_room_identifier(room))
 
     def save_history(self) -> None:
         """
         Save chat history to a file.
+
+        If a save is already running, this returns at once and that save
+        writes the history again when it finishes, so concurrent appends
+        don't queue up behind each other's writes.
         """
-        with self.lock:
-            # Join the storage directory with the filename using Path
-            with open(self.history_filepath, "wb") as f:
-                pickle.dump(self.history, f)
+        with self._save_state_lock:
+            self._save_requested = True
+            if self._saving:
+                return
+            self._saving = True
+        try:
+            while True:
+                with self._save_state_lock:
+                    if not self._save_requested:
+                        self._saving = False
+                        return
+                    self._save_requested = False
+                self._write_history()
+        except BaseException:
+            with self._save_state_lock:
+                self._saving = False
+            raise
+
+    def _write_history(self) -> None:
+        with HISTORY_PERSIST_SECONDS.time():
+            # Copy each conversation's columns under its own lock, then write
+            # with no lock held
+            conversations: dict[tuple[str, str], tuple[bytes, bytes, bytes, bytes]] = {}
+            bases: dict[tuple[str, str], int] = {}
+            for key in self.conversations():
+                with self._stripe(key):
+                    log: ConversationLog = self.history[key]
+                    conversations[key] = log.dump(len(log))
+                    if key in self.base_offsets:
+                        bases[key] = self.base_offsets[key]
+            # Copied last, so it includes every sender in the copied columns
+            users: list[str] = list(self.users.names)
+            temp_filepath: Path = self.history_filepath.with_suffix(".tmp")
+            with open(temp_filepath, "wb") as f:
+                pickle.dump(
+                    {
+                        "version": 2,
+                        "users": users,
+                        "conversations": conversations,
+                        "bases": bases,
+                    },
+                    f,
+                    protocol=pickle.HIGHEST_PROTOCOL,
+                )
+            os.replace(temp_filepath, self.history_filepath)
 
     # TODO: Abstract away the load-from-file logic that's repeated in UserManager and ChatHistory
-    def load_history(self) -> dict[tuple[str, str], list[tuple[str, str, str]]]:
+    def load_history(self) -> dict[tuple[str, str], ConversationLog]:
         """
         Load chat history from a file.
 
@@ -101,9 +445,62 @@ class ChatHistory:
         """
         try:
             with open(self.history_filepath, "rb") as f:
-                return pickle.load(f)
+                state = pickle.load(f)
         except (FileNotFoundError, pickle.UnpicklingError):
             logger.warning(
                 f"Failed to load {self.history_filepath.name}; file will be created"
             )
             return {}
+
+        if state.get("version") == 2:
+            self.users = UserTable(state["users"])
+            self.base_offsets = state["bases"]
+            return {
+                key: ConversationLog.load(self.users, columns)
+                for key, columns in state["conversations"].items()
+            }
+
+        # Saved as lists of message tuples, by a version without archiving
+        # (a plain dictionary) or with it
+        if "history" in state:
+            self.base_offsets = state["bases"]
+            state = state["history"]
+        logger.info(f"Converting {self.history_filepath.name} to columnar storage")
+        return {
+            key: ConversationLog.from_messages(self.users, messages)
+            for key, messages in state.items()
+        }
+
+    def _canonicalize_keys(self) -> None:
+        """
+        Re-key private conversations saved with their users in either order
+        to the sorted order, merging a conversation stored under both orders.
+        Runs once on load, before the search index catches up.
+        """
+        for key in list(self.history.keys()):
+            u1, u2 = key
+            if not u2 or u1 <= u2:
+                continue
+            canonical: tuple[str, str] = (u2, u1)
+            log: ConversationLog = self.history.pop(key)
+            self.base_offsets.pop(key, None)
+            archived: list[Message] = self._read_archive(key)
+
+            if canonical not in self.history:
+                self.history[canonical] = log
+                canonical_base: int = 0
+            else:
+                merged: ConversationLog = ConversationLog(self.users)
+                for sender, moment, body in sorted(
+                    [*self.history[canonical].records(), *log.records()],
+                    key=lambda record: record[1],
+                ):
+                    merged.append(sender, moment, body)
+                self.history[canonical] = merged
+                canonical_base = self.base_offsets.get(canonical, 0)
+            if archived:
+                self._write_archive(canonical, canonical_base, archived)
+                self._archive_path(key).unlink()
+            if canonical_base + len(archived):
+                self.base_offsets[canonical] = canonical_base + len(archived)
+            logger.info(f"Moved conversation {key} to {canonical}")
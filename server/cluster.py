@@ -0,0 +1,791 @@
+import hmac
+import json
+import queue
+import socket
+import struct
+import threading
+import time
+import uuid
+import zlib
+import logging
+from typing import Any, Callable, Protocol
+from utils.encryption import MAX_MESSAGE_SIZE, encode_frame, receive
+from server.chat_history import ChatHistory
+from server.offline_inbox import OfflineInbox, OfflineMessage
+from server.user_manager import UserManager
+from server.metrics import CLUSTER_MESSAGES_SENT, CLUSTER_MESSAGES_RECEIVED
+
+logger = logging.getLogger(__name__)
+
+# Callback invoked with the sending node's ID and the message
+MessageCallback = Callable[[str, dict[str, Any]], None]
+# Callback invoked with a node's ID when it connects or disconnects
+PeerCallback = Callable[[str], None]
+
+
+# -- Transports --
+
+
+class ClusterBus:
+    """
+    Transport that carries JSON-serializable messages between cluster nodes.
+
+    Subclasses deliver messages to the `on_message` callback passed to `start`,
+    and report peers coming and going through `on_peer_up` and `on_peer_down`.
+    """
+
+    def __init__(self, node_id: str) -> None:
+        self.node_id: str = node_id
+        self._on_message: MessageCallback = lambda node_id, message: None
+        self._on_peer_up: PeerCallback = lambda node_id: None
+        self._on_peer_down: PeerCallback = lambda node_id: None
+
+    def start(
+        self,
+        on_message: MessageCallback,
+        on_peer_up: PeerCallback,
+        on_peer_down: PeerCallback,
+    ) -> None:
+        self._on_message = on_message
+        self._on_peer_up = on_peer_up
+        self._on_peer_down = on_peer_down
+
+    def nodes(self) -> list[str]:
+        """
+        Get the IDs of all nodes in the cluster, including this one.
+
+        The list must be the same on every node, since it determines which
+        node owns each partition of the chat history.
+        """
+        raise NotImplementedError
+
+    def send(self, node_id: str, message: dict[str, Any]) -> None:
+        """
+        Send a message to one node without waiting for it to be delivered.
+
+        Raises:
+            ValueError: If the message is too large for a frame once
+                serialized (more than `MAX_MESSAGE_SIZE` bytes of JSON).
+        """
+        raise NotImplementedError
+
+    def broadcast(self, message: dict[str, Any]) -> None:
+        """Send a message to every other node."""
+        for node_id in self.nodes():
+            if node_id != self.node_id:
+                self.send(node_id, message)
+
+    def close(self) -> None:
+        pass
+
+
+class LocalBus(ClusterBus):
+    """
+    In-process transport connecting every bus created with the same `hub`.
+
+    Messages are round-tripped through JSON and delivered on a background
+    thread, like the TCP transport, which makes this a stand-in for tests.
+    """
+
+    def __init__(self, node_id: str, hub: dict[str, "LocalBus"]) -> None:
+        super().__init__(node_id)
+        self.hub: dict[str, LocalBus] = hub
+        self._inbox: queue.Queue[tuple[str, str] | None] = queue.Queue()
+        self._thread: threading.Thread = threading.Thread(
+            target=self._dispatch_loop, name=f"Local bus {node_id}", daemon=True
+        )
+
+    def start(
+        self,
+        on_message: MessageCallback,
+        on_peer_up: PeerCallback,
+        on_peer_down: PeerCallback,
+    ) -> None:
+        super().start(on_message, on_peer_up, on_peer_down)
+        self._thread.start()
+        self.hub[self.node_id] = self
+        for node_id, bus in list(self.hub.items()):
+            if node_id != self.node_id:
+                bus._on_peer_up(self.node_id)
+                self._on_peer_up(node_id)
+
+    def nodes(self) -> list[str]:
+        return sorted(self.hub)
+
+    def send(self, node_id: str, message: dict[str, Any]) -> None:
+        bus: LocalBus | None = self.hub.get(node_id)
+        if bus is None:
+            logger.warning(f"Dropping message for unknown node {node_id}")
+            return
+        payload: str = json.dumps(message)
+        # Hold messages to the frame size limit of the TCP transport
+        if len(payload) > MAX_MESSAGE_SIZE:
+            raise ValueError(f"Cluster message too large: {len(payload)} bytes")
+        CLUSTER_MESSAGES_SENT.labels(str(message.get("kind"))).inc()
+        bus._inbox.put((self.node_id, payload))
+
+    def close(self) -> None:
+        self.hub.pop(self.node_id, None)
+        for bus in list(self.hub.values()):
+            bus._on_peer_down(self.node_id)
+        self._inbox.put(None)
+
+    def _dispatch_loop(self) -> None:
+        while True:
+            item = self._inbox.get()
+            if item is None:
+                return
+            sender, payload = item
+            message: dict[str, Any] = json.loads(payload)
+            CLUSTER_MESSAGES_RECEIVED.labels(str(message.get("kind"))).inc()
+            try:
+                self._on_message(sender, message)
+            except Exception as e:
+                logger.error(f"Error handling cluster message from {sender}: {e}")
+
+
+class TcpMeshBus(ClusterBus):
+    """
+    Transport that connects every node directly to every other node over TCP.
+
+    Each node listens for connections from its peers and opens one outgoing
+    connection to each peer, which it reconnects with backoff if it drops.
+    Messages use the same framing as client connections. Every connection
+    starts with a hello message carrying the node ID and shared secret.
+    """
+
+    # Messages held for a peer that is down before new ones are dropped
+    max_queued_messages: int = 10000
+
+    def __init__(
+        self,
+        node_id: str,
+        listen_address: tuple[str, int],
+        peers: dict[str, tuple[str, int]],
+        secret: str,
+    ) -> None:
+        """
+        Args:
+            node_id: The ID of this node.
+            listen_address: The (host, port) to accept peer connections on.
+            peers: The (host, port) of every other node, keyed by node ID.
+            secret: Shared secret that peers must present when connecting.
+
+        Raises:
+            ValueError: If the secret is empty, which would let anyone who
+                can reach the listening port join the cluster.
+        """
+        if not secret:
+            raise ValueError("A cluster secret is required")
+        super().__init__(node_id)
+        self.listen_address: tuple[str, int] = listen_address
+        self.peers: dict[str, tuple[str, int]] = peers
+        self.secret: str = secret
+        self._outgoing: dict[str, queue.Queue[bytes]] = {
+            peer: queue.Queue(self.max_queued_messages) for peer in peers
+        }
+        self._listener: socket.socket | None = None
+        self._closed: threading.Event = threading.Event()
+
+    def start(
+        self,
+        on_message: MessageCallback,
+        on_peer_up: PeerCallback,
+        on_peer_down: PeerCallback,
+    ) -> None:
+        super().start(on_message, on_peer_up, on_peer_down)
+        self._listener = socket.create_server(self.listen_address)
+        threading.Thread(
+            target=self._accept_loop, name="Cluster listener", daemon=True
+        ).start()
+        for peer in self.peers:
+            threading.Thread(
+                target=self._send_loop, args=(peer,), name=f"Cluster link {peer}", daemon=True
+            ).start()
+        logger.info(
+            f"Cluster node {self.node_id} listening on "
+            f"{self.listen_address[0]}:{self.listen_address[1]}"
+        )
+
+    def nodes(self) -> list[str]:
+        return sorted([self.node_id, *self.peers])
+
+    def send(self, node_id: str, message: dict[str, Any]) -> None:
+        outgoing: queue.Queue[bytes] | None = self._outgoing.get(node_id)
+        if outgoing is None:
+            logger.warning(f"Dropping message for unknown node {node_id}")
+            return
+        try:
+            frame: bytes = encode_frame(message)
+        except struct.error:
+            raise ValueError("Cluster message too large for a frame") from None
+        try:
+            outgoing.put_nowait(frame)
+            CLUSTER_MESSAGES_SENT.labels(str(message.get("kind"))).inc()
+        except queue.Full:
+            logger.warning(f"Queue for cluster node {node_id} is full; message dropped")
+
+    def close(self) -> None:
+        self._closed.set()
+        if self._listener:
+            self._listener.close()
+
+    def _hello(self) -> dict[str, Any]:
+        return {"kind": "hello", "node_id": self.node_id, "secret": self.secret}
+
+    def _send_loop(self, peer: str) -> None:
+        backoff: float = 0.5
+        outgoing: queue.Queue[bytes] = self._outgoing[peer]
+        while not self._closed.is_set():
+            try:
+                with socket.create_connection(self.peers[peer], timeout=5) as sock:
+                    sock.settimeout(None)
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    sock.sendall(encode_frame(self._hello()))
+                    backoff = 0.5
+                    logger.info(f"Connected to cluster node {peer}")
+                    self._on_peer_up(peer)
+                    while not self._closed.is_set():
+                        frames: list[bytes] = [outgoing.get()]
+                        # Coalesce whatever else is already queued into one write
+                        while len(frames) < 64:
+                            try:
+                                frames.append(outgoing.get_nowait())
+                            except queue.Empty:
+                                break
+                        sock.sendall(b"".join(frames))
+            except OSError as e:
+                logger.warning(f"Link to cluster node {peer} failed: {e}")
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 10.0)
+
+    def _accept_loop(self) -> None:
+        assert self._listener is not None
+        while not self._closed.is_set():
+            try:
+                sock, address = self._listener.accept()
+            except OSError:
+                return
+            threading.Thread(
+                target=self._receive_loop, args=(sock, address), daemon=True
+            ).start()
+
+    def _receive_loop(self, sock: socket.socket, address: tuple[str, int]) -> None:
+        peer: str = ""
+        try:
+            with sock:
+                hello: dict[str, Any] = receive(sock)
+                if (
+                    hello.get("kind") != "hello"
+                    or hello.get("node_id") not in self.peers
+                    or not isinstance(hello.get("secret"), str)
+                    or not hmac.compare_digest(
+                        hello["secret"].encode("utf-8"), self.secret.encode("utf-8")
+                    )
+                ):
+                    logger.warning(f"Rejected cluster connection from {address}")
+                    return
+                peer = hello["node_id"]
+                while not self._closed.is_set():
+                    message: dict[str, Any] = receive(sock)
+                    CLUSTER_MESSAGES_RECEIVED.labels(str(message.get("kind"))).inc()
+                    try:
+                        self._on_message(peer, message)
+                    except Exception as e:
+                        logger.error(f"Error handling cluster message from {peer}: {e}")
+        except (OSError, ValueError) as e:
+            logger.warning(f"Lost connection from cluster node {peer or address}: {e}")
+        finally:
+            if peer:
+                self._on_peer_down(peer)
+
+
+def parse_peers(value: str) -> dict[str, tuple[str, int]]:
+    """
+    Parse a peer list of the form "node-b=10.0.0.2:9000,node-c=10.0.0.3:9000".
+
+    Args:
+        value: The peer list.
+
+    Returns:
+        A dictionary mapping node IDs to (host, port) tuples.
+    """
+    peers: dict[str, tuple[str, int]] = {}
+    for entry in filter(None, (part.strip() for part in value.split(","))):
+        node_id, address = entry.split("=", 1)
+        host, port = address.rsplit(":", 1)
+        peers[node_id.strip()] = (host.strip(), int(port))
+    return peers
+
+
+# -- Cluster node --
+
+
+class LocalNode(Protocol):
+    """The parts of the local server that a cluster node routes messages to."""
+
+    chat_history: ChatHistory
+    offline_inbox: OfflineInbox
+    user_manager: UserManager
+
+    def local_usernames(self) -> list[str]: ...
+
+    def deliver_to_user(
+        self, username: str, data: dict[str, Any], file_peer: str = ""
+    ) -> bool: ...
+
+    def deliver_to_all(self, data: dict[str, Any], exclude: str = "") -> None: ...
+
+    def deliver_to_room(self, room: str, data: dict[str, Any], exclude: str = "") -> None: ...
+
+
+class ClusterNode:
+    """
+    Shares presence between server nodes and routes messages across them.
+
+    Every node tells the others which users are connected to it, so private
+    messages can be forwarded to the node that holds the recipient, and
+    broadcasts reach every node. Chat history and offline inboxes are
+    partitioned by conversation: each partition is owned by one node, chosen
+    by hashing the partition key over the sorted node list, so storage and
+    persistence work are spread across the cluster.
+    """
+
+    def __init__(self, bus: ClusterBus, local: LocalNode, timeout: float) -> None:
+        """
+        Args:
+            bus: The transport to other nodes.
+            local: The local server.
+            timeout: Seconds to wait for another node to answer a request.
+        """
+        self.bus: ClusterBus = bus
+        self.local: LocalNode = local
+        self.timeout: float = timeout
+        self.node_id: str = bus.node_id
+
+        self.lock: threading.Lock = threading.Lock()
+        # Users connected to other nodes, mapped to their node
+        self.remote_users: dict[str, str] = {}
+        # Responses received so far to each outstanding request, and an event
+        # set once the last of them arrives
+        self._pending: dict[str, tuple[threading.Event, list[dict[str, Any]]]] = {}
+        # Offline messages sent to another node, by request ID, kept until
+        # that node acknowledges them so they can be restored if it doesn't
+        self._unacknowledged: dict[str, tuple[str, list[OfflineMessage]]] = {}
+
+    def start(self) -> None:
+        self.bus.start(self._handle_message, self._handle_peer_up, self._handle_peer_down)
+
+    # -- Partitioning --
+
+    def owner(self, partition: str) -> str:
+        """
+        Get the node that owns a partition of the chat history.
+
+        Args:
+            partition: The partition key.
+
+        Returns:
+            The ID of the owning node.
+        """
+        nodes: list[str] = self.bus.nodes()
+        return nodes[zlib.crc32(partition.encode("utf-8")) % len(nodes)]
+
+    @staticmethod
+    def conversation_partition(sender: str, receiver: str) -> str:
+        # Sort the usernames so both directions of a conversation map to one partition
+        return "" if receiver == "" else "\0".join(sorted((sender, receiver)))
+
+    # -- Presence --
+
+    def user_joined(self, username: str) -> None:
+        self.bus.broadcast({"kind": "presence_join", "username": username})
+
+    def user_left(self, username: str) -> None:
+        self.bus.broadcast({"kind": "presence_leave", "username": username})
+
+    def remote_usernames(self) -> list[str]:
+        with self.lock:
+            return list(self.remote_users)
+
+    def users_registered(self, entries: list[tuple[str, str]]) -> None:
+        # Replicate accounts so users can log in to any node
+        for batch in self._batches({"kind": "users_registered"}, "records", entries):
+            self.bus.broadcast(batch)
+
+    # -- Routing --
+
+    def send_to_user(self, username: str, data: dict[str, Any], file_peer: str = "") -> bool:
+        """
+        Forward a message to a user connected to another node.
+
+        Args:
+            username: The recipient.
+            data: The message to deliver.
+            file_peer: If set, record this user as the recipient's pending file
+                transfer peer.
+
+        Returns:
+            True if the user is connected to another node, False otherwise.
+        """
+        with self.lock:
+            node_id: str | None = self.remote_users.get(username)
+        if node_id is None:
+            return False
+        self.bus.send(
+            node_id,
+            {"kind": "deliver", "username": username, "data": data, "file_peer": file_peer},
+        )
+        return True
+
+    def send_to_all(self, data: dict[str, Any], exclude: str = "") -> None:
+        self.bus.broadcast({"kind": "broadcast", "data": data, "exclude": exclude})
+
+    def send_to_room(self, room: str, data: dict[str, Any], exclude: str = "") -> None:
+        self.bus.broadcast(
+            {"kind": "room_broadcast", "room": room, "data": data, "exclude": exclude}
+        )
+
+    # -- Partitioned storage --
+
+    def append_to_history(self, sender: str, receiver: str, msg: str) -> None:
+        owner: str = self.owner(self.conversation_partition(sender, receiver))
+        if owner == self.node_id:
+            self.local.chat_history.append_to_history(sender, receiver, msg)
+        else:
+            self.bus.send(
+                owner,
+                {"kind": "history_append", "sender": sender, "receiver": receiver, "msg": msg},
+            )
+
+    def append_to_room_history(self, room: str, sender: str, msg: str) -> None:
+        owner: str = self.owner(f"#{room}")
+        if owner == self.node_id:
+            self.local.chat_history.append_to_room_history(room, sender, msg)
+        else:
+            self.bus.send(
+                owner,
+                {"kind": "room_history_append", "room": room, "sender": sender, "msg": msg},
+            )
+
+    def get_history(self, sender: str, receiver: str) -> list[Any]:
+        owner: str = self.owner(self.conversation_partition(sender, receiver))
+        if owner == self.node_id:
+            return list(self.local.chat_history.get_history(sender, receiver))
+        return self._request(
+            owner, {"kind": "history_get", "sender": sender, "receiver": receiver}
+        )
+
+    def get_room_history(self, room: str) -> list[Any]:
+        owner: str = self.owner(f"#{room}")
+        if owner == self.node_id:
+            return list(self.local.chat_history.get_room_history(room))
+        return self._request(owner, {"kind": "room_history_get", "room": room})
+
+    def get_archived_history(self, sender: str, receiver: str) -> list[Any]:
+        owner: str = self.owner(self.conversation_partition(sender, receiver))
+        if owner == self.node_id:
+            return self.local.chat_history.get_archived_history(sender, receiver)
+        return self._request(
+            owner, {"kind": "archive_get", "sender": sender, "receiver": receiver}
+        )
+
+    def get_archived_room_history(self, room: str) -> list[Any]:
+        owner: str = self.owner(f"#{room}")
+        if owner == self.node_id:
+            return self.local.chat_history.get_archived_room_history(room)
+        return self._request(owner, {"kind": "room_archive_get", "room": room})
+
+    def add_offline_message(self, recipient: str, sender: str, message: str) -> None:
+        owner: str = self.owner(f"@{recipient}")
+        if owner == self.node_id:
+            self.local.offline_inbox.add(recipient, sender, message)
+        else:
+            self.bus.send(
+                owner,
+                {"kind": "inbox_add", "recipient": recipient, "sender": sender, "message": message},
+            )
+
+    def drain_offline_messages(self, recipient: str) -> list[OfflineMessage]:
+        owner: str = self.owner(f"@{recipient}")
+        if owner == self.node_id:
+            return self.local.offline_inbox.drain(recipient)
+        response: dict[str, Any] | None = self._request_many(
+            [owner], {"kind": "inbox_drain", "recipient": recipient}
+        )[0]
+        if response is None:
+            # The owner puts the messages back unless they are acknowledged
+            return []
+        self.bus.send(owner, {"kind": "inbox_ack", "request_id": response["request_id"]})
+        return [(sender, timestamp, message) for sender, timestamp, message in response["data"]]
+
+    def search(
+        self,
+        query: str,
+        username: str,
+        rooms: list[str],
+        peers: list[str] | None,
+        limit: int,
+    ) -> tuple[int, list[dict[str, Any]]]:
+        """
+        Search the history partitions on every node and merge the results.
+        Takes the same arguments as `ChatHistory.search`.
+        """
+        request: dict[str, Any] = {
+            "kind": "search",
+            "query": query,
+            "username": username,
+            "rooms": rooms,
+            "peers": peers,
+            "limit": limit,
+        }
+        total, results = self.local.chat_history.search(query, username, rooms, peers, limit)
+        others: list[str] = [node for node in self.bus.nodes() if node != self.node_id]
+        for response in self._request_many(others, request):
+            if response:
+                total += response["total"]
+                results.extend(response["data"])
+        results.sort(key=lambda result: result["score"], reverse=True)
+        return total, results[:limit]
+
+    # -- Requests between nodes --
+
+    def _request(self, node_id: str, message: dict[str, Any]) -> list[Any]:
+        """
+        Send a request to another node and wait for its response.
+
+        Returns:
+            The response data, or an empty list if the node didn't answer in time.
+        """
+        response: dict[str, Any] | None = self._request_many([node_id], message)[0]
+        return response["data"] if response else []
+
+    def _request_many(
+        self, node_ids: list[str], message: dict[str, Any]
+    ) -> list[dict[str, Any] | None]:
+        """
+        Send a request to several nodes at once and wait for all their responses.
+
+        Returns:
+            Each node's response, with the data of all its batches joined, or
+            None for nodes that didn't answer in time.
+        """
+        requests: list[tuple[str, str, threading.Event, list[dict[str, Any]]]] = []
+        with self.lock:
+            for node_id in node_ids:
+                request_id: str = uuid.uuid4().hex
+                event: threading.Event = threading.Event()
+                batches: list[dict[str, Any]] = []
+                self._pending[request_id] = (event, batches)
+                requests.append((node_id, request_id, event, batches))
+        try:
+            for node_id, request_id, _, _ in requests:
+                self.bus.send(node_id, {**message, "request_id": request_id})
+            deadline: float = time.monotonic() + self.timeout
+            responses: list[dict[str, Any] | None] = []
+            for node_id, _, event, batches in requests:
+                if event.wait(max(0.0, deadline - time.monotonic())):
+                    data: list[Any] = [item for batch in batches for item in batch["data"]]
+                    responses.append({**batches[-1], "data": data})
+                else:
+                    logger.error(f"Cluster node {node_id} did not answer {message['kind']}")
+                    responses.append(None)
+            return responses
+        finally:
+            with self.lock:
+                for _, request_id, _, _ in requests:
+                    self._pending.pop(request_id, None)
+
+    def _respond(
+        self, node_id: str, message: dict[str, Any], data: list[Any], **fields: Any
+    ) -> None:
+        """
+        Answer a request, split into as many responses as fit within the frame
+        size limit. All but the last are marked as having "more" to follow.
+
+        Args:
+            node_id: The requesting node.
+            message: The request.
+            data: The items to send, split across the "data" field of each response.
+            fields: Extra fields to include in every response.
+        """
+        response: dict[str, Any] = {
+            "kind": "response",
+            "request_id": message["request_id"],
+            "more": False,
+            **fields,
+        }
+        batches: list[dict[str, Any]] = self._batches(response, "data", data)
+        for batch in batches[:-1]:
+            batch["more"] = True
+        for batch in batches:
+            self.bus.send(node_id, batch)
+
+    @staticmethod
+    def _batches(
+        message: dict[str, Any], field: str, items: list[Any]
+    ) -> list[dict[str, Any]]:
+        """
+        Split a list across copies of a message, each within the frame size
+        limit. There is always at least one message, even for an empty list.
+
+        Args:
+            message: The fields to include in every message.
+            field: The field to put each batch of items in.
+            items: The items to split.
+
+        Returns:
+            The messages.
+        """
+        overhead: int = len(json.dumps({**message, field: []}))
+        messages: list[dict[str, Any]] = []
+        batch: list[Any] = []
+        batch_size: int = 0
+        for item in items:
+            # Account for the separator between list items
+            item_size: int = len(json.dumps(item)) + 2
+            if batch and overhead + batch_size + item_size > MAX_MESSAGE_SIZE:
+                messages.append({**message, field: batch})
+                batch, batch_size = [], 0
+            batch.append(item)
+            batch_size += item_size
+        messages.append({**message, field: batch})
+        return messages
+
+    def _restore_unacknowledged(self, request_id: str) -> None:
+        """Put back offline messages whose delivery another node didn't acknowledge."""
+        with self.lock:
+            entry: tuple[str, list[OfflineMessage]] | None = self._unacknowledged.pop(
+                request_id, None
+            )
+        if entry:
+            recipient, messages = entry
+            logger.warning(
+                f"Delivery of {len(messages)} offline messages for {recipient} "
+                "was not acknowledged; keeping them"
+            )
+            self.local.offline_inbox.restore(recipient, messages)
+
+    # -- Bus callbacks --
+
+    def _handle_peer_up(self, node_id: str) -> None:
+        # Tell the new peer which users are connected here
+        for batch in self._batches(
+            {"kind": "presence_sync"}, "usernames", self.local.local_usernames()
+        ):
+            self.bus.send(node_id, batch)
+
+    def _handle_peer_down(self, node_id: str) -> None:
+        with self.lock:
+            departed: list[str] = [
+                user for user, node in self.remote_users.items() if node == node_id
+            ]
+            for user in departed:
+                del self.remote_users[user]
+        for user in departed:
+            self.local.deliver_to_all({"type": "peer_left", "peer": user})
+
+    def _handle_message(self, node_id: str, message: dict[str, Any]) -> None:
+        kind: str = message.get("kind", "")
+        if kind == "deliver":
+            self.local.deliver_to_user(
+                message["username"], message["data"], message.get("file_peer", "")
+            )
+        elif kind == "broadcast":
+            self.local.deliver_to_all(message["data"], message.get("exclude", ""))
+        elif kind == "room_broadcast":
+            self.local.deliver_to_room(
+                message["room"], message["data"], message.get("exclude", "")
+            )
+        elif kind == "presence_join":
+            with self.lock:
+                self.remote_users[message["username"]] = node_id
+            self.local.deliver_to_all(
+                {"type": "peer_joined", "peer": message["username"]}
+            )
+        elif kind == "presence_leave":
+            with self.lock:
+                if self.remote_users.get(message["username"]) == node_id:
+                    del self.remote_users[message["username"]]
+            self.local.deliver_to_all({"type": "peer_left", "peer": message["username"]})
+        elif kind == "presence_sync":
+            with self.lock:
+                for user in message["usernames"]:
+                    self.remote_users[user] = node_id
+        elif kind == "users_registered":
+            self.local.user_manager.add_records(
+                [(username, record) for username, record in message["records"]]
+            )
+        elif kind == "history_append":
+            self.local.chat_history.append_to_history(
+                message["sender"], message["receiver"], message["msg"]
+            )
+        elif kind == "room_history_append":
+            self.local.chat_history.append_to_room_history(
+                message["room"], message["sender"], message["msg"]
+            )
+        elif kind == "history_get":
+            self._respond(
+                node_id,
+                message,
+                list(self.local.chat_history.get_history(message["sender"], message["receiver"])),
+            )
+        elif kind == "room_history_get":
+            self._respond(
+                node_id, message, list(self.local.chat_history.get_room_history(message["room"]))
+            )
+        elif kind == "archive_get":
+            self._respond(
+                node_id,
+                message,
+                self.local.chat_history.get_archived_history(
+                    message["sender"], message["receiver"]
+                ),
+            )
+        elif kind == "room_archive_get":
+            self._respond(
+                node_id,
+                message,
+                self.local.chat_history.get_archived_room_history(message["room"]),
+            )
+        elif kind == "search":
+            total, results = self.local.chat_history.search(
+                message["query"],
+                message["username"],
+                message["rooms"],
+                message["peers"],
+                message["limit"],
+            )
+            self._respond(node_id, message, results, total=total)
+        elif kind == "inbox_add":
+            self.local.offline_inbox.add(
+                message["recipient"], message["sender"], message["message"]
+            )
+        elif kind == "inbox_drain":
+            drained: list[OfflineMessage] = self.local.offline_inbox.drain(message["recipient"])
+            if drained:
+                with self.lock:
+                    self._unacknowledged[message["request_id"]] = (
+                        message["recipient"],
+                        drained,
+                    )
+                # Allow for the requester's timeout and the acknowledgement's trip
+                timer: threading.Timer = threading.Timer(
+                    self.timeout * 2, self._restore_unacknowledged, (message["request_id"],)
+                )
+                timer.daemon = True
+                timer.start()
+            self._respond(node_id, message, [list(entry) for entry in drained])
+        elif kind == "inbox_ack":
+            with self.lock:
+                self._unacknowledged.pop(message["request_id"], None)
+        elif kind == "response":
+            with self.lock:
+                pending = self._pending.get(message["request_id"])
+            if pending:
+                event, batches = pending
+                batches.append(message)
+                if not message.get("more"):
+                    event.set()
+        else:
+            logger.warning(f"Unknown cluster message kind from {node_id}: {kind}")
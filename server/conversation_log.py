@@ -0,0 +1,216 @@
+import time
+import threading
+from array import array
+from datetime import datetime
+from typing import Iterator
+
+# A message as sent to clients: (sender, "%m/%d %H:%M" timestamp, message)
+Message = tuple[str, str, str]
+# A message as stored: (sender, epoch time, message)
+Record = tuple[str, float, str]
+
+TIME_FORMAT: str = "%m/%d %H:%M"
+
+
+class UserTable:
+    """
+    Interns usernames as small integer IDs, so each conversation stores a
+    4-byte ID per message instead of a reference to a string.
+    """
+
+    def __init__(self, names: list[str] | None = None) -> None:
+        self.names: list[str] = list(names or ())
+        self._ids: dict[str, int] = {name: index for index, name in enumerate(self.names)}
+        self._lock: threading.Lock = threading.Lock()
+
+    def id(self, name: str) -> int:
+        user_id: int | None = self._ids.get(name)
+        if user_id is None:
+            with self._lock:
+                user_id = self._ids.get(name)
+                if user_id is None:
+                    user_id = len(self.names)
+                    self.names.append(name)
+                    self._ids[name] = user_id
+        return user_id
+
+
+class ConversationLog:
+    """
+    The messages of one conversation, stored column by column: sender IDs in
+    an array('I'), epoch times in an array('d'), and message bodies in one
+    UTF-8 buffer with an array('Q') of offsets into it. A message costs about
+    20 bytes plus its encoded body, rather than a tuple and three strings.
+
+    Logs are append-only. Appends only add to the end of each column, so
+    messages below a length read earlier never change, and a reader that
+    notes the length under the conversation's lock can decode them after
+    releasing it.
+    """
+
+    __slots__ = ("users", "_senders", "_times", "_bodies", "_offsets")
+
+    def __init__(self, users: UserTable) -> None:
+        self.users: UserTable = users
+        self._senders: array = array("I")
+        self._times: array = array("d")
+        self._bodies: bytearray = bytearray()
+        # Start of each body in `_bodies`, plus the end of the last one
+        self._offsets: array = array("Q", (0,))
+
+    def __len__(self) -> int:
+        return len(self._senders)
+
+    def __getitem__(self, index: int) -> Message:
+        sender, moment, body = self.record(index)
+        return sender, format_time(moment), body
+
+    def append(self, sender: str, moment: float, message: str) -> None:
+        """
+        Add a message. The body is written before the columns that index it,
+        so a concurrent reader never sees a message without its body.
+        """
+        self._bodies += message.encode("utf-8")
+        self._offsets.append(len(self._bodies))
+        self._times.append(moment)
+        self._senders.append(self.users.id(sender))
+
+    def record(self, index: int) -> Record:
+        return (
+            self.users.names[self._senders[index]],
+            self._times[index],
+            self._bodies[self._offsets[index] : self._offsets[index + 1]].decode("utf-8"),
+        )
+
+    def records(self, start: int = 0, stop: int | None = None) -> Iterator[Record]:
+        for index in range(start, len(self) if stop is None else stop):
+            yield self.record(index)
+
+    def messages(self, start: int = 0, stop: int | None = None) -> list[Message]:
+        """
+        Decode messages into the form sent to clients.
+
+        Args:
+            start: Index of the first message.
+            stop: Index after the last message, or None for the end of the log.
+
+        Returns:
+            The messages as (sender, timestamp, message) tuples.
+        """
+        names: list[str] = self.users.names
+        messages: list[Message] = []
+        # Consecutive messages are usually in the same minute
+        last_minute: float = -1.0
+        formatted: str = ""
+        for index in range(start, len(self) if stop is None else stop):
+            moment: float = self._times[index]
+            if moment // 60 != last_minute:
+                last_minute = moment // 60
+                formatted = format_time(moment)
+            messages.append(
+                (
+                    names[self._senders[index]],
+                    formatted,
+                    self._bodies[self._offsets[index] : self._offsets[index + 1]].decode(
+                        "utf-8"
+                    ),
+                )
+            )
+        return messages
+
+    def bodies(self, start: int = 0, stop: int | None = None) -> list[str]:
+        return [
+            self._bodies[self._offsets[index] : self._offsets[index + 1]].decode("utf-8")
+            for index in range(start, len(self) if stop is None else stop)
+        ]
+
+    def times(self) -> array:
+        return self._times
+
+    def slice(self, start: int, stop: int | None = None) -> "ConversationLog":
+        """Copy the messages from `start` to `stop` into a new log."""
+        stop = len(self) if stop is None else stop
+        log: ConversationLog = ConversationLog(self.users)
+        log.extend(self, start, stop)
+        return log
+
+    def extend(self, other: "ConversationLog", start: int, stop: int) -> None:
+        """Append messages `start` to `stop` of another log sharing this log's users."""
+        if start >= stop:
+            return
+        first: int = other._offsets[start]
+        shift: int = len(self._bodies) - first
+        self._bodies += other._bodies[first : other._offsets[stop]]
+        self._offsets.extend(offset + shift for offset in other._offsets[start + 1 : stop + 1])
+        self._times.extend(other._times[start:stop])
+        self._senders.extend(other._senders[start:stop])
+
+    def dump(self, length: int) -> tuple[bytes, bytes, bytes, bytes]:
+        """Copy the first `length` messages' columns, for saving."""
+        return (
+            self._senders[:length].tobytes(),
+            self._times[:length].tobytes(),
+            bytes(self._bodies[: self._offsets[length]]),
+            self._offsets[: length + 1].tobytes(),
+        )
+
+    @classmethod
+    def load(
+        cls, users: UserTable, columns: tuple[bytes, bytes, bytes, bytes]
+    ) -> "ConversationLog":
+        log: ConversationLog = cls(users)
+        senders, times, bodies, offsets = columns
+        log._senders.frombytes(senders)
+        log._times.frombytes(times)
+        log._bodies += bodies
+        log._offsets = array("Q")
+        log._offsets.frombytes(offsets)
+        return log
+
+    @classmethod
+    def from_messages(cls, users: UserTable, messages: list[Message]) -> "ConversationLog":
+        """Convert messages saved in the older tuple format, whose timestamps have no year."""
+        log: ConversationLog = cls(users)
+        for (sender, _, body), moment in zip(
+            messages, message_times([timestamp for _, timestamp, _ in messages], time.time())
+        ):
+            log.append(sender, moment, body)
+        return log
+
+
+def format_time(moment: float) -> str:
+    return time.strftime(TIME_FORMAT, time.localtime(moment))
+
+
+def message_times(timestamps: list[str], now: float) -> list[float]:
+    """
+    Convert timestamps stored as "%m/%d %H:%M" without a year to epoch times.
+    Messages are in chronological order, so the year is found by walking back
+    from now and stepping back a year whenever a timestamp would come after
+    the message following it.
+
+    Args:
+        timestamps: The timestamps of a conversation's messages, oldest first.
+        now: The current epoch time.
+
+    Returns:
+        The epoch time of each message.
+    """
+    times: list[float] = [0.0] * len(timestamps)
+    year: int = datetime.fromtimestamp(now).year
+    later: float = now + 24 * 60 * 60  # Allow for clock adjustments
+    for index in range(len(timestamps) - 1, -1, -1):
+        while True:
+            try:
+                moment: float = datetime.strptime(
+                    f"{year}/{timestamps[index]}", "%Y/" + TIME_FORMAT
+                ).timestamp()
+            except ValueError:
+                # February 29th in a non-leap year
+                year -= 1
+                continue
+            if moment <= later:
+                break
+            year -= 1
+        times[index] = later = moment
+    return times
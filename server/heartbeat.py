@@ -0,0 +1,133 @@
+import socket
+import threading
+import time
+import logging
+from typing import Any, Protocol
+from server.metrics import HEARTBEAT_PINGS_SENT, CONNECTIONS_REAPED, AUTH_TIMEOUTS
+
+logger = logging.getLogger(__name__)
+
+
+class MonitoredConnection(Protocol):
+    # time.monotonic() timestamp of the last frame received from the client
+    last_seen: float
+    # time.monotonic() timestamp from which the authentication deadline runs
+    connected_at: float
+    authed: bool
+
+    def deliver(self, data: dict[str, Any]) -> None: ...
+
+    def disconnect(self, reason: str) -> None: ...
+
+
+class HeartbeatMonitor:
+    """
+    Pings idle connections and reaps those that stop responding.
+
+    A connection that hasn't sent anything for `interval` seconds is sent a
+    `ping`, to which clients reply with a `pong` command. A connection that
+    hasn't sent anything for `timeout` seconds is disconnected, so half-open
+    connections from crashed clients don't hold threads and sockets forever.
+
+    A connection that hasn't logged in within `auth_timeout` seconds is also
+    disconnected, however active it is, so clients can't hold connections
+    open without an account.
+    """
+
+    def __init__(self, interval: float, timeout: float, auth_timeout: float = 0) -> None:
+        """
+        Args:
+            interval: Seconds of inactivity before a connection is pinged, or 0
+                to disable heartbeats.
+            timeout: Seconds of inactivity before a connection is reaped.
+            auth_timeout: Seconds a connection may stay unauthenticated, or 0
+                for no limit.
+        """
+        self.interval: float = interval
+        self.timeout: float = max(timeout, interval)
+        self.auth_timeout: float = auth_timeout
+        # Check often enough to honour the shorter of the enabled periods
+        self._period: float = min(
+            (period / 3 for period in (interval, auth_timeout) if period > 0),
+            default=0.0,
+        )
+        self._connections: dict[MonitoredConnection, float] = {}
+        self._lock: threading.Lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+
+    def __len__(self) -> int:
+        return len(self._connections)
+
+    def add(self, connection: MonitoredConnection) -> None:
+        with self._lock:
+            self._connections[connection] = 0.0
+            if self._thread is None and self._period > 0:
+                self._thread = threading.Thread(
+                    target=self._run, name="Heartbeat monitor", daemon=True
+                )
+                self._thread.start()
+
+    def remove(self, connection: MonitoredConnection) -> None:
+        with self._lock:
+            self._connections.pop(connection, None)
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self._period)
+            self.check()
+
+    def check(self) -> None:
+        """Ping idle connections and reap unresponsive or unauthenticated ones."""
+        now: float = time.monotonic()
+        with self._lock:
+            connections: list[tuple[MonitoredConnection, float]] = list(
+                self._connections.items()
+            )
+
+        for connection, last_ping in connections:
+            idle: float = now - connection.last_seen
+            if (
+                self.auth_timeout
+                and not connection.authed
+                and now - connection.connected_at >= self.auth_timeout
+            ):
+                AUTH_TIMEOUTS.inc()
+                self.remove(connection)
+                connection.disconnect(f"not logged in after {self.auth_timeout:.0f}s")
+            elif not self.interval:
+                continue
+            elif idle >= self.timeout:
+                CONNECTIONS_REAPED.inc()
+                self.remove(connection)
+                connection.disconnect(f"no response for {idle:.0f}s")
+            elif idle >= self.interval and last_ping < connection.last_seen:
+                # Only ping once per idle period
+                with self._lock:
+                    if connection in self._connections:
+                        self._connections[connection] = now
+                HEARTBEAT_PINGS_SENT.inc()
+                try:
+                    connection.deliver({"type": "ping"})
+                except Exception as e:
+                    logger.debug("Failed to ping connection: %s", e)
+
+
+def configure_keepalive(sock: socket.socket, idle: int) -> None:
+    """
+    Enable TCP keepalive so the kernel detects dead peers even if the
+    application is blocked.
+
+    Args:
+        sock: The connected socket.
+        idle: Seconds of inactivity before the first keepalive probe. Probes
+            are then sent every 10 seconds, and the connection is dropped
+            after 3 unanswered probes.
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # The tuning options are platform-specific
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+    if hasattr(socket, "TCP_KEEPINTVL"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
+    if hasattr(socket, "TCP_KEEPCNT"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
@@ -0,0 +1,523 @@
+import bisect
+import threading
+import time
+import logging
+import tracemalloc
+from urllib.parse import parse_qs, urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Iterator, Self
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets (in seconds) suitable for in-process work such as
+# encryption, lock waits, and disk writes
+DEFAULT_BUCKETS: tuple[float, ...] = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+)
+
+
+def _format_labels(labelnames: tuple[str, ...], labelvalues: tuple[str, ...]) -> str:
+    if not labelnames:
+        return ""
+    pairs = []
+    for name, value in zip(labelnames, labelvalues):
+        escaped = value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    """
+    Base class for metrics with an optional set of labels.
+
+    Calling `labels` with one value per label name returns a child metric
+    that tracks its own value. Children are created on first use and cached.
+    """
+
+    metric_type: str = "untyped"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: tuple[str, ...] = ()
+    ) -> None:
+        self.name: str = name
+        self.documentation: str = documentation
+        self.labelnames: tuple[str, ...] = labelnames
+        self._lock: threading.Lock = threading.Lock()
+        self._children: dict[tuple[str, ...], Self] = {}
+
+    def labels(self, *labelvalues: str) -> Self:
+        """
+        Get the child metric for a combination of label values.
+
+        Args:
+            labelvalues: One value for each label name, in order.
+
+        Returns:
+            The child metric.
+        """
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError(
+                f"Expected {len(self.labelnames)} label values for {self.name}"
+            )
+        child = self._children.get(labelvalues)
+        if child is None:
+            with self._lock:
+                child = self._children.get(labelvalues)
+                if child is None:
+                    child = self._new_child()
+                    self._children[labelvalues] = child
+        return child
+
+    def _new_child(self) -> Self:
+        return type(self)(self.name, self.documentation)
+
+    def _samples(self) -> Iterator[tuple[str, tuple[str, ...], tuple[str, ...], float]]:
+        """Yield (suffix, extra label names, extra label values, value) tuples."""
+        raise NotImplementedError
+
+    def collect(self) -> list[str]:
+        """
+        Render the metric in Prometheus text exposition format.
+
+        Returns:
+            A list of lines, including the HELP and TYPE headers.
+        """
+        lines: list[str] = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.metric_type}",
+        ]
+        children: list[tuple[tuple[str, ...], _Metric]]
+        if self.labelnames:
+            with self._lock:
+                children = sorted(self._children.items(), key=lambda item: item[0])
+        else:
+            children = [((), self)]
+        for labelvalues, child in children:
+            for suffix, extra_names, extra_values, value in child._samples():
+                labels = _format_labels(
+                    self.labelnames + extra_names, labelvalues + extra_values
+                )
+                lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    metric_type = "counter"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: tuple[str, ...] = ()
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._value: float = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self._value += amount
+
+    def _samples(self) -> Iterator[tuple[str, tuple[str, ...], tuple[str, ...], float]]:
+        yield "", (), (), self._value
+
+
+class Gauge(_Metric):
+    metric_type = "gauge"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: tuple[str, ...] = ()
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._value: float = 0.0
+        self._function: Callable[[], float] | None = None
+
+    def set(self, value: float) -> None:
+        with self._lock:
+            self._value = value
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self._value -= amount
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        """
+        Compute the gauge value by calling `function` at collection time.
+
+        Args:
+            function: A callable returning the current value.
+        """
+        self._function = function
+
+    def _samples(self) -> Iterator[tuple[str, tuple[str, ...], tuple[str, ...], float]]:
+        if self._function is not None:
+            try:
+                yield "", (), (), float(self._function())
+            except Exception as e:
+                logger.warning(f"Failed to collect gauge {self.name}: {e}")
+        else:
+            yield "", (), (), self._value
+
+
+class Histogram(_Metric):
+    metric_type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets: tuple[float, ...] = tuple(sorted(buckets))
+        self._counts: list[int] = [0] * (len(self.buckets) + 1)
+        self._sum: float = 0.0
+
+    def _new_child(self) -> Self:
+        return type(self)(self.name, self.documentation, buckets=self.buckets)
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        """
+        Observe the wall-clock duration of the enclosed block, in seconds.
+        """
+        start: float = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def _samples(self) -> Iterator[tuple[str, tuple[str, ...], tuple[str, ...], float]]:
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        cumulative: int = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            yield "_bucket", ("le",), (_format_value(bound),), cumulative
+        yield "_count", (), (), cumulative
+        yield "_sum", (), (), total
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._metrics: dict[str, _Metric] = {}
+        self._lock: threading.Lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(
+        self, name: str, documentation: str, labelnames: tuple[str, ...] = ()
+    ) -> Counter:
+        metric = Counter(name, documentation, labelnames)
+        self.register(metric)
+        return metric
+
+    def gauge(
+        self, name: str, documentation: str, labelnames: tuple[str, ...] = ()
+    ) -> Gauge:
+        metric = Gauge(name, documentation, labelnames)
+        self.register(metric)
+        return metric
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self.register(metric)
+        return metric
+
+    def render(self) -> str:
+        """
+        Render all registered metrics in Prometheus text exposition format.
+
+        Returns:
+            The exposition text, terminated by a newline.
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines: list[str] = []
+        for metric in metrics:
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+class TimedLock:
+    """
+    A `threading.Lock` drop-in that records how long callers wait to acquire it.
+    """
+
+    def __init__(self, wait_histogram: Histogram) -> None:
+        self._lock: threading.Lock = threading.Lock()
+        self._wait_histogram: Histogram = wait_histogram
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        start: float = time.perf_counter()
+        acquired = self._lock.acquire(blocking, timeout)
+        self._wait_histogram.observe(time.perf_counter() - start)
+        return acquired
+
+    def release(self) -> None:
+        self._lock.release()
+
+    def locked(self) -> bool:
+        return self._lock.locked()
+
+    def __enter__(self) -> bool:
+        return self.acquire()
+
+    def __exit__(self, *args: object) -> None:
+        self.release()
+
+
+# -- Server metrics --
+
+REGISTRY: MetricsRegistry = MetricsRegistry()
+
+FRAMES_RECEIVED: Counter = REGISTRY.counter(
+    "ncr_frames_received_total", "Frames received from clients", ("command",)
+)
+FRAMES_SENT: Counter = REGISTRY.counter(
+    "ncr_frames_sent_total", "Frames sent to clients", ("type",)
+)
+BYTES_RECEIVED: Counter = REGISTRY.counter(
+    "ncr_bytes_received_total", "Frame bytes received from clients", ("command",)
+)
+BYTES_SENT: Counter = REGISTRY.counter(
+    "ncr_bytes_sent_total", "Frame bytes sent to clients", ("type",)
+)
+ENCRYPT_SECONDS: Histogram = REGISTRY.histogram(
+    "ncr_encrypt_seconds", "Time spent serializing and encrypting outbound frames"
+)
+DECRYPT_SECONDS: Histogram = REGISTRY.histogram(
+    "ncr_decrypt_seconds", "Time spent decrypting and parsing inbound frames"
+)
+HISTORY_PERSIST_SECONDS: Histogram = REGISTRY.histogram(
+    "ncr_history_persist_seconds", "Time spent writing chat history to disk"
+)
+LOCK_WAIT_SECONDS: Histogram = REGISTRY.histogram(
+    "ncr_lock_wait_seconds", "Time spent waiting to acquire shared locks", ("lock",)
+)
+REQUEST_STAGE_SECONDS: Histogram = REGISTRY.histogram(
+    "ncr_request_stage_seconds",
+    "Time spent in each stage of handling a request (only when tracing is enabled)",
+    ("command", "stage"),
+)
+OUTBOUND_QUEUE_FRAMES: Gauge = REGISTRY.gauge(
+    "ncr_outbound_queue_frames", "Frames queued for sending across all connections"
+)
+OUTBOUND_QUEUE_BYTES: Gauge = REGISTRY.gauge(
+    "ncr_outbound_queue_bytes", "Bytes queued for sending across all connections"
+)
+SLOW_CONSUMERS: Gauge = REGISTRY.gauge(
+    "ncr_slow_consumers", "Connections currently flagged as slow consumers"
+)
+SLOW_CONSUMERS_FLAGGED: Counter = REGISTRY.counter(
+    "ncr_slow_consumers_flagged_total", "Times a connection was flagged as slow"
+)
+SLOW_CONSUMERS_EVICTED: Counter = REGISTRY.counter(
+    "ncr_slow_consumers_evicted_total", "Connections dropped for falling behind"
+)
+HEARTBEAT_PINGS_SENT: Counter = REGISTRY.counter(
+    "ncr_heartbeat_pings_sent_total", "Pings sent to idle connections"
+)
+CONNECTIONS_REAPED: Counter = REGISTRY.counter(
+    "ncr_connections_reaped_total", "Connections dropped for not responding to pings"
+)
+OPEN_CONNECTIONS: Gauge = REGISTRY.gauge(
+    "ncr_open_connections", "Number of open connections, authenticated or not"
+)
+OFFLINE_MESSAGES_QUEUED: Counter = REGISTRY.counter(
+    "ncr_offline_messages_queued_total", "Private messages queued for offline users"
+)
+OFFLINE_MESSAGES_DROPPED: Counter = REGISTRY.counter(
+    "ncr_offline_messages_dropped_total",
+    "Private messages dropped because the recipient's offline inbox was full",
+)
+CONNECTED_CLIENTS: Gauge = REGISTRY.gauge(
+    "ncr_connected_clients", "Number of authenticated clients currently connected"
+)
+CLUSTER_MESSAGES_SENT: Counter = REGISTRY.counter(
+    "ncr_cluster_messages_sent_total",
+    "Messages sent to other cluster nodes, by kind",
+    ("kind",),
+)
+CLUSTER_MESSAGES_RECEIVED: Counter = REGISTRY.counter(
+    "ncr_cluster_messages_received_total",
+    "Messages received from other cluster nodes, by kind",
+    ("kind",),
+)
+PASSWORD_HASH_SECONDS: Histogram = REGISTRY.histogram(
+    "ncr_password_hash_seconds",
+    "Time spent deriving password hashes, by operation (hash or verify)",
+    ("operation",),
+)
+PASSWORD_HASH_QUEUE: Gauge = REGISTRY.gauge(
+    "ncr_password_hash_queue", "Password hashes queued or running on the worker pool"
+)
+LOGIN_VALIDATIONS: Counter = REGISTRY.counter(
+    "ncr_login_validations_total",
+    "Credential checks, by result (ok, fail, cached or busy)",
+    ("result",),
+)
+HISTORY_MESSAGES_ARCHIVED: Counter = REGISTRY.counter(
+    "ncr_history_messages_archived_total",
+    "Messages moved from the chat history to compressed archives",
+)
+HISTORY_COMPACTION_SECONDS: Histogram = REGISTRY.histogram(
+    "ncr_history_compaction_seconds", "Time spent applying history retention policies"
+)
+REMOTE_USERS: Gauge = REGISTRY.gauge(
+    "ncr_cluster_remote_users", "Number of users connected to other cluster nodes"
+)
+LOG_QUEUE_RECORDS: Gauge = REGISTRY.gauge(
+    "ncr_log_queue_records", "Log records waiting to be written to the console"
+)
+LOG_RECORDS_DROPPED: Counter = REGISTRY.counter(
+    "ncr_log_records_dropped_total",
+    "Log records dropped because the log queue was full",
+)
+CONNECTIONS_REJECTED: Counter = REGISTRY.counter(
+    "ncr_connections_rejected_total",
+    "Connections refused by admission control, by reason (server_full or ip_limit)",
+    ("reason",),
+)
+AUTH_TIMEOUTS: Counter = REGISTRY.counter(
+    "ncr_auth_timeouts_total", "Connections dropped for not logging in in time"
+)
+THROTTLED_COMMANDS: Counter = REGISTRY.counter(
+    "ncr_throttled_commands_total",
+    "Commands rejected by rate limits, by command and limit (user or command)",
+    ("command", "limit"),
+)
+RATE_LIMITED_USERS: Gauge = REGISTRY.gauge(
+    "ncr_rate_limited_users", "Users whose rate limit buckets are being tracked"
+)
+TRACED_MEMORY: Gauge = REGISTRY.gauge(
+    "ncr_traced_memory_bytes",
+    "Memory allocated by Python code, when running with tracemalloc enabled",
+)
+TRAFFIC_RECORDED: Counter = REGISTRY.counter(
+    "ncr_traffic_records_total", "Frames and connection events queued for the traffic recording"
+)
+TRAFFIC_DROPPED: Counter = REGISTRY.counter(
+    "ncr_traffic_records_dropped_total",
+    "Traffic records dropped because the recorder fell behind",
+)
+
+
+TRACED_MEMORY.set_function(lambda: tracemalloc.get_traced_memory()[0])
+
+
+# -- HTTP exposition --
+
+
+def render_allocations(limit: int) -> str:
+    """
+    Summarize the memory currently allocated by Python code, when the process
+    runs with tracemalloc enabled (such as with PYTHONTRACEMALLOC=1).
+
+    Args:
+        limit: Number of source lines to list.
+
+    Returns:
+        A "total <bytes> <blocks>" line followed by "<bytes> <blocks> <file>:<line>"
+        lines for the source lines holding the most memory, largest first.
+    """
+    snapshot: tracemalloc.Snapshot = tracemalloc.take_snapshot().filter_traces(
+        (tracemalloc.Filter(False, tracemalloc.__file__),)
+    )
+    stats: list[tracemalloc.Statistic] = snapshot.statistics("lineno")
+    lines: list[str] = [
+        f"total {sum(stat.size for stat in stats)} {sum(stat.count for stat in stats)}"
+    ]
+    for stat in stats[:limit]:
+        frame: tracemalloc.Frame = stat.traceback[0]
+        lines.append(f"{stat.size} {stat.count} {frame.filename}:{frame.lineno}")
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        if url.path == "/allocations":
+            if not tracemalloc.is_tracing():
+                self.send_error(404, "tracemalloc is not enabled")
+                return
+            try:
+                limit: int = int(parse_qs(url.query).get("limit", ["25"])[0])
+            except ValueError:
+                limit = -1
+            if limit < 0:
+                self.send_error(400, "limit must be a non-negative integer")
+                return
+            body: bytes = render_allocations(limit).encode("utf-8")
+        elif url.path in ("/", "/metrics"):
+            body = REGISTRY.render().encode("utf-8")
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: object) -> None:
+        logger.debug(f"Metrics request from {self.client_address}: {format % args}")
+
+
+def start_metrics_server(host: str, port: int) -> ThreadingHTTPServer:
+    """
+    Serve the metrics registry over HTTP from a daemon thread.
+
+    Args:
+        host: The interface to bind to; keep this on localhost in production.
+        port: The port to listen on.
+
+    Returns:
+        The running HTTP server.
+    """
+    httpd = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    httpd.daemon_threads = True
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    logger.info(f"Metrics available at http://{host}:{port}/metrics")
+    return httpd
@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import deque
+from pathlib import Path
+from server.metrics import OFFLINE_MESSAGES_QUEUED, OFFLINE_MESSAGES_DROPPED
+
+logger = logging.getLogger(__name__)
+
+# An offline message: (sender, epoch timestamp, message)
+OfflineMessage = tuple[str, float, str]
+
+
+class OfflineInbox:
+    """
+    Holds private messages for users who are not connected until they next log in.
+
+    The first `memory_limit` messages for a recipient are kept in memory; any
+    further messages spill over to a JSON-lines file per recipient, so a
+    long-offline user can't exhaust the server's memory. Each recipient's
+    inbox is capped at `max_messages`, and messages older than `ttl` seconds
+    are discarded.
+    """
+
+    def __init__(
+        self, directory: Path, max_messages: int, ttl: float, memory_limit: int
+    ) -> None:
+        """
+        Args:
+            directory: Directory for spilled-over messages.
+            max_messages: Maximum messages held per recipient; further messages
+                are dropped until the recipient collects their inbox.
+            ttl: Seconds after which undelivered messages expire.
+            memory_limit: Messages per recipient to keep in memory before
+                spilling to disk.
+        """
+        self.directory: Path = directory
+        self.directory.mkdir(exist_ok=True)
+        self.max_messages: int = max_messages
+        self.ttl: float = ttl
+        self.memory_limit: int = memory_limit
+
+        self.lock: threading.Lock = threading.Lock()
+        self._memory: dict[str, deque[OfflineMessage]] = {}
+        self._spilled: dict[str, int] = self._count_spilled()
+
+    def _spill_path(self, recipient: str) -> Path:
+        # Hash usernames so that they are always safe to use as file names
+        digest: str = hashlib.sha256(recipient.encode("utf-8")).hexdigest()
+        return self.directory / f"{digest}.jsonl"
+
+    def _count_spilled(self) -> dict[str, int]:
+        """Count messages spilled to disk before the last restart."""
+        counts: dict[str, int] = {}
+        for path in self.directory.glob("*.jsonl"):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    lines: list[str] = f.readlines()
+                recipient: str = json.loads(lines[0])["recipient"] if lines else ""
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"Failed to read offline inbox {path.name}: {e}")
+                continue
+            if recipient:
+                counts[recipient] = len(lines)
+        return counts
+
+    def add(self, recipient: str, sender: str, message: str) -> bool:
+        """
+        Queue a message for a recipient who is offline.
+
+        Args:
+            recipient: The username of the offline recipient.
+            sender: The username of the sender.
+            message: The message content.
+
+        Returns:
+            True if the message was queued, False if the recipient's inbox is full.
+        """
+        entry: OfflineMessage = (sender, time.time(), message)
+        with self.lock:
+            queued: bool = self._append(recipient, entry)
+        if queued:
+            OFFLINE_MESSAGES_QUEUED.inc()
+        return queued
+
+    def drain(self, recipient: str) -> list[OfflineMessage]:
+        """
+        Remove and return all unexpired messages waiting for a recipient.
+
+        Args:
+            recipient: The username of the recipient.
+
+        Returns:
+            The recipient's messages, oldest first.
+        """
+        with self.lock:
+            messages: list[OfflineMessage] = self._take(recipient)
+
+        cutoff: float = time.time() - self.ttl
+        return [message for message in messages if message[1] >= cutoff]
+
+    def restore(self, recipient: str, messages: list[OfflineMessage]) -> None:
+        """
+        Put drained messages back, ahead of any that have arrived since, when
+        they couldn't be delivered after all.
+
+        Args:
+            recipient: The username of the recipient.
+            messages: The messages returned by `drain`, oldest first.
+        """
+        with self.lock:
+            newer: list[OfflineMessage] = self._take(recipient)
+            for entry in [*messages, *newer]:
+                self._append(recipient, entry)
+
+    def _append(self, recipient: str, entry: OfflineMessage) -> bool:
+        # Must be called with the lock held
+        memory: deque[OfflineMessage] = self._memory.setdefault(recipient, deque())
+        self._expire(memory)
+        spilled: int = self._spilled.get(recipient, 0)
+
+        if len(memory) + spilled >= self.max_messages:
+            OFFLINE_MESSAGES_DROPPED.inc()
+            logger.warning(f"Offline inbox for {recipient} is full; message dropped")
+            return False
+
+        if len(memory) < self.memory_limit and not spilled:
+            memory.append(entry)
+        else:
+            # Keep delivery order by spilling everything after the in-memory batch
+            with open(self._spill_path(recipient), "a", encoding="utf-8") as f:
+                f.write(
+                    json.dumps(
+                        {
+                            "recipient": recipient,
+                            "sender": entry[0],
+                            "time": entry[1],
+                            "message": entry[2],
+                        }
+                    )
+                    + "\n"
+                )
+            self._spilled[recipient] = spilled + 1
+        return True
+
+    def _take(self, recipient: str) -> list[OfflineMessage]:
+        # Must be called with the lock held
+        messages: list[OfflineMessage] = list(self._memory.pop(recipient, ()))
+        if self._spilled.pop(recipient, 0):
+            path: Path = self._spill_path(recipient)
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        record = json.loads(line)
+                        messages.append(
+                            (record["sender"], record["time"], record["message"])
+                        )
+                os.remove(path)
+            except (OSError, ValueError, KeyError) as e:
+                logger.error(f"Failed to read offline inbox for {recipient}: {e}")
+        return messages
+
+    def _expire(self, memory: deque[OfflineMessage]) -> None:
+        cutoff: float = time.time() - self.ttl
+        while memory and memory[0][1] < cutoff:
+            memory.popleft()
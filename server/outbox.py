@@ -0,0 +1,371 @@
+import queue
+import socket
+import selectors
+import threading
+import time
+import logging
+from collections import deque
+from server.metrics import (
+    OUTBOUND_QUEUE_BYTES,
+    OUTBOUND_QUEUE_FRAMES,
+    SLOW_CONSUMERS,
+    SLOW_CONSUMERS_FLAGGED,
+    SLOW_CONSUMERS_EVICTED,
+)
+
+logger = logging.getLogger(__name__)
+
+# Most bytes of queued frames coalesced into one write
+WRITE_BATCH_BYTES: int = 64 * 1024
+
+
+class Outbox:
+    """
+    Queue of encoded frames for one connection.
+
+    The socket is switched to non-blocking mode, so writes never block:
+    `put` writes what the socket will take straight away, and whatever is
+    left is queued and written by the process's `OutboxWriter` thread once
+    the socket has room. A client that stops reading therefore only fills
+    its own queue, and an idle connection costs no thread of its own.
+    Queued frames are coalesced into larger writes.
+
+    A connection is flagged as a slow consumer when its queue passes half of
+    `max_bytes` or its writes have been blocked for half of `send_timeout`,
+    and is evicted (its socket shut down) when either limit is reached.
+    """
+
+    __slots__ = (
+        "sock",
+        "name",
+        "max_bytes",
+        "send_timeout",
+        "writer",
+        "_frames",
+        "_offset",
+        "_queued_frames",
+        "_queued_bytes",
+        "_send_started",
+        "_closed",
+        "_slow",
+        "_lock",
+    )
+
+    def __init__(
+        self,
+        sock: socket.socket,
+        name: str,
+        max_bytes: int,
+        send_timeout: float,
+        writer: "OutboxWriter | None" = None,
+    ) -> None:
+        """
+        Args:
+            sock: The connected socket to write to. Whoever reads from it
+                must cope with it being non-blocking, as the receive
+                functions in `utils.encryption` do.
+            name: A description of the peer for log messages.
+            max_bytes: Maximum bytes queued before the connection is evicted.
+            send_timeout: Maximum seconds a write may stay blocked before the
+                connection is evicted.
+            writer: The writer that finishes blocked writes; defaults to the
+                one shared by the whole process.
+        """
+        self.sock: socket.socket = sock
+        self.name: str = name
+        self.max_bytes: int = max_bytes
+        self.send_timeout: float = send_timeout
+        # Not `writer or ...`: a writer watching nothing has a length of 0
+        self.writer: OutboxWriter = writer if writer is not None else shared_writer()
+
+        self._frames: deque[bytes] = deque()
+        # Bytes of the first queued frame already written
+        self._offset: int = 0
+        self._queued_frames: int = 0
+        self._queued_bytes: int = 0
+        self._send_started: float = 0.0
+        self._closed: bool = False
+        self._slow: bool = False
+        self._lock: threading.RLock = threading.RLock()
+
+        sock.setblocking(False)
+
+    @property
+    def queued_bytes(self) -> int:
+        return self._queued_bytes
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def put(self, frame: bytes) -> bool:
+        """
+        Send a frame, or queue it if the socket can't take it yet, without
+        blocking.
+
+        Args:
+            frame: The encoded frame.
+
+        Returns:
+            True if the frame was sent or queued, False if the outbox is
+            closed or the connection was evicted for falling too far behind.
+        """
+        with self._lock:
+            if self._closed:
+                return False
+            self._frames.append(frame)
+            self._queued_frames += 1
+            self._queued_bytes += len(frame)
+            OUTBOUND_QUEUE_FRAMES.inc()
+            OUTBOUND_QUEUE_BYTES.inc(len(frame))
+            if len(self._frames) == 1 and not self._flush():
+                # The socket is full; the writer finishes once it drains
+                self.writer.watch(self)
+        return self.check()
+
+    def check(self) -> bool:
+        """
+        Flag or evict the connection if it is not keeping up.
+
+        Returns:
+            False if the connection has been evicted or closed, True otherwise.
+        """
+        with self._lock:
+            if self._closed:
+                return False
+            stalled_for: float = (
+                time.monotonic() - self._send_started if self._send_started else 0.0
+            )
+            if self._queued_bytes > self.max_bytes or stalled_for > self.send_timeout:
+                self.evict(
+                    f"{self._queued_bytes} bytes queued, "
+                    f"write blocked for {stalled_for:.1f}s"
+                )
+                return False
+            self._set_slow(
+                self._queued_bytes > self.max_bytes // 2
+                or stalled_for > self.send_timeout / 2
+            )
+            return True
+
+    def evict(self, reason: str) -> None:
+        """
+        Drop a slow connection by shutting down its socket.
+
+        The handler's receive loop then fails and runs its normal cleanup,
+        which notifies other users that the peer has left.
+
+        Args:
+            reason: Why the connection is being dropped, for the log.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            logger.warning(f"Evicting slow consumer {self.name}: {reason}")
+            SLOW_CONSUMERS_EVICTED.inc()
+            self.close()
+            self._shutdown()
+
+    def close(self) -> None:
+        """Stop sending and discard any frames not yet sent."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            OUTBOUND_QUEUE_FRAMES.dec(self._queued_frames)
+            OUTBOUND_QUEUE_BYTES.dec(self._queued_bytes)
+            self._frames.clear()
+            self._queued_frames = 0
+            self._queued_bytes = 0
+            self._set_slow(False)
+            if self._send_started:
+                # Stop watching the socket before its owner closes it
+                self.writer.forget(self)
+
+    def write_ready(self) -> bool:
+        """
+        Write queued frames now that the socket has room. Called by the
+        writer.
+
+        Returns:
+            True if frames are still waiting for room in the socket.
+        """
+        with self._lock:
+            return not self._closed and not self._flush()
+
+    def _flush(self) -> bool:
+        """
+        Write queued frames until the socket is full. Must be called with the
+        lock held.
+
+        Returns:
+            True if everything was written (or the write failed and the
+            connection was closed), False if frames are still queued.
+        """
+        while self._frames:
+            batch: list[bytes] = []
+            size: int = 0
+            for frame in self._frames:
+                batch.append(frame)
+                size += len(frame)
+                if size >= WRITE_BATCH_BYTES:
+                    break
+            data: bytes = batch[0] if len(batch) == 1 else b"".join(batch)
+            try:
+                sent: int = self.sock.send(memoryview(data)[self._offset :])
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError as e:
+                logger.debug("Write to %s failed: %s", self.name, e)
+                # Part of a frame may already be on the wire, so nothing more
+                # can be sent; end the connection so the handler cleans up
+                self.close()
+                self._shutdown()
+                return True
+
+            self._offset += sent
+            # The socket took less than offered if it is full
+            full: bool = self._offset < len(data)
+            while self._frames and self._offset >= len(self._frames[0]):
+                frame = self._frames.popleft()
+                self._offset -= len(frame)
+                self._queued_frames -= 1
+                self._queued_bytes -= len(frame)
+                OUTBOUND_QUEUE_FRAMES.dec()
+                OUTBOUND_QUEUE_BYTES.dec(len(frame))
+            if full:
+                if not self._send_started:
+                    self._send_started = time.monotonic()
+                return False
+        self._send_started = 0.0
+        return True
+
+    def _shutdown(self) -> None:
+        # Wakes the handler's receive loop, which then runs its cleanup
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _set_slow(self, slow: bool) -> None:
+        # Must be called with the lock held
+        if slow == self._slow:
+            return
+        self._slow = slow
+        if slow:
+            logger.warning(f"Slow consumer detected: {self.name}")
+            SLOW_CONSUMERS_FLAGGED.inc()
+            SLOW_CONSUMERS.inc()
+        else:
+            SLOW_CONSUMERS.dec()
+
+
+class OutboxWriter:
+    """
+    A single thread that finishes the writes of every outbox whose socket
+    was full, waiting on all of their sockets at once with a selector, and
+    checks the blocked outboxes for stalls once a second.
+
+    Only the writer's thread touches the selector; other threads hand it
+    outboxes to watch or forget through a queue, and wake it with a byte on
+    a socket pair.
+    """
+
+    def __init__(self, check_interval: float = 1.0) -> None:
+        """
+        Args:
+            check_interval: Seconds between stall checks of blocked outboxes.
+        """
+        self.check_interval: float = check_interval
+        self._selector: selectors.BaseSelector = selectors.DefaultSelector()
+        self._requests: queue.SimpleQueue[tuple[bool, Outbox]] = queue.SimpleQueue()
+        self._wake_reader, self._wake_writer = socket.socketpair()
+        self._wake_reader.setblocking(False)
+        self._wake_writer.setblocking(False)
+        self._selector.register(self._wake_reader, selectors.EVENT_READ)
+        self._thread: threading.Thread = threading.Thread(
+            target=self._run, name="Outbox writer", daemon=True
+        )
+        self._thread.start()
+
+    def __len__(self) -> int:
+        # The wake-up socket is registered too
+        return len(self._selector.get_map()) - 1
+
+    def watch(self, outbox: Outbox) -> None:
+        """Write the outbox's queued frames when its socket has room."""
+        self._request(True, outbox)
+
+    def forget(self, outbox: Outbox) -> None:
+        """Stop watching a closed outbox's socket."""
+        self._request(False, outbox)
+
+    def _request(self, watch: bool, outbox: Outbox) -> None:
+        self._requests.put((watch, outbox))
+        try:
+            self._wake_writer.send(b"\0")
+        except BlockingIOError:
+            # The writer already has a wake-up pending
+            pass
+
+    def _run(self) -> None:
+        last_check: float = time.monotonic()
+        while True:
+            for key, _ in self._selector.select(self.check_interval):
+                if key.fileobj is self._wake_reader:
+                    try:
+                        while self._wake_reader.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                outbox: Outbox = key.data
+                if not outbox.write_ready():
+                    self._unregister(outbox)
+
+            # Requests are applied in order, so a closed outbox is forgotten
+            # before a new connection reusing its file descriptor is watched
+            while True:
+                try:
+                    watch, outbox = self._requests.get_nowait()
+                except queue.Empty:
+                    break
+                if not watch:
+                    self._unregister(outbox)
+                elif not outbox.closed:
+                    try:
+                        self._selector.register(outbox.sock, selectors.EVENT_WRITE, outbox)
+                    except (KeyError, ValueError, OSError):
+                        # Already watched, or the socket was closed meanwhile
+                        pass
+
+            now: float = time.monotonic()
+            if now - last_check >= self.check_interval:
+                last_check = now
+                # Catch writes that stall when nobody is sending to the connection
+                for key in list(self._selector.get_map().values()):
+                    if key.fileobj is not self._wake_reader:
+                        key.data.check()
+
+    def _unregister(self, outbox: Outbox) -> None:
+        try:
+            # Works even if the socket has since been closed
+            key: selectors.SelectorKey = self._selector.unregister(outbox.sock)
+        except (KeyError, ValueError):
+            return
+        if key.data is not outbox:
+            # The file descriptor belongs to another outbox's socket now
+            self._selector.register(key.fileobj, key.events, key.data)
+
+
+_shared_writer: OutboxWriter | None = None
+_shared_writer_lock: threading.Lock = threading.Lock()
+
+
+def shared_writer() -> OutboxWriter:
+    """Get the writer shared by every outbox in the process, starting it if necessary."""
+    global _shared_writer
+    with _shared_writer_lock:
+        if _shared_writer is None:
+            _shared_writer = OutboxWriter()
+        return _shared_writer
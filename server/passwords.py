@@ -0,0 +1,162 @@
+import os
+import time
+import hmac
+import base64
+import hashlib
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, TypeVar
+from server.metrics import PASSWORD_HASH_SECONDS, PASSWORD_HASH_QUEUE
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Prefix identifying hashed password records; anything else is a legacy plaintext password
+ALGORITHM: str = "pbkdf2_sha256"
+
+
+class HasherBusyError(Exception):
+    """Raised when too many password hashes are already waiting for a worker."""
+
+
+class PasswordHasher:
+    """
+    Hashes and verifies passwords with salted PBKDF2-SHA256 on a bounded pool
+    of worker threads.
+
+    hashlib releases the GIL while deriving keys, so the workers run in
+    parallel without holding up other threads. At most `workers` hashes run at
+    once, so a burst of logins can't starve the rest of the server of CPU,
+    and at most `max_pending` may wait for a worker, so the wait is bounded
+    and excess requests fail fast instead.
+
+    Hashes are stored as "pbkdf2_sha256$<iterations>$<salt>$<hash>", with the
+    salt and hash base64-encoded.
+    """
+
+    def __init__(self, iterations: int, workers: int, max_pending: int) -> None:
+        """
+        Args:
+            iterations: PBKDF2 iterations for new hashes.
+            workers: Maximum number of hashes computed at once.
+            max_pending: Maximum number of hashes queued or running.
+        """
+        self.iterations: int = iterations
+        self.max_pending: int = max_pending
+        self._executor: ThreadPoolExecutor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="Password hasher"
+        )
+        self._pending: int = 0
+        self._lock: threading.Lock = threading.Lock()
+
+    def hash(self, password: str) -> str:
+        """
+        Hash a password with a new random salt.
+
+        Args:
+            password: The plaintext password.
+
+        Returns:
+            The encoded hash record.
+
+        Raises:
+            HasherBusyError: If too many hashes are already pending.
+        """
+        return self._run("hash", self._new_record, password)
+
+    def hash_many(self, passwords: list[str]) -> list[str]:
+        """
+        Hash many passwords in parallel across all workers, for bulk
+        provisioning. Not subject to the pending limit.
+
+        Args:
+            passwords: The plaintext passwords.
+
+        Returns:
+            The encoded hash records, in the same order.
+        """
+        PASSWORD_HASH_QUEUE.inc(len(passwords))
+        try:
+            return list(
+                self._executor.map(
+                    lambda password: self._timed("hash", self._new_record, password),
+                    passwords,
+                )
+            )
+        finally:
+            PASSWORD_HASH_QUEUE.dec(len(passwords))
+
+    def _new_record(self, password: str) -> str:
+        salt: bytes = os.urandom(16)
+        digest: bytes = self._derive(password, salt, self.iterations)
+        return "$".join(
+            (
+                ALGORITHM,
+                str(self.iterations),
+                base64.b64encode(salt).decode("ascii"),
+                base64.b64encode(digest).decode("ascii"),
+            )
+        )
+
+    def verify(self, password: str, record: str) -> bool:
+        """
+        Check a password against a stored hash record, or against a legacy
+        plaintext password.
+
+        Args:
+            password: The plaintext password to check.
+            record: The stored record.
+
+        Returns:
+            True if the password matches, False otherwise.
+
+        Raises:
+            HasherBusyError: If too many hashes are already pending.
+        """
+        if not is_hashed(record):
+            return hmac.compare_digest(password.encode("utf-8"), record.encode("utf-8"))
+        try:
+            _, iterations, salt, expected = record.split("$")
+            digest: bytes = self._run(
+                "verify", self._derive, password, base64.b64decode(salt), int(iterations)
+            )
+        except ValueError as e:
+            logger.error(f"Malformed password record: {e}")
+            return False
+        return hmac.compare_digest(digest, base64.b64decode(expected))
+
+    def needs_rehash(self, record: str) -> bool:
+        """Check whether a record is plaintext or uses outdated parameters."""
+        return not is_hashed(record) or record.split("$")[1] != str(self.iterations)
+
+    @staticmethod
+    def _derive(password: str, salt: bytes, iterations: int) -> bytes:
+        return hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations)
+
+    def _run(self, operation: str, function: Callable[..., T], *args: object) -> T:
+        """Run a hashing function on the pool and wait for its result."""
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise HasherBusyError(f"{self._pending} password hashes pending")
+            self._pending += 1
+        PASSWORD_HASH_QUEUE.inc()
+        try:
+            return self._executor.submit(self._timed, operation, function, *args).result()
+        finally:
+            with self._lock:
+                self._pending -= 1
+            PASSWORD_HASH_QUEUE.dec()
+
+    @staticmethod
+    def _timed(operation: str, function: Callable[..., T], *args: object) -> T:
+        start: float = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            PASSWORD_HASH_SECONDS.labels(operation).observe(time.perf_counter() - start)
+
+
+def is_hashed(record: str) -> bool:
+    return record.startswith(ALGORITHM + "$")
@@ -0,0 +1,206 @@
+import time
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# A limit: (tokens added per second, bucket size)
+Limit = tuple[float, float]
+
+
+class TokenBucket:
+    """
+    Allows bursts of up to `burst` commands, refilled at `rate` per second.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float, now: float) -> None:
+        self.rate: float = rate
+        self.burst: float = burst
+        self.tokens: float = burst
+        self.updated: float = now
+
+    def take(self, now: float) -> float:
+        """
+        Take a token if one is available.
+
+        Args:
+            now: The current time.monotonic() time.
+
+        Returns:
+            0 if a token was taken, or else the seconds until one is available.
+        """
+        # A caller that read the clock before another took a token may be
+        # slightly behind it
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def full(self, now: float) -> bool:
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class _UserBuckets:
+    __slots__ = ("total", "commands", "lock")
+
+    def __init__(self, total: TokenBucket | None) -> None:
+        self.total: TokenBucket | None = total
+        self.commands: dict[str, TokenBucket] = {}
+        # Held across refilling and taking from the buckets, since a user's
+        # connections may send commands at the same time
+        self.lock: threading.Lock = threading.Lock()
+
+
+class RateLimiter:
+    """
+    Per-user token buckets: one for all of a user's commands, and one for
+    each command with its own limit, such as expensive history searches.
+
+    Buckets are kept per username rather than per connection, so a user
+    gets the same share of the server however many connections they open,
+    and reconnecting doesn't refill their buckets. A user's buckets are
+    forgotten once they have refilled after the user disconnects.
+    """
+
+    def __init__(
+        self,
+        user_limit: Limit | None,
+        command_limits: dict[str, Limit],
+        sweep_interval: float = 60,
+    ) -> None:
+        """
+        Args:
+            user_limit: Limit on all of a user's commands together, or None
+                for no overall limit.
+            command_limits: Limits on individual commands, by command.
+            sweep_interval: Minimum seconds between sweeps of the buckets of
+                users who have disconnected.
+        """
+        self.user_limit: Limit | None = user_limit
+        self.command_limits: dict[str, Limit] = command_limits
+        self.sweep_interval: float = sweep_interval
+        self._users: dict[str, _UserBuckets] = {}
+        self._connected: dict[str, int] = {}
+        self._lock: threading.Lock = threading.Lock()
+        self._last_sweep: float = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    @property
+    def enabled(self) -> bool:
+        return self.user_limit is not None or bool(self.command_limits)
+
+    def check(self, username: str, command: str) -> tuple[float, str]:
+        """
+        Take a token for a command from the user's buckets.
+
+        Args:
+            username: The user sending the command.
+            command: The command being sent.
+
+        Returns:
+            (0, "") if the command may run, or else the seconds until it may
+            be retried and which limit was reached ("user" or "command").
+        """
+        now: float = time.monotonic()
+        buckets: _UserBuckets | None = self._users.get(username)
+        if buckets is None:
+            with self._lock:
+                buckets = self._users.get(username)
+                if buckets is None:
+                    buckets = _UserBuckets(
+                        TokenBucket(*self.user_limit, now) if self.user_limit else None
+                    )
+                    self._users[username] = buckets
+
+        with buckets.lock:
+            command_bucket: TokenBucket | None = None
+            limit: Limit | None = self.command_limits.get(command)
+            if limit:
+                command_bucket = buckets.commands.get(command)
+                if command_bucket is None:
+                    command_bucket = buckets.commands[command] = TokenBucket(*limit, now)
+                retry_after: float = command_bucket.take(now)
+                if retry_after:
+                    return retry_after, "command"
+            if buckets.total:
+                retry_after = buckets.total.take(now)
+                if retry_after:
+                    # Give back the command's token, which wasn't used after all
+                    if command_bucket:
+                        command_bucket.tokens += 1
+                    return retry_after, "user"
+            return 0.0, ""
+
+    def connected(self, username: str) -> None:
+        with self._lock:
+            self._connected[username] = self._connected.get(username, 0) + 1
+
+    def disconnected(self, username: str) -> None:
+        """
+        Note that a user disconnected, and forget the buckets of
+        disconnected users that have since refilled.
+        """
+        now: float = time.monotonic()
+        with self._lock:
+            remaining: int = self._connected.get(username, 1) - 1
+            if remaining:
+                self._connected[username] = remaining
+            else:
+                self._connected.pop(username, None)
+            if now - self._last_sweep < self.sweep_interval:
+                return
+            self._last_sweep = now
+            idle: list[str] = [
+                name
+                for name, buckets in self._users.items()
+                if name not in self._connected
+                and (buckets.total is None or buckets.total.full(now))
+                and all(bucket.full(now) for bucket in buckets.commands.values())
+            ]
+            for name in idle:
+                del self._users[name]
+        if idle:
+            logger.debug("Forgot the rate limits of %d disconnected users", len(idle))
+
+
+def parse_limit(value: str) -> Limit | None:
+    """
+    Parse a limit of the form "rate/burst", such as "20/100" for 20 commands
+    a second with bursts of up to 100. A rate of 0 disables the limit.
+
+    Args:
+        value: The limit.
+
+    Returns:
+        A (rate, burst) tuple, or None if the limit is disabled.
+    """
+    rate, _, burst = value.partition("/")
+    if not float(rate or 0):
+        return None
+    return float(rate), max(1.0, float(burst or rate))
+
+
+def parse_limits(value: str) -> dict[str, Limit]:
+    """
+    Parse per-command limits of the form "search=2/10,get_history=5/20".
+
+    Args:
+        value: The limits.
+
+    Returns:
+        A dictionary mapping commands to (rate, burst) tuples.
+    """
+    limits: dict[str, Limit] = {}
+    for entry in filter(None, (part.strip() for part in value.split(","))):
+        command, spec = entry.split("=", 1)
+        limit: Limit | None = parse_limit(spec.strip())
+        if limit:
+            limits[command.strip()] = limit
+    return limits
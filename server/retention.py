@@ -0,0 +1,152 @@
+import json
+import time
+import threading
+import logging
+from bisect import bisect_left
+from pathlib import Path
+from typing import NamedTuple
+from server.chat_history import ChatHistory
+from server.metrics import HISTORY_COMPACTION_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionPolicy(NamedTuple):
+    # Seconds after which messages are archived, or 0 to keep them regardless of age
+    max_age: float
+    # Messages kept per conversation before the oldest are archived, or 0 for no limit
+    max_messages: int
+
+
+def load_overrides(filepath: Path) -> dict[tuple[str, str], RetentionPolicy]:
+    """
+    Load per-conversation retention policies from a JSON file of the form:
+
+        {
+            "global": {"max_age_days": 30},
+            "#ops": {"max_messages": 1000},
+            "alice,bob": {"max_age_days": 7, "max_messages": 500}
+        }
+
+    Keys name the global chat, a room (prefixed with "#"), or the two users
+    of a private conversation. Omitted limits are not enforced.
+
+    Args:
+        filepath: The JSON file.
+
+    Returns:
+        A dictionary mapping conversation keys to policies, or an empty
+        dictionary if the file doesn't exist or is invalid.
+    """
+    try:
+        with open(filepath, "r", encoding="utf-8") as f:
+            config: dict[str, dict[str, float]] = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        logger.error(f"Failed to load {filepath.name}: {e}")
+        return {}
+
+    if not isinstance(config, dict):
+        logger.error(f"Failed to load {filepath.name}: expected a JSON object")
+        return {}
+
+    overrides: dict[tuple[str, str], RetentionPolicy] = {}
+    for name, limits in config.items():
+        # Skip bad entries rather than abandon the whole compaction run
+        if name != "global" and not name.startswith("#") and name.count(",") != 1:
+            logger.error(f"Ignoring retention policy for {name!r}: expected \"user1,user2\"")
+            continue
+        try:
+            policy = RetentionPolicy(
+                float(limits.get("max_age_days", 0)) * 24 * 60 * 60,
+                int(limits.get("max_messages", 0)),
+            )
+        except (AttributeError, TypeError, ValueError) as e:
+            logger.error(f"Ignoring retention policy for {name!r}: {e}")
+            continue
+        if name == "global":
+            overrides[("", "")] = policy
+        elif name.startswith("#"):
+            overrides[(name, "")] = policy
+        else:
+            u1, u2 = sorted(name.split(","))
+            overrides[(u1, u2)] = policy
+    return overrides
+
+
+class HistoryCompactor:
+    """
+    Applies retention policies to the chat history in the background,
+    archiving messages that are too old or beyond a conversation's message
+    limit.
+
+    The default policy comes from the environment, and can be overridden per
+    conversation in a JSON file that is re-read on every run.
+    """
+
+    def __init__(
+        self,
+        history: ChatHistory,
+        default: RetentionPolicy,
+        overrides_filepath: Path,
+        interval: float,
+    ) -> None:
+        """
+        Args:
+            history: The chat history to compact.
+            default: The policy for conversations without an override.
+            overrides_filepath: JSON file of per-conversation policies.
+            interval: Seconds between runs, or 0 to disable compaction.
+        """
+        self.history: ChatHistory = history
+        self.default: RetentionPolicy = default
+        self.overrides_filepath: Path = overrides_filepath
+        self.interval: float = interval
+
+    def start(self) -> None:
+        if self.interval <= 0:
+            return
+        threading.Thread(
+            target=self._run, name="History compactor", daemon=True
+        ).start()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self.compact()
+            except Exception as e:
+                logger.error(f"History compaction failed: {e}")
+            time.sleep(self.interval)
+
+    def compact(self) -> int:
+        """
+        Archive every conversation's expired messages.
+
+        Returns:
+            The number of messages archived.
+        """
+        with HISTORY_COMPACTION_SECONDS.time():
+            overrides = load_overrides(self.overrides_filepath)
+            now: float = time.time()
+            archived: int = 0
+            for key in self.history.conversations():
+                policy: RetentionPolicy = overrides.get(key, self.default)
+                count: int = self._expired_count(
+                    self.history.message_times(key), policy, now
+                )
+                if count:
+                    archived += self.history.archive_before(key, count)
+        if archived:
+            logger.info(f"Archived {archived} messages from chat history")
+        return archived
+
+    @staticmethod
+    def _expired_count(times: list[float], policy: RetentionPolicy, now: float) -> int:
+        """Count the messages at the start of a conversation that the policy expires."""
+        count: int = 0
+        if policy.max_messages:
+            count = max(0, len(times) - policy.max_messages)
+        if policy.max_age:
+            count = max(count, bisect_left(times, now - policy.max_age))
+        return count
@@ -0,0 +1,132 @@
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Longest allowed room name, in characters
+MAX_ROOM_NAME_LENGTH: int = 64
+
+
+def is_valid_room_name(room: str) -> bool:
+    """
+    Check that a room name is non-empty, not too long, and has no surrounding
+    whitespace.
+
+    Args:
+        room: The room name to check.
+
+    Returns:
+        True if the name is valid, False otherwise.
+    """
+    return 0 < len(room) <= MAX_ROOM_NAME_LENGTH and room == room.strip()
+
+
+class RoomRegistry:
+    """
+    Tracks which users have joined which named rooms.
+
+    Members of each room are kept in a set and the rooms of each user in
+    another, so membership checks, joins and leaves are constant-time, and
+    fanning a message out to a room only touches that room's members. Rooms
+    exist for as long as they have members.
+    """
+
+    def __init__(self) -> None:
+        self.lock: threading.Lock = threading.Lock()
+        self._members: dict[str, set[str]] = {}
+        self._rooms_of: dict[str, set[str]] = {}
+
+    def join(self, room: str, username: str) -> bool:
+        """
+        Add a user to a room, creating the room if it doesn't exist.
+
+        Args:
+            room: The room name.
+            username: The user joining.
+
+        Returns:
+            True if the user joined, False if they were already a member.
+        """
+        with self.lock:
+            members: set[str] = self._members.setdefault(room, set())
+            if username in members:
+                return False
+            members.add(username)
+            self._rooms_of.setdefault(username, set()).add(room)
+        logger.debug("%s joined room %s", username, room)
+        return True
+
+    def leave(self, room: str, username: str) -> bool:
+        """
+        Remove a user from a room, deleting the room if it becomes empty.
+
+        Args:
+            room: The room name.
+            username: The user leaving.
+
+        Returns:
+            True if the user left, False if they weren't a member.
+        """
+        with self.lock:
+            return self._remove(room, username)
+
+    def leave_all(self, username: str) -> list[str]:
+        """
+        Remove a user from every room they have joined.
+
+        Args:
+            username: The user leaving.
+
+        Returns:
+            The rooms the user left.
+        """
+        with self.lock:
+            rooms: list[str] = list(self._rooms_of.get(username, ()))
+            for room in rooms:
+                self._remove(room, username)
+        return rooms
+
+    def _remove(self, room: str, username: str) -> bool:
+        # Must be called with the lock held
+        members: set[str] | None = self._members.get(room)
+        if members is None or username not in members:
+            return False
+        members.discard(username)
+        if not members:
+            del self._members[room]
+        user_rooms: set[str] = self._rooms_of[username]
+        user_rooms.discard(room)
+        if not user_rooms:
+            del self._rooms_of[username]
+        logger.debug("%s left room %s", username, room)
+        return True
+
+    def is_member(self, room: str, username: str) -> bool:
+        return username in self._members.get(room, ())
+
+    def members(self, room: str) -> frozenset[str]:
+        """
+        Get a snapshot of a room's members that is safe to iterate without the lock.
+
+        Args:
+            room: The room name.
+
+        Returns:
+            The usernames of the room's members.
+        """
+        with self.lock:
+            return frozenset(self._members.get(room, ()))
+
+    def rooms(self) -> dict[str, int]:
+        """
+        Get all rooms and their member counts.
+
+        Returns:
+            A dictionary mapping room names to the number of members.
+        """
+        with self.lock:
+            return {room: len(members) for room, members in self._members.items()}
+
+    def rooms_of(self, username: str) -> frozenset[str]:
+        with self.lock:
+            return frozenset(self._rooms_of.get(username, ()))
@@ -0,0 +1,368 @@
+import os
+import re
+import math
+import heapq
+import pickle
+import threading
+import time
+import logging
+from pathlib import Path
+from typing import Any, Callable, Iterable
+
+logger = logging.getLogger(__name__)
+
+# A conversation key, as used by ChatHistory
+ConversationKey = tuple[str, str]
+# A search hit: (conversation key, message number, score)
+SearchHit = tuple[ConversationKey, int, float]
+
+_TOKEN_PATTERN: re.Pattern[str] = re.compile(r"\w+")
+
+# BM25 parameters
+_K1: float = 1.2
+_B: float = 0.75
+
+
+def tokenize(text: str) -> list[str]:
+    return _TOKEN_PATTERN.findall(text.lower())
+
+
+# Number of locks that the index is split across, by conversation
+INDEX_LOCK_STRIPES: int = 64
+
+
+class _Stripe:
+    """The part of the index holding the conversations that hash to one lock."""
+
+    __slots__ = (
+        "lock",
+        "postings",
+        "document_frequency",
+        "lengths",
+        "bases",
+        "total_length",
+        "messages",
+    )
+
+    def __init__(self) -> None:
+        self.lock: threading.Lock = threading.Lock()
+        self.postings: dict[str, dict[ConversationKey, list[tuple[int, int]]]] = {}
+        # Number of messages in this stripe containing each token
+        self.document_frequency: dict[str, int] = {}
+        # Token count of each message, by conversation and message number
+        # (offset by the conversation's base number)
+        self.lengths: dict[ConversationKey, list[int]] = {}
+        # Number of the first indexed message of each conversation
+        self.bases: dict[ConversationKey, int] = {}
+        self.total_length: int = 0
+        self.messages: int = 0
+
+    def state(self) -> dict[str, Any]:
+        return {"postings": self.postings, "lengths": self.lengths, "bases": self.bases}
+
+
+class SearchIndex:
+    """
+    Inverted index over chat messages, ranked with BM25.
+
+    Each token maps to the conversations it appears in, and for each of those
+    to the (message number, term frequency) of every message containing it,
+    so a search only visits the postings of its query terms within the
+    conversations it is allowed to see. Messages are numbered from the start
+    of their conversation; when old messages are archived, their postings
+    are dropped and the conversation's base number moves forward.
+
+    Like `ChatHistory`, the index is split by conversation across a fixed set
+    of striped locks, each part with its own postings, so indexing a message
+    only locks its conversation's stripe, and searches and saves only lock
+    one stripe at a time.
+
+    The index is updated as messages are appended and saved to disk at most
+    every `save_interval` seconds. Messages appended after the last save are
+    re-indexed from the history on load, so the index never falls behind.
+    """
+
+    def __init__(self, filepath: Path, save_interval: float) -> None:
+        """
+        Args:
+            filepath: File to persist the index to.
+            save_interval: Minimum seconds between saves.
+        """
+        self.filepath: Path = filepath
+        self.save_interval: float = save_interval
+        self._save_lock: threading.Lock = threading.Lock()
+        self._stripes: list[_Stripe] = [_Stripe() for _ in range(INDEX_LOCK_STRIPES)]
+
+        self._dirty: bool = False
+        self._last_save: float = time.monotonic()
+        self._load()
+
+    def _stripe(self, key: ConversationKey) -> _Stripe:
+        return self._stripes[hash(key) % INDEX_LOCK_STRIPES]
+
+    def indexed_count(self, key: ConversationKey) -> int:
+        """Get the number of the next message to index in a conversation."""
+        stripe: _Stripe = self._stripe(key)
+        with stripe.lock:
+            return stripe.bases.get(key, 0) + len(stripe.lengths.get(key, ()))
+
+    def add(self, key: ConversationKey, number: int, text: str) -> None:
+        """
+        Index a message.
+
+        Args:
+            key: The message's conversation.
+            number: The message's position in its conversation; messages must
+                be added in order.
+            text: The message content.
+        """
+        tokens: list[str] = tokenize(text)
+        frequencies: dict[str, int] = {}
+        for token in tokens:
+            frequencies[token] = frequencies.get(token, 0) + 1
+
+        stripe: _Stripe = self._stripe(key)
+        with stripe.lock:
+            lengths: list[int] = stripe.lengths.setdefault(key, [])
+            expected: int = stripe.bases.get(key, 0) + len(lengths)
+            if number != expected:
+                raise ValueError(f"Expected message {expected} of {key}, got {number}")
+            lengths.append(len(tokens))
+            stripe.total_length += len(tokens)
+            stripe.messages += 1
+            for token, frequency in frequencies.items():
+                stripe.postings.setdefault(token, {}).setdefault(key, []).append(
+                    (number, frequency)
+                )
+                stripe.document_frequency[token] = (
+                    stripe.document_frequency.get(token, 0) + 1
+                )
+        self._dirty = True
+
+    def search(
+        self,
+        query: str,
+        allowed: Callable[[ConversationKey], bool],
+        limit: int,
+    ) -> tuple[int, list[SearchHit]]:
+        """
+        Find the messages that best match a query.
+
+        Args:
+            query: The search terms; messages matching any term are returned,
+                ranked higher the more (and the rarer) terms they match.
+            allowed: Returns whether a conversation may be searched.
+            limit: Maximum number of hits to return.
+
+        Returns:
+            The total number of matching messages, and the top `limit` hits,
+            best first and most recent first among equal scores.
+        """
+        terms: set[str] = set(tokenize(query))
+        messages: int = 0
+        total_length: int = 0
+        frequencies: dict[str, int] = dict.fromkeys(terms, 0)
+        # The term, a conversation, its postings for the term, its message
+        # lengths and its base number
+        matches: list[
+            tuple[str, ConversationKey, list[tuple[int, int]], list[int], int]
+        ] = []
+        for stripe in self._stripes:
+            with stripe.lock:
+                messages += stripe.messages
+                total_length += stripe.total_length
+                for term in terms:
+                    conversations = stripe.postings.get(term)
+                    if not conversations:
+                        continue
+                    frequencies[term] += stripe.document_frequency[term]
+                    # Lists of lengths are only appended to or replaced, so
+                    # they can be read after the lock is released
+                    matches.extend(
+                        (
+                            term,
+                            key,
+                            list(postings),
+                            stripe.lengths[key],
+                            stripe.bases.get(key, 0),
+                        )
+                        for key, postings in conversations.items()
+                        if allowed(key)
+                    )
+        if not messages:
+            return 0, []
+
+        average_length: float = total_length / messages
+        idfs: dict[str, float] = {
+            term: math.log(1 + (messages - frequency + 0.5) / (frequency + 0.5))
+            for term, frequency in frequencies.items()
+        }
+        scores: dict[tuple[ConversationKey, int], float] = {}
+        for term, key, postings, lengths, base in matches:
+            idf: float = idfs[term]
+            for number, tf in postings:
+                norm: float = _K1 * (1 - _B + _B * lengths[number - base] / average_length)
+                scores[(key, number)] = scores.get((key, number), 0.0) + idf * (
+                    tf * (_K1 + 1) / (tf + norm)
+                )
+
+        top: list[tuple[tuple[ConversationKey, int], float]] = heapq.nlargest(
+            limit, scores.items(), key=lambda item: (item[1], item[0][1])
+        )
+        return len(scores), [(key, number, score) for (key, number), score in top]
+
+    def forget_before(self, key: ConversationKey, number: int, texts: list[str]) -> None:
+        """
+        Drop a conversation's messages before `number` from the index.
+
+        Args:
+            key: The conversation.
+            number: The number of the first message to keep.
+            texts: The content of the dropped messages, used to find the
+                postings to remove without scanning the whole index.
+        """
+        tokens: set[str] = set()
+        for text in texts:
+            tokens.update(tokenize(text))
+
+        stripe: _Stripe = self._stripe(key)
+        with stripe.lock:
+            base: int = stripe.bases.get(key, 0)
+            if number <= base:
+                return
+            for token in tokens:
+                conversations = stripe.postings.get(token)
+                postings = conversations.get(key) if conversations else None
+                if not conversations or not postings:
+                    continue
+                kept: list[tuple[int, int]] = [p for p in postings if p[0] >= number]
+                stripe.document_frequency[token] -= len(postings) - len(kept)
+                if kept:
+                    conversations[key] = kept
+                else:
+                    del conversations[key]
+                    if not conversations:
+                        del stripe.postings[token]
+                        del stripe.document_frequency[token]
+
+            lengths: list[int] = stripe.lengths.get(key, [])
+            dropped: list[int] = lengths[: number - base]
+            stripe.lengths[key] = lengths[number - base :]
+            stripe.bases[key] = number
+            stripe.total_length -= sum(dropped)
+            stripe.messages -= len(dropped)
+        self._dirty = True
+
+    def maybe_save(self) -> None:
+        """Save the index if it has changed and wasn't saved recently."""
+        if self._dirty and time.monotonic() - self._last_save >= self.save_interval:
+            self.save()
+
+    def save(self) -> None:
+        with self._save_lock:
+            self._dirty = False
+            self._last_save = time.monotonic()
+            # Pickle one stripe at a time, so indexing only ever waits for a
+            # small part of the save
+            stripes: list[bytes] = []
+            for stripe in self._stripes:
+                with stripe.lock:
+                    stripes.append(pickle.dumps(stripe.state()))
+
+            # Write outside the locks so appends aren't held up by the disk
+            temp_filepath: Path = self.filepath.with_suffix(".tmp")
+            with open(temp_filepath, "wb") as f:
+                pickle.dump({"stripes": stripes}, f)
+            os.replace(temp_filepath, self.filepath)
+        logger.debug("Saved search index with %d messages", self._message_count())
+
+    def _message_count(self) -> int:
+        return sum(stripe.messages for stripe in self._stripes)
+
+    def _load(self) -> None:
+        try:
+            with open(self.filepath, "rb") as f:
+                state = pickle.load(f)
+            # Indexes saved before striping hold a single part
+            parts: list[dict[str, Any]] = (
+                [pickle.loads(blob) for blob in state["stripes"]]
+                if "stripes" in state
+                else [state]
+            )
+            for part in parts:
+                self._load_part(part["postings"], part["lengths"], part.get("bases", {}))
+        except FileNotFoundError:
+            return
+        except (pickle.UnpicklingError, EOFError, KeyError) as e:
+            logger.warning(f"Failed to load {self.filepath.name}; index will be rebuilt: {e}")
+            self.clear()
+
+    def _load_part(
+        self,
+        postings: dict[str, dict[ConversationKey, list[tuple[int, int]]]],
+        lengths: dict[ConversationKey, list[int]],
+        bases: dict[ConversationKey, int],
+    ) -> None:
+        # Keys hash differently in each process, so conversations are
+        # assigned to stripes afresh
+        for key, conversation_lengths in lengths.items():
+            stripe: _Stripe = self._stripe(key)
+            stripe.lengths[key] = conversation_lengths
+            stripe.bases[key] = bases.get(key, 0)
+            stripe.total_length += sum(conversation_lengths)
+            stripe.messages += len(conversation_lengths)
+        for token, conversations in postings.items():
+            for key, token_postings in conversations.items():
+                stripe = self._stripe(key)
+                stripe.postings.setdefault(token, {})[key] = token_postings
+                stripe.document_frequency[token] = stripe.document_frequency.get(
+                    token, 0
+                ) + len(token_postings)
+
+    def clear(self) -> None:
+        for stripe in self._stripes:
+            with stripe.lock:
+                stripe.postings = {}
+                stripe.document_frequency = {}
+                stripe.lengths = {}
+                stripe.bases = {}
+                stripe.total_length = 0
+                stripe.messages = 0
+        self._dirty = True
+
+    def catch_up(
+        self, history: Iterable[tuple[ConversationKey, int, list[str]]]
+    ) -> None:
+        """
+        Index messages appended since the index was last saved.
+
+        Args:
+            history: Each conversation's key, the number of its first message,
+                and its message texts, in order.
+        """
+        conversations: list[tuple[ConversationKey, int, list[str]]] = list(history)
+        known: set[ConversationKey] = {key for key, _, _ in conversations}
+        indexed: dict[ConversationKey, int] = {}
+        for stripe in self._stripes:
+            indexed.update({key: stripe.bases.get(key, 0) for key in stripe.lengths})
+        if any(key not in known for key in indexed) or any(
+            (key in indexed and indexed[key] != base)
+            or self.indexed_count(key) > base + len(messages)
+            for key, base, messages in conversations
+        ):
+            logger.warning("Search index doesn't match the chat history; rebuilding")
+            self.clear()
+            indexed = {}
+
+        added: int = 0
+        for key, base, messages in conversations:
+            if key not in indexed:
+                stripe = self._stripe(key)
+                stripe.lengths[key] = []
+                stripe.bases[key] = base
+            for number in range(self.indexed_count(key), base + len(messages)):
+                self.add(key, number, messages[number - base])
+                added += 1
+        if added:
+            logger.info(f"Indexed {added} messages missing from the search index")
+            self.save()
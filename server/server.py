@@ -4,46 +4,261 @@
 
 # Import necessary modules
 import os
+import sys
+import hmac
+import json
+import itertools
+import time
+import socket
 import socketserver
-import threading
 import logging
-from typing import Callable
+from pathlib import Path
+from types import MappingProxyType
+from typing import Any, Callable, ClassVar, Iterator, Mapping
 from dotenv import load_dotenv
-from utils.encryption import send, receive
-from utils.logger import configure_logger
+from utils.encryption import (
+    MAX_MESSAGE_SIZE,
+    encode_frame,
+    receive_length_prefix,
+    receive_payload,
+    decrypt_frame,
+)
+from utils.logger import configure_logger, frame_dump_enabled, queued_log_records
 from server.user_manager import UserManager
-from server.chat_history import ChatHistory
+from server.passwords import HasherBusyError
+from server.sessions import SessionTokens
+from server.chat_history import ChatHistory, STORAGE_DIR
+from server.outbox import Outbox
+from server.offline_inbox import OfflineInbox
+from server.rooms import RoomRegistry, is_valid_room_name
+from server.retention import HistoryCompactor, RetentionPolicy
+from server.heartbeat import HeartbeatMonitor, configure_keepalive
+from server.cluster import ClusterNode, TcpMeshBus, parse_peers
+from server.traffic import TrafficRecorder
+from server.rate_limit import RateLimiter, parse_limit, parse_limits
+from server.admission import AdmissionControl, ChatServer
+from server.tracing import (
+    RequestTrace,
+    Tracer,
+    SamplingProfiler,
+    current_trace,
+    install_signal_handlers,
+)
+from server.metrics import (
+    TimedLock,
+    start_metrics_server,
+    FRAMES_RECEIVED,
+    FRAMES_SENT,
+    BYTES_RECEIVED,
+    BYTES_SENT,
+    ENCRYPT_SECONDS,
+    DECRYPT_SECONDS,
+    LOCK_WAIT_SECONDS,
+    OPEN_CONNECTIONS,
+    CONNECTED_CLIENTS,
+    REMOTE_USERS,
+    LOGIN_VALIDATIONS,
+    LOG_QUEUE_RECORDS,
+    LOG_RECORDS_DROPPED,
+    THROTTLED_COMMANDS,
+    RATE_LIMITED_USERS,
+)
 
 load_dotenv(override=True)
 LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text").lower()
+LOG_FRAME_SAMPLE_RATE = int(os.environ.get("LOG_FRAME_SAMPLE_RATE", 1))
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10_000))
+TRACE_REQUESTS = os.environ.get("TRACE_REQUESTS", "").lower() in ("1", "true", "yes")
+TRACE_SLOW_MS = float(os.environ.get("TRACE_SLOW_MS", 250))
+SEND_TIMEOUT = float(os.environ.get("SEND_TIMEOUT", 10))
+OUTBOX_MAX_BYTES = int(os.environ.get("OUTBOX_MAX_BYTES", 1024 * 1024))
+HEARTBEAT_INTERVAL = float(os.environ.get("HEARTBEAT_INTERVAL", 30))
+HEARTBEAT_TIMEOUT = float(os.environ.get("HEARTBEAT_TIMEOUT", 90))
+TCP_KEEPALIVE_IDLE = int(os.environ.get("TCP_KEEPALIVE_IDLE", 0))
+OFFLINE_INBOX_MAX = int(os.environ.get("OFFLINE_INBOX_MAX", 1000))
+OFFLINE_INBOX_TTL = float(os.environ.get("OFFLINE_INBOX_TTL", 7 * 24 * 60 * 60))
+OFFLINE_INBOX_MEMORY = int(os.environ.get("OFFLINE_INBOX_MEMORY", 100))
+CLUSTER_NODE_ID = os.environ.get("CLUSTER_NODE_ID", "")
+CLUSTER_LISTEN = os.environ.get("CLUSTER_LISTEN", "127.0.0.1:9000")
+CLUSTER_PEERS = os.environ.get("CLUSTER_PEERS", "")
+CLUSTER_SECRET = os.environ.get("CLUSTER_SECRET", "")
+CLUSTER_TIMEOUT = float(os.environ.get("CLUSTER_TIMEOUT", 5))
+HISTORY_RETENTION_DAYS = float(os.environ.get("HISTORY_RETENTION_DAYS", 0))
+HISTORY_RETENTION_MESSAGES = int(os.environ.get("HISTORY_RETENTION_MESSAGES", 0))
+HISTORY_COMPACT_INTERVAL = float(os.environ.get("HISTORY_COMPACT_INTERVAL", 60 * 60))
+ADMIN_TOKENS = frozenset(filter(None, os.environ.get("ADMIN_TOKENS", "").split(",")))
+# Without a configured secret, session tokens only last until the server restarts
+SESSION_SECRET = os.environ.get("SESSION_SECRET", "").encode("utf-8") or os.urandom(32)
+SESSION_TTL = float(os.environ.get("SESSION_TTL", 24 * 60 * 60))
+RECORD_TRAFFIC_PATH = os.environ.get("RECORD_TRAFFIC_PATH", "")
+RATE_LIMIT_USER = os.environ.get("RATE_LIMIT_USER", "50/200")
+RATE_LIMIT_COMMANDS = os.environ.get(
+    "RATE_LIMIT_COMMANDS",
+    "get_history=5/20,get_archive=2/10,search=2/10,get_users=5/20,"
+    "list_rooms=5/20,file_request=2/10",
+)
+RATE_LIMIT_MAX_DELAY = float(os.environ.get("RATE_LIMIT_MAX_DELAY", 1))
+MAX_CONNECTIONS = int(os.environ.get("MAX_CONNECTIONS", 5000))
+MAX_CONNECTIONS_PER_IP = int(os.environ.get("MAX_CONNECTIONS_PER_IP", 0))
+LISTEN_BACKLOG = int(os.environ.get("LISTEN_BACKLOG", 128))
+AUTH_TIMEOUT = float(os.environ.get("AUTH_TIMEOUT", 30))
 
 # Set up logger
-configure_logger(LOG_LEVEL)
+configure_logger(
+    LOG_LEVEL,
+    LOG_FORMAT == "json",
+    LOG_FRAME_SAMPLE_RATE,
+    LOG_QUEUE_SIZE,
+    LOG_RECORDS_DROPPED.inc,
+)
 logger = logging.getLogger(__name__)
 
+# Commands reported under their own name in metrics; anything else is
+# counted as "unknown" to keep label cardinality bounded
+KNOWN_COMMANDS: frozenset[str] = frozenset(
+    {
+        "login",
+        "register",
+        "resume",
+        "batch_register",
+        "get_users",
+        "get_history",
+        "chat",
+        "file_request",
+        "file_response",
+        "close",
+        "pong",
+        "get_offline",
+        "join_room",
+        "leave_room",
+        "list_rooms",
+        "room_chat",
+        "search",
+        "get_archive",
+    }
+)
+
+# Commands that are never rate limited
+UNLIMITED_COMMANDS: frozenset[str] = frozenset({"pong", "close"})
+
+# Largest page of search results a client may request
+MAX_SEARCH_PAGE_SIZE: int = 100
+
 
 # RequestHandler class for managing client connections
-class RequestHandler(socketserver.BaseRequestHandler):
-    # Thread-safe dictionary to store connected clients
-    clients: dict[str, "RequestHandler"] = {}
-    clients_lock: threading.Lock = threading.Lock()
+class RequestHandler:
+    """
+    Serves one client connection.
+
+    Follows the `socketserver.BaseRequestHandler` protocol (the server calls
+    the class with the socket, client address and server, and `setup`,
+    `handle` and `finish` run from the constructor), but declares its
+    per-connection state in `__slots__`, which the base class's instance
+    dictionary would defeat, to keep idle connections cheap.
+    """
 
-    # Load user data and chat history
-    user_manager: UserManager = UserManager()
-    chat_history: ChatHistory = ChatHistory()
+    __slots__ = (
+        "request",
+        "client_address",
+        "server",
+        "connection_id",
+        "connected_at",
+        "username",
+        "file_peer",
+        "authed",
+        "last_seen",
+        "outbox",
+    )
+
+    # Connected clients by username. This is an immutable snapshot that is
+    # replaced wholesale on login and logout, so readers iterate it without
+    # locking; the lock only serializes writers.
+    clients: Mapping[str, "RequestHandler"] = MappingProxyType({})
+    clients_lock: TimedLock = TimedLock(LOCK_WAIT_SECONDS.labels("clients"))
+
+    # Load user data and chat history. These are shared by every handler,
+    # and the class itself stands in for the local server in a cluster.
+    user_manager: ClassVar[UserManager] = UserManager()
+    chat_history: ClassVar[ChatHistory] = ChatHistory()
+    rooms: RoomRegistry = RoomRegistry()
+    offline_inbox: ClassVar[OfflineInbox] = OfflineInbox(
+        STORAGE_DIR / "inbox",
+        OFFLINE_INBOX_MAX,
+        OFFLINE_INBOX_TTL,
+        OFFLINE_INBOX_MEMORY,
+    )
 
     # Maximum buffer size for receiving data
     max_buff_size: int = 1024
 
+    # Limits after which a client that isn't reading its messages is dropped
+    send_timeout: float = SEND_TIMEOUT
+    outbox_max_bytes: int = OUTBOX_MAX_BYTES
+
+    # Pings idle connections and reaps unresponsive or unauthenticated ones
+    heartbeat: HeartbeatMonitor = HeartbeatMonitor(
+        HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT, AUTH_TIMEOUT
+    )
+
+    # Per-stage request tracing (toggled at runtime with SIGUSR2)
+    tracer: Tracer = Tracer(
+        TRACE_REQUESTS, TRACE_SLOW_MS / 1000, STORAGE_DIR / "slow_requests.log"
+    )
+
+    # Signed tokens that let clients reconnect without their password
+    sessions: SessionTokens = SessionTokens(SESSION_SECRET, SESSION_TTL)
+
+    # Per-user and per-command token buckets for authenticated commands
+    rate_limiter: RateLimiter = RateLimiter(
+        parse_limit(RATE_LIMIT_USER), parse_limits(RATE_LIMIT_COMMANDS)
+    )
+
+    # Links to other server nodes, if this server is part of a cluster
+    cluster: ClusterNode | None = None
+
+    # Records inbound traffic for replay, if RECORD_TRAFFIC_PATH is set
+    recorder: TrafficRecorder | None = None
+    _connection_ids: Iterator[int] = itertools.count(1)
+
     # -- Client connection lifecycle methods --
 
+    def __init__(
+        self,
+        request: socket.socket,
+        client_address: tuple[str, int],
+        server: socketserver.BaseServer,
+    ) -> None:
+        self.request: socket.socket = request
+        self.client_address: tuple[str, int] = client_address
+        self.server: socketserver.BaseServer = server
+        self.setup()
+        try:
+            self.handle()
+        finally:
+            self.finish()
+
     def setup(self) -> None:
         """
         Initialize the handler for a new client connection.
         """
+        self.connection_id: int = next(self._connection_ids)
         self.username: str = ""
         self.file_peer: str = ""
         self.authed: bool = False
+        self.connected_at: float = time.monotonic()
+        self.last_seen: float = self.connected_at
+        if TCP_KEEPALIVE_IDLE:
+            configure_keepalive(self.request, TCP_KEEPALIVE_IDLE)
+        self.outbox: Outbox = Outbox(
+            self.request,
+            str(self.client_address),
+            self.outbox_max_bytes,
+            self.send_timeout,
+        )
+        self.heartbeat.add(self)
+        if self.recorder:
+            self.recorder.opened(self.connection_id)
         logger.info(f"New connection from {self.client_address}")
 
     def handle(self) -> None:
@@ -53,14 +268,38 @@ class RequestHandler(socketserver.BaseRequestHandler):
         while self.request:
             try:
                 # self.request is the TCP socket connected to the client
-                data: dict = receive(self.request, self.max_buff_size)
+                length: int = receive_length_prefix(self.request)
+                trace: RequestTrace = self.tracer.start()
+                with trace.stage("receive"):
+                    frame: bytes = receive_payload(
+                        self.request, length, self.max_buff_size
+                    )
+                self.last_seen = time.monotonic()
+                with DECRYPT_SECONDS.time():
+                    with trace.stage("decrypt"):
+                        plaintext: bytes = decrypt_frame(frame)
+                    with trace.stage("decode"):
+                        data: dict = json.loads(plaintext)
+                if self.recorder:
+                    self.recorder.frame(self.connection_id, data, plaintext)
                 if data:
-                    logger.debug(f"Received data from {self.client_address}: {data}")
+                    command = str(data.get("command", ""))
+                    label = command if command in KNOWN_COMMANDS else "unknown"
+                    FRAMES_RECEIVED.labels(label).inc()
+                    BYTES_RECEIVED.labels(label).inc(len(frame) + 2)
+                    trace.command = label
+
+                    if frame_dump_enabled(logger):
+                        logger.debug(
+                            "Received data from %s: %s", self.client_address, data
+                        )
 
-                    if not self.authed:
-                        self._handle_authentication(data)
-                    else:
-                        self._handle_authenticated_commands(data)
+                    with trace.stage("dispatch"):
+                        if not self.authed:
+                            self._handle_authentication(data)
+                        else:
+                            self._handle_authenticated_commands(data)
+                    self.tracer.finish(trace, self.username)
                 else:
                     logger.error(f"Empty message received from {self.client_address}")
             except ConnectionResetError:
@@ -81,12 +320,198 @@ class RequestHandler(socketserver.BaseRequestHandler):
         if self.authed:
             self.authed = False
 
-            with RequestHandler.clients_lock:
-                if self.username in RequestHandler.clients:
-                    del RequestHandler.clients[self.username]
-                    logger.info(f"Removed {self.username} from connected clients")
+            # If the user has since logged in on another connection, they
+            # haven't left, so their presence and rooms stay as they are
+            if self._remove_client(self.username, self):
+                logger.info(f"Removed {self.username} from connected clients")
+                self.rate_limiter.disconnected(self.username)
+
+                self._notify_peer_left()
+                for room in self.rooms.leave_all(self.username):
+                    self._notify_room(room, {"type": "peer_left_room", "room": room})
+
+        self.heartbeat.remove(self)
+        self.outbox.close()
+        if self.recorder:
+            self.recorder.closed(self.connection_id)
+
+    def disconnect(self, reason: str) -> None:
+        """
+        Drop the connection from another thread. The handler's receive loop
+        then fails and `finish` cleans up as usual.
+
+        Args:
+            reason: Why the connection is being dropped, for the log.
+        """
+        logger.warning(f"Disconnecting {self.client_address}: {reason}")
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def deliver(self, data: dict[str, Any]) -> None:
+        """
+        Encrypt a message and queue it for sending to the client connected to
+        this handler. Never blocks on the client's socket.
+
+        Args:
+            data (dict): The message to send; its "type" labels the frame in metrics.
+        """
+        with current_trace().stage("send"):
+            self.deliver_frame(self._encode(data), str(data.get("type", "")))
+
+    def deliver_frame(self, frame: bytes, message_type: str) -> None:
+        """
+        Queue an already encoded frame for sending, so a message fanned out
+        to many clients is only encrypted once.
+
+        Args:
+            frame (bytes): The encoded frame.
+            message_type (str): The message's "type", for metrics.
+        """
+        if not self.outbox.put(frame):
+            return
+        FRAMES_SENT.labels(message_type).inc()
+        BYTES_SENT.labels(message_type).inc(len(frame))
+
+    @staticmethod
+    def _encode(data: dict[str, Any]) -> bytes:
+        with ENCRYPT_SECONDS.time():
+            return encode_frame(data)
+
+    def deliver_in_batches(
+        self, message_type: str, items: list[Any], **fields: Any
+    ) -> None:
+        """
+        Send a list to the client in as few messages as fit within the frame
+        size limit. At least one message is always sent, even for an empty list.
+
+        Args:
+            message_type (str): The "type" of each message.
+            items (list): The items to send, split across the "data" field of
+                each message.
+            fields: Extra fields to include in every message.
+        """
+        overhead: int = len(json.dumps({"type": message_type, "data": [], **fields}))
+        batch: list[Any] = []
+        batch_size: int = 0
+        for item in items:
+            # Account for the separator between list items
+            item_size: int = len(json.dumps(item)) + 2
+            if batch and overhead + batch_size + item_size > MAX_MESSAGE_SIZE:
+                self.deliver({"type": message_type, "data": batch, **fields})
+                batch, batch_size = [], 0
+            batch.append(item)
+            batch_size += item_size
+        self.deliver({"type": message_type, "data": batch, **fields})
+
+    # -- Client registry --
+
+    @classmethod
+    def _add_client(cls, username: str, handler: "RequestHandler") -> bool:
+        """
+        Add a client, replacing any earlier connection of the same user.
+
+        Returns:
+            bool: True if the user wasn't already connected.
+        """
+        with cls.clients_lock:
+            clients: dict[str, RequestHandler] = dict(cls.clients)
+            previous: RequestHandler | None = clients.get(username)
+            clients[username] = handler
+            cls.clients = MappingProxyType(clients)
+        return previous is None
+
+    @classmethod
+    def _remove_client(cls, username: str, handler: "RequestHandler") -> bool:
+        """
+        Remove a client, unless the user has since logged in on another connection.
+
+        Returns:
+            bool: True if the client was removed.
+        """
+        with cls.clients_lock:
+            if cls.clients.get(username) is not handler:
+                return False
+            clients: dict[str, RequestHandler] = dict(cls.clients)
+            del clients[username]
+            cls.clients = MappingProxyType(clients)
+        return True
+
+    # -- Local delivery, shared by handlers and the cluster node --
 
-            self._notify_peer_left()
+    @classmethod
+    def local_usernames(cls) -> list[str]:
+        return list(cls.clients.keys())
+
+    @classmethod
+    def deliver_to_user(
+        cls, username: str, data: dict[str, Any], file_peer: str = ""
+    ) -> bool:
+        """
+        Send a message to a user connected to this server.
+
+        Args:
+            username (str): The recipient.
+            data (dict): The message to send.
+            file_peer (str): If set, record this user as the recipient's
+                pending file transfer peer.
+
+        Returns:
+            bool: True if the user is connected to this server, False otherwise.
+        """
+        with current_trace().stage("fanout"):
+            handler: RequestHandler | None = cls.clients.get(username)
+            if handler is None:
+                return False
+            if file_peer:
+                handler.file_peer = sys.intern(file_peer)
+            handler.deliver(data)
+        return True
+
+    @classmethod
+    def deliver_to_all(cls, data: dict[str, Any], exclude: str = "") -> None:
+        """
+        Send a message to every user connected to this server.
+
+        Args:
+            data (dict): The message to send.
+            exclude (str): A user who should not receive the message.
+        """
+        cls._deliver_to_handlers(
+            [handler for user, handler in cls.clients.items() if user != exclude],
+            data,
+        )
+
+    @classmethod
+    def deliver_to_room(cls, room: str, data: dict[str, Any], exclude: str = "") -> None:
+        """
+        Send a message to every member of a room connected to this server.
+
+        Args:
+            room (str): The room name.
+            data (dict): The message to send.
+            exclude (str): A user who should not receive the message.
+        """
+        members: frozenset[str] = cls.rooms.members(room)
+        clients: Mapping[str, RequestHandler] = cls.clients
+        cls._deliver_to_handlers(
+            [clients[user] for user in members if user != exclude and user in clients],
+            data,
+        )
+
+    @staticmethod
+    def _deliver_to_handlers(
+        handlers: list["RequestHandler"], data: dict[str, Any]
+    ) -> None:
+        """Encode a message once and queue it for each of the given clients."""
+        if not handlers:
+            return
+        with current_trace().stage("fanout"):
+            frame: bytes = RequestHandler._encode(data)
+            message_type: str = str(data.get("type", ""))
+            for handler in handlers:
+                handler.deliver_frame(frame, message_type)
 
     # -- Notification methods --
 
@@ -96,12 +521,9 @@ class RequestHandler(socketserver.BaseRequestHandler):
 
         Triggered in `_process_login` after successful authentication.
         """
-        with RequestHandler.clients_lock:
-            for user in RequestHandler.clients.keys():
-                send(
-                    RequestHandler.clients[user].request,
-                    {"type": "peer_joined", "peer": self.username},
-                )
+        self.deliver_to_all({"type": "peer_joined", "peer": self.username})
+        if self.cluster:
+            self.cluster.user_joined(self.username)
 
     def _notify_peer_left(self) -> None:
         """
@@ -109,12 +531,22 @@ class RequestHandler(socketserver.BaseRequestHandler):
 
         Triggered in `finish` method after the client disconnects.
         """
-        with RequestHandler.clients_lock:
-            for user in RequestHandler.clients.keys():
-                send(
-                    RequestHandler.clients[user].request,
-                    {"type": "peer_left", "peer": self.username},
-                )
+        self.deliver_to_all({"type": "peer_left", "peer": self.username})
+        if self.cluster:
+            self.cluster.user_left(self.username)
+
+    def _notify_room(self, room: str, data: dict[str, Any]) -> None:
+        """
+        Send a message to every other member of a room who is connected.
+
+        Args:
+            room (str): The room name.
+            data (dict): The message to send; a "peer" field naming this user is added.
+        """
+        message: dict[str, Any] = {**data, "peer": self.username}
+        self.deliver_to_room(room, message, exclude=self.username)
+        if self.cluster:
+            self.cluster.send_to_room(room, message, exclude=self.username)
 
     # -- Command handlers --
 
@@ -127,10 +559,16 @@ class RequestHandler(socketserver.BaseRequestHandler):
         Args:
             data (dict): The received data containing authentication information.
         """
-        logger.debug(f"Handling authentication for client {self.client_address}")
+        logger.debug("Handling authentication for client %s", self.client_address)
 
         if data.get("command") == "login":
             self._process_login(data)
+        elif data.get("command") == "resume":
+            self._process_resume(data)
+        elif data.get("command") == "batch_register":
+            self._process_batch_registration(data)
+        elif data.get("command") == "pong":
+            pass
         elif data.get("command") == "register":
             logger.debug("Received register command")
             self._process_registration(data)
@@ -146,22 +584,71 @@ class RequestHandler(socketserver.BaseRequestHandler):
             "username": username,
         }
 
-        if self.user_manager.validate(username, password):
-            login_result.update({"response": "ok"})
-
-            # Update authentication state
-            self.username = username
-            self.authed = True
-            with RequestHandler.clients_lock:
-                RequestHandler.clients[self.username] = self
+        try:
+            is_valid: bool = self.user_manager.validate(username, password)
+        except HasherBusyError as e:
+            logger.warning(f"Rejected login for {username}: {e}")
+            login_result.update(
+                {"response": "fail", "reason": "Server is busy, please try again"}
+            )
+            self.deliver(login_result)
+            return
 
-            self._notify_peer_joined()
+        if is_valid:
+            self._complete_login(username, login_result)
         else:
             login_result.update(
                 {"response": "fail", "reason": "Incorrect username or password!"}
             )
 
-        send(self.request, login_result)
+        self.deliver(login_result)
+
+    def _process_resume(self, data: dict[str, str]) -> None:
+        """
+        Log in with a session token from an earlier login instead of a
+        password, which skips the password hash.
+
+        Args:
+            data (dict): The received data containing the session token.
+        """
+        username: str | None = self.sessions.verify(data.get("token", ""))
+        login_result: dict[str, str] = {
+            "type": "login_result",
+            "username": username or "",
+        }
+        if username and self.user_manager.exists(username):
+            LOGIN_VALIDATIONS.labels("resumed").inc()
+            self._complete_login(username, login_result)
+        else:
+            login_result.update(
+                {"response": "fail", "reason": "Session expired, please log in again"}
+            )
+        self.deliver(login_result)
+
+    def _complete_login(self, username: str, login_result: dict[str, str]) -> None:
+        """
+        Mark the connection as authenticated and announce the user.
+
+        Args:
+            username (str): The authenticated user.
+            login_result (dict): The response to the client, to which the
+                result and a fresh session token are added.
+        """
+        login_result.update(
+            {"response": "ok", "session_token": self.sessions.issue(username)}
+        )
+
+        # Update authentication state. The username is interned so that the
+        # client registry, room memberships and file transfer peers share
+        # one string per user.
+        self.username = sys.intern(username)
+        self.authed = True
+        if self._add_client(self.username, self):
+            # Counted once per user, matching `finish`, which only counts the
+            # user as gone when their current connection closes
+            self.rate_limiter.connected(self.username)
+
+        self._notify_peer_joined()
 
     def _process_registration(self, data: dict[str, str]) -> None:
         """
@@ -183,6 +670,10 @@ class RequestHandler(socketserver.BaseRequestHandler):
 
             if registration_success:
                 register_result.update({"response": "ok"})
+                if self.cluster:
+                    self.cluster.users_registered(
+                        [(username, self.user_manager.get_record(username))]
+                    )
                 logger.debug(f"Registration successful for user: {username}")
             else:
                 register_result.update(
@@ -191,13 +682,77 @@ class RequestHandler(socketserver.BaseRequestHandler):
                 logger.debug(
                     f"Registration failed for user: {username} - Username already exists"
                 )
+        except HasherBusyError as e:
+            logger.warning(f"Rejected registration for {username}: {e}")
+            register_result.update(
+                {"response": "fail", "reason": "Server is busy, please try again"}
+            )
         except Exception as e:
             logger.error(f"Error during registration process: {str(e)}")
             register_result.update(
                 {"response": "fail", "reason": "Internal server error"}
             )
         finally:
-            send(self.request, register_result)
+            self.deliver(register_result)
+
+    def _process_batch_registration(self, data: dict[str, Any]) -> None:
+        """
+        Register many accounts in one request, for provisioning agents.
+        Requires one of the tokens in `ADMIN_TOKENS`.
+
+        Args:
+            data (dict): The received data containing the admin token and a
+                list of [username, password] pairs.
+        """
+        token: Any = data.get("token")
+        # compare_digest only accepts ASCII strings, so compare encoded tokens
+        if not isinstance(token, str) or not any(
+            hmac.compare_digest(token.encode("utf-8"), admin.encode("utf-8"))
+            for admin in ADMIN_TOKENS
+        ):
+            logger.warning(f"Rejected batch registration from {self.client_address}")
+            self.deliver(
+                {
+                    "type": "batch_register_result",
+                    "response": "fail",
+                    "reason": "Invalid admin token",
+                }
+            )
+            return
+
+        # Provisioning can take a while, so each authorized batch restarts
+        # the authentication deadline instead of counting towards it
+        self.connected_at = time.monotonic()
+        entries: Any = data.get("accounts", [])
+        if not isinstance(entries, list) or not all(
+            isinstance(entry, list)
+            and len(entry) == 2
+            and all(isinstance(field, str) for field in entry)
+            for entry in entries
+        ):
+            self.deliver(
+                {
+                    "type": "batch_register_result",
+                    "response": "fail",
+                    "reason": "Accounts must be a list of [username, password] pairs",
+                }
+            )
+            return
+        accounts: list[tuple[str, str]] = [
+            (username, password) for username, password in entries
+        ]
+        added: list[tuple[str, str]] = self.user_manager.register_many(accounts)
+        if self.cluster and added:
+            self.cluster.users_registered(added)
+
+        added_usernames: set[str] = {username for username, _ in added}
+        results: list[list[Any]] = []
+        for username, _ in accounts:
+            results.append([username, username in added_usernames])
+            # Only the first occurrence of a username counts as registered
+            added_usernames.discard(username)
+        self.deliver_in_batches("batch_register_result", results, response="ok")
+        self.connected_at = time.monotonic()
 
     ## Authenticated command handlers
 
@@ -210,6 +765,12 @@ class RequestHandler(socketserver.BaseRequestHandler):
         """
         command: str = data.get("command", "")
 
+        if self.rate_limiter.enabled and command not in UNLIMITED_COMMANDS:
+            retry_after, limit = self.rate_limiter.check(self.username, command)
+            if retry_after:
+                self._throttle(command, retry_after, limit)
+                return
+
         command_handlers: dict[str, Callable[[dict[str, str]], None]] = {
             "get_users": self._handle_get_users,
             "get_history": self._handle_get_history,
@@ -217,6 +778,14 @@ class RequestHandler(socketserver.BaseRequestHandler):
             "file_request": self._handle_file_request,
             "file_response": self._handle_file_response,
             "close": self._handle_close,
+            "pong": self._handle_pong,
+            "get_offline": self._handle_get_offline,
+            "join_room": self._handle_join_room,
+            "leave_room": self._handle_leave_room,
+            "list_rooms": self._handle_list_rooms,
+            "room_chat": self._handle_room_chat,
+            "search": self._handle_search,
+            "get_archive": self._handle_get_archive,
         }
 
         handler = command_handlers.get(command)
@@ -232,6 +801,31 @@ class RequestHandler(socketserver.BaseRequestHandler):
                 f"Unknown or missing command received from {self.username}: {command}"
             )
 
+    def _throttle(self, command: str, retry_after: float, limit: str) -> None:
+        """
+        Reject a command that exceeded a rate limit, then stop reading from
+        this connection until the command could be retried (up to
+        `RATE_LIMIT_MAX_DELAY`), so that a client flooding the server waits on
+        its own socket buffer instead of using the server's time.
+
+        Args:
+            command (str): The rejected command.
+            retry_after (float): Seconds until the command would be allowed.
+            limit (str): The limit that was reached, "user" or "command".
+        """
+        THROTTLED_COMMANDS.labels(
+            command if command in KNOWN_COMMANDS else "unknown", limit
+        ).inc()
+        self.deliver(
+            {
+                "type": "throttled",
+                "command": command,
+                "limit": limit,
+                "retry_after": round(retry_after, 3),
+            }
+        )
+        time.sleep(min(retry_after, RATE_LIMIT_MAX_DELAY))
+
     def _handle_get_users(self, data: dict[str, str]) -> None:
         """
         Handle request for list of online users.
@@ -239,28 +833,67 @@ class RequestHandler(socketserver.BaseRequestHandler):
         Args:
             data (dict): The received data (unused in this method).
         """
-        with RequestHandler.clients_lock:
-            users = [
-                user for user in RequestHandler.clients.keys() if user != self.username
-            ]
-        send(self.request, {"type": "get_users", "data": users})
+        users: list[str] = [
+            user for user in RequestHandler.clients.keys() if user != self.username
+        ]
+        if self.cluster:
+            users.extend(self.cluster.remote_usernames())
+        self.deliver({"type": "get_users", "data": users})
 
     def _handle_get_history(self, data: dict[str, str]) -> None:
         """
         Handle request for chat history.
 
         Args:
-            data (dict): The received data containing the peer for which history is requested.
+            data (dict): The received data containing the peer for which history is
+                requested, or the room for room history.
         """
-        send(
-            self.request,
+        if "room" in data:
+            if not self.rooms.is_member(data["room"], self.username):
+                self._send_room_error(data["room"], "You are not a member of this room")
+                return
+            self.deliver(
+                {
+                    "type": "get_history",
+                    "room": data["room"],
+                    "data": self._history().get_room_history(data["room"]),
+                },
+            )
+            return
+
+        self.deliver(
             {
                 "type": "get_history",
                 "peer": data["peer"],
-                "data": self.chat_history.get_history(self.username, data["peer"]),
+                "data": self._history().get_history(self.username, data["peer"]),
             },
         )
 
+    def _handle_get_archive(self, data: dict[str, str]) -> None:
+        """
+        Handle request for the messages of a conversation that were archived
+        by the retention policy.
+
+        Args:
+            data (dict): The received data containing the peer, or the room.
+        """
+        if "room" in data:
+            if not self.rooms.is_member(data["room"], self.username):
+                self._send_room_error(data["room"], "You are not a member of this room")
+                return
+            self.deliver_in_batches(
+                "get_archive",
+                self._history().get_archived_room_history(data["room"]),
+                room=data["room"],
+            )
+            return
+
+        self.deliver_in_batches(
+            "get_archive",
+            self._history().get_archived_history(self.username, data["peer"]),
+            peer=data["peer"],
+        )
+
     def _handle_chat(self, data: dict[str, str]) -> None:
         """
         Handle chat messages (both private and broadcast).
@@ -280,19 +913,27 @@ class RequestHandler(socketserver.BaseRequestHandler):
         Args:
             data (dict): The received data containing the private chat message and its recipient.
         """
-        with RequestHandler.clients_lock:
-            if data["peer"] in RequestHandler.clients:
-                send(
-                    RequestHandler.clients[data["peer"]].request,
-                    {
-                        "type": "private_message",
-                        "peer": self.username,
-                        "message": data["message"],
-                    },
-                )
-        self.chat_history.append_to_history(
-            self.username, data["peer"], data["message"]
+        trace: RequestTrace = current_trace()
+        peer_online: bool = self._send_to_user(
+            data["peer"],
+            {
+                "type": "private_message",
+                "peer": self.username,
+                "message": data["message"],
+            },
         )
+        if not peer_online and self.user_manager.exists(data["peer"]):
+            with trace.stage("persist"):
+                if self.cluster:
+                    self.cluster.add_offline_message(
+                        data["peer"], self.username, data["message"]
+                    )
+                else:
+                    self.offline_inbox.add(data["peer"], self.username, data["message"])
+        with trace.stage("persist"):
+            self._history().append_to_history(
+                self.username, data["peer"], data["message"]
+            )
 
     def _handle_broadcast_chat(self, data: dict[str, str]) -> None:
         """
@@ -301,20 +942,141 @@ class RequestHandler(socketserver.BaseRequestHandler):
         Args:
             data (dict): The received data containing the broadcast chat message.
         """
-        with RequestHandler.clients_lock:
-            logger.debug(f"You're inside the clients lock")
-            for user in RequestHandler.clients.keys():
-                if user != self.username:
-                    send(
-                        RequestHandler.clients[user].request,
-                        {
-                            "type": "broadcast_message",
-                            "peer": self.username,
-                            "message": data["message"],
-                        },
-                    )
-        logger.debug("You're outside the clients lock")
-        self.chat_history.append_to_history(self.username, "", data["message"])
+        message: dict[str, Any] = {
+            "type": "broadcast_message",
+            "peer": self.username,
+            "message": data["message"],
+        }
+        self.deliver_to_all(message, exclude=self.username)
+        if self.cluster:
+            self.cluster.send_to_all(message, exclude=self.username)
+        with current_trace().stage("persist"):
+            self._history().append_to_history(self.username, "", data["message"])
+
+    def _handle_join_room(self, data: dict[str, str]) -> None:
+        """
+        Handle requests to join a room, creating it if it doesn't exist.
+
+        Args:
+            data (dict): The received data containing the room name.
+        """
+        room: str = data.get("room", "")
+        if not is_valid_room_name(room):
+            self._send_room_error(room, "Invalid room name")
+            return
+
+        if self.rooms.join(room, self.username):
+            self._notify_room(room, {"type": "peer_joined_room", "room": room})
+        self.deliver(
+            {
+                "type": "room_joined",
+                "room": room,
+                "members": sorted(self.rooms.members(room)),
+            }
+        )
+
+    def _handle_leave_room(self, data: dict[str, str]) -> None:
+        """
+        Handle requests to leave a room.
+
+        Args:
+            data (dict): The received data containing the room name.
+        """
+        room: str = data.get("room", "")
+        if self.rooms.leave(room, self.username):
+            self._notify_room(room, {"type": "peer_left_room", "room": room})
+        self.deliver({"type": "room_left", "room": room})
+
+    def _handle_list_rooms(self, data: dict[str, str]) -> None:
+        """
+        Handle request for the list of rooms and their member counts.
+
+        Args:
+            data (dict): The received data (unused in this method).
+        """
+        rooms: list[list[Any]] = [
+            [room, count] for room, count in sorted(self.rooms.rooms().items())
+        ]
+        self.deliver_in_batches("list_rooms", rooms)
+
+    def _handle_room_chat(self, data: dict[str, str]) -> None:
+        """
+        Handle chat messages sent to a room. Only members of the room receive
+        the message, so the cost scales with the room's size.
+
+        Args:
+            data (dict): The received data containing the room name and message.
+        """
+        room: str = data["room"]
+        if not self.rooms.is_member(room, self.username):
+            self._send_room_error(room, "You are not a member of this room")
+            return
+
+        self._notify_room(
+            room, {"type": "room_message", "room": room, "message": data["message"]}
+        )
+        with current_trace().stage("persist"):
+            self._history().append_to_room_history(
+                room, self.username, data["message"]
+            )
+
+    def _handle_search(self, data: dict[str, Any]) -> None:
+        """
+        Handle full-text searches of chat history. Only conversations the user
+        takes part in are searched: the global chat, their private chats, and
+        the rooms they are currently in.
+
+        Args:
+            data (dict): The received data containing the "query", an optional
+                "peer" or "room" to search only that conversation, and optional
+                zero-based "page" and "page_size".
+        """
+        query: str = str(data.get("query", ""))
+        page: int = max(0, int(data.get("page", 0)))
+        page_size: int = min(max(1, int(data.get("page_size", 20))), MAX_SEARCH_PAGE_SIZE)
+
+        rooms: list[str]
+        peers: list[str] | None
+        if "room" in data:
+            if not self.rooms.is_member(data["room"], self.username):
+                self._send_room_error(data["room"], "You are not a member of this room")
+                return
+            rooms, peers = [data["room"]], []
+        elif "peer" in data:
+            rooms, peers = [], [data["peer"]]
+        else:
+            rooms, peers = sorted(self.rooms.rooms_of(self.username)), None
+
+        with current_trace().stage("search"):
+            total, results = self._history().search(
+                query, self.username, rooms, peers, (page + 1) * page_size
+            )
+        self.deliver_in_batches(
+            "search_results",
+            results[page * page_size :],
+            query=query,
+            page=page,
+            total=total,
+        )
+
+    def _send_room_error(self, room: str, reason: str) -> None:
+        self.deliver({"type": "room_error", "room": room, "reason": reason})
+
+    def _send_to_user(self, username: str, data: dict[str, Any], file_peer: str = "") -> bool:
+        """
+        Send a message to a user connected to this server or, in a cluster,
+        to any other node.
+
+        Returns:
+            bool: True if the user is online, False otherwise.
+        """
+        if self.deliver_to_user(username, data, file_peer):
+            return True
+        return bool(self.cluster and self.cluster.send_to_user(username, data, file_peer))
+
+    def _history(self) -> ChatHistory | ClusterNode:
+        # In a cluster, history is partitioned across nodes by conversation
+        return self.cluster or self.chat_history
 
     def _handle_file_request(self, data: dict[str, str]) -> None:
         """
@@ -323,28 +1085,29 @@ class RequestHandler(socketserver.BaseRequestHandler):
         Args:
             data (dict): The received data containing file transfer request information.
         """
-        with RequestHandler.clients_lock:
-            if data["peer"] in RequestHandler.clients:
-                RequestHandler.clients[data["peer"]].file_peer = self.username
-                send(
-                    RequestHandler.clients[data["peer"]].request,
-                    {
-                        "type": "file_request",
-                        "peer": self.username,
-                        "filename": data["filename"],
-                        "size": data["size"],
-                        "md5": data["md5"],
-                    },
-                )
-            else:
-                send(
-                    self.request,
-                    {
-                        "type": "file_response",
-                        "response": "error",
-                        "reason": "Peer not found or not connected",
-                    },
-                )
+        request: dict[str, Any] = {
+            "type": "file_request",
+            "peer": self.username,
+            "filename": data["filename"],
+            "size": data["size"],
+        }
+        if isinstance(data.get("md5"), str):
+            # Sent by older clients
+            request["md5"] = data["md5"]
+        if isinstance(data.get("hashes"), dict):
+            # Digests in further algorithms, for the receiver to choose from
+            request["hashes"] = data["hashes"]
+        if isinstance(data.get("chunk_size"), int):
+            # The sender can send only the chunks the receiver is missing
+            request["chunk_size"] = data["chunk_size"]
+        if not self._send_to_user(data["peer"], request, file_peer=self.username):
+            self.deliver(
+                {
+                    "type": "file_response",
+                    "response": "error",
+                    "reason": "Peer not found or not connected",
+                },
+            )
 
     def _handle_file_response(self, data: dict[str, str]) -> None:
         """
@@ -355,25 +1118,64 @@ class RequestHandler(socketserver.BaseRequestHandler):
         """
         if data["peer"] == self.file_peer:
             self.file_peer = ""
-            with RequestHandler.clients_lock:
-                if data["peer"] in RequestHandler.clients:
-                    response = {
-                        "type": "file_response",
-                        "peer": self.username,
-                        "response": data["response"],
-                    }
-                    if data["response"] == "accept":
-                        response["ip"] = self.client_address[0]
-                    send(RequestHandler.clients[data["peer"]].request, response)
+            response: dict[str, Any] = {
+                "type": "file_response",
+                "peer": self.username,
+                "response": data["response"],
+            }
+            if data["response"] == "accept":
+                response["ip"] = self.client_address[0]
+                if data.get("chunked") is True:
+                    response["chunked"] = True
+            self._send_to_user(data["peer"], response)
+
+    def _handle_get_offline(self, data: dict[str, str]) -> None:
+        """
+        Handle request for private messages received while the user was offline.
+        The inbox is emptied once delivered.
+
+        Args:
+            data (dict): The received data (unused in this method).
+        """
+        pending = (
+            self.cluster.drain_offline_messages(self.username)
+            if self.cluster
+            else self.offline_inbox.drain(self.username)
+        )
+        messages = [
+            (sender, time.strftime("%m/%d %H:%M", time.localtime(timestamp)), message)
+            for sender, timestamp, message in pending
+        ]
+        self.deliver_in_batches("offline_messages", messages)
+
+    def _handle_pong(self, data: dict[str, str]) -> None:
+        """
+        Handle heartbeat replies. Receiving any frame already marks the
+        connection as alive, so there is nothing left to do.
+
+        Args:
+            data (dict): The received data (unused in this method).
+        """
 
     def _handle_close(self, data: dict[str, str]) -> None:
         """
-        Handle client disconnection requests.
+        Handle client disconnection requests. Shutting down the socket ends
+        the receive loop, after which `finish` cleans up once, as for any
+        other disconnection.
 
         Args:
             data (dict): The received data (unused in this method).
         """
-        self.finish()
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+OPEN_CONNECTIONS.set_function(lambda: len(RequestHandler.heartbeat))
+CONNECTED_CLIENTS.set_function(lambda: len(RequestHandler.clients))
+LOG_QUEUE_RECORDS.set_function(queued_log_records)
+RATE_LIMITED_USERS.set_function(lambda: len(RequestHandler.rate_limiter))
 
 
 if __name__ == "__main__":
@@ -381,9 +1183,65 @@ if __name__ == "__main__":
         load_dotenv(override=True)
         port: int = int(os.environ.get("SERVER_PORT", 8888)) or 8888
 
+        # Expose Prometheus metrics on localhost if a port is configured
+        metrics_port: int = int(os.environ.get("METRICS_PORT", 0))
+        if metrics_port:
+            start_metrics_server(
+                os.environ.get("METRICS_HOST", "127.0.0.1"), metrics_port
+            )
+
+        # Profile on SIGUSR1 and toggle request tracing on SIGUSR2
+        install_signal_handlers(
+            RequestHandler.tracer,
+            SamplingProfiler(
+                STORAGE_DIR,
+                float(os.environ.get("PROFILE_INTERVAL_MS", 10)) / 1000,
+                float(os.environ.get("PROFILE_SECONDS", 30)),
+            ),
+        )
+
+        # Join the cluster if this server is one of several nodes
+        if CLUSTER_NODE_ID:
+            # Peers can read any conversation and create accounts, so they
+            # must prove they know the secret
+            if not CLUSTER_SECRET:
+                logger.critical("CLUSTER_SECRET must be set to run in cluster mode")
+                sys.exit(1)
+            host, cluster_port = CLUSTER_LISTEN.rsplit(":", 1)
+            cluster: ClusterNode = ClusterNode(
+                TcpMeshBus(
+                    CLUSTER_NODE_ID,
+                    (host, int(cluster_port)),
+                    parse_peers(CLUSTER_PEERS),
+                    CLUSTER_SECRET,
+                ),
+                RequestHandler,
+                CLUSTER_TIMEOUT,
+            )
+            RequestHandler.cluster = cluster
+            REMOTE_USERS.set_function(lambda: len(cluster.remote_users))
+            cluster.start()
+
+        # Archive old messages according to the retention policies
+        HistoryCompactor(
+            RequestHandler.chat_history,
+            RetentionPolicy(
+                HISTORY_RETENTION_DAYS * 24 * 60 * 60, HISTORY_RETENTION_MESSAGES
+            ),
+            STORAGE_DIR / "retention.json",
+            HISTORY_COMPACT_INTERVAL,
+        ).start()
+
+        # Record inbound traffic for replay with tools.replay_traffic
+        if RECORD_TRAFFIC_PATH:
+            RequestHandler.recorder = TrafficRecorder(Path(RECORD_TRAFFIC_PATH))
+
         # Start the server
-        app: socketserver.ThreadingTCPServer = socketserver.ThreadingTCPServer(
-            ("0.0.0.0", port), RequestHandler
+        app: ChatServer = ChatServer(
+            ("0.0.0.0", port),
+            RequestHandler,
+            AdmissionControl(MAX_CONNECTIONS, MAX_CONNECTIONS_PER_IP),
+            LISTEN_BACKLOG,
         )
         logger.info(f"Server started on 0.0.0.0:{port}")
         app.serve_forever()
@@ -394,4 +1252,6 @@ if __name__ == "__main__":
     finally:
         if "app" in locals():
             app.server_close()
+        if RequestHandler.recorder:
+            RequestHandler.recorder.close()
         logger.info("Server shut down")
@@ -0,0 +1,247 @@
+import os
+import re
+import sys
+import json
+import time
+import signal
+import threading
+import logging
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+from types import FrameType
+from typing import ContextManager, Iterator
+from server.metrics import REQUEST_STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Thread-local storage for the trace of the request being handled on this thread
+_local = threading.local()
+
+
+class RequestTrace:
+    """
+    Per-request record of how long each stage of a message's life took.
+
+    Stage durations accumulate, so a stage entered several times (such as
+    "send" during a fan-out) reports its total. Stages may nest: "dispatch"
+    includes "persist", "fanout" and "send".
+    """
+
+    __slots__ = ("command", "stages", "start")
+
+    def __init__(self) -> None:
+        self.command: str = ""
+        self.stages: dict[str, float] = {}
+        self.start: float = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start: float = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name: str, seconds: float) -> None:
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+
+class _NullTrace(RequestTrace):
+    """Stand-in used when tracing is disabled; records nothing."""
+
+    _context: ContextManager[None] = nullcontext()
+
+    def stage(self, name: str) -> ContextManager[None]:  # type: ignore[override]
+        return self._context
+
+    def add(self, name: str, seconds: float) -> None:
+        pass
+
+
+NULL_TRACE: RequestTrace = _NullTrace()
+
+
+def current_trace() -> RequestTrace:
+    """
+    Get the trace of the request being handled on the calling thread.
+
+    Returns:
+        The active trace, or a no-op trace if tracing is disabled.
+    """
+    return getattr(_local, "trace", NULL_TRACE)
+
+
+class Tracer:
+    def __init__(self, enabled: bool, slow_threshold: float, filepath: Path) -> None:
+        """
+        Args:
+            enabled: Whether to trace requests from startup.
+            slow_threshold: Requests slower than this many seconds are written
+                to the slow request log.
+            filepath: Path of the rotating slow request log.
+        """
+        self.enabled: bool = enabled
+        self.slow_threshold: float = slow_threshold
+        self.filepath: Path = filepath
+        self._slow_logger: logging.Logger | None = None
+        self._slow_logger_lock: threading.Lock = threading.Lock()
+
+    def start(self) -> RequestTrace:
+        """
+        Begin tracing a request on the calling thread.
+
+        Returns:
+            A new trace, or a no-op trace if tracing is disabled.
+        """
+        trace: RequestTrace = RequestTrace() if self.enabled else NULL_TRACE
+        _local.trace = trace
+        return trace
+
+    def finish(self, trace: RequestTrace, username: str) -> None:
+        """
+        Record a completed trace and write it to the slow request log if it
+        exceeded the threshold.
+
+        Args:
+            trace: The trace returned by `start`.
+            username: The user who sent the request, if authenticated.
+        """
+        _local.trace = NULL_TRACE
+        if trace is NULL_TRACE:
+            return
+
+        total: float = trace.elapsed()
+        command: str = trace.command or "unknown"
+        for stage, seconds in trace.stages.items():
+            REQUEST_STAGE_SECONDS.labels(command, stage).observe(seconds)
+        REQUEST_STAGE_SECONDS.labels(command, "total").observe(total)
+
+        if total >= self.slow_threshold:
+            self._get_slow_logger().info(
+                json.dumps(
+                    {
+                        "time": time.time(),
+                        "username": username,
+                        "command": command,
+                        "total_ms": round(total * 1000, 3),
+                        "stages_ms": {
+                            stage: round(seconds * 1000, 3)
+                            for stage, seconds in trace.stages.items()
+                        },
+                    }
+                )
+            )
+
+    def toggle(self) -> None:
+        self.enabled = not self.enabled
+        logger.info(f"Request tracing {'enabled' if self.enabled else 'disabled'}")
+
+    def _get_slow_logger(self) -> logging.Logger:
+        # Create the log file lazily, so that it only exists once something is slow
+        with self._slow_logger_lock:
+            if self._slow_logger is None:
+                handler = RotatingFileHandler(
+                    self.filepath, maxBytes=10 * 1024 * 1024, backupCount=5
+                )
+                handler.setFormatter(logging.Formatter("%(message)s"))
+                slow_logger = logging.getLogger(f"{__name__}.slow_requests")
+                slow_logger.setLevel(logging.INFO)
+                slow_logger.propagate = False
+                slow_logger.addHandler(handler)
+                self._slow_logger = slow_logger
+            return self._slow_logger
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler that periodically samples the stacks of all threads.
+
+    Unlike cProfile, which only sees the thread that enabled it, this covers
+    every connection thread. Results are written in collapsed-stack format,
+    which flame graph tools such as `flamegraph.pl` and speedscope accept.
+    """
+
+    def __init__(self, output_dir: Path, interval: float, duration: float) -> None:
+        """
+        Args:
+            output_dir: Directory to write profiles to.
+            interval: Seconds between samples.
+            duration: Seconds to profile for before writing the results.
+        """
+        self.output_dir: Path = output_dir
+        self.interval: float = interval
+        self.duration: float = duration
+        self._stop_event: threading.Event = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        if self.is_running():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        logger.info(f"Sampling profiler started for {self.duration}s")
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+    def _run(self) -> None:
+        samples: Counter[str] = Counter()
+        own_thread: int = threading.get_ident()
+        thread_names: dict[int, str] = {}
+        deadline: float = time.monotonic() + self.duration
+
+        while time.monotonic() < deadline and not self._stop_event.wait(self.interval):
+            if len(thread_names) != threading.active_count():
+                thread_names = {t.ident: t.name for t in threading.enumerate() if t.ident}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                stack: list[str] = []
+                current: FrameType | None = frame
+                while current is not None:
+                    code = current.f_code
+                    stack.append(
+                        f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                    )
+                    current = current.f_back
+                # Strip thread numbers so that connection threads aggregate together
+                stack.append(re.sub(r"-\d+", "", thread_names.get(thread_id, "unknown")))
+                samples[";".join(reversed(stack))] += 1
+
+        filepath = self.output_dir / f"profile-{time.strftime('%Y%m%d-%H%M%S')}.folded"
+        with open(filepath, "w") as f:
+            for stack_key, count in samples.most_common():
+                f.write(f"{stack_key} {count}\n")
+        logger.info(f"Wrote {sum(samples.values())} profile samples to {filepath}")
+
+
+def install_signal_handlers(tracer: Tracer, profiler: SamplingProfiler) -> None:
+    """
+    Toggle request tracing on SIGUSR2, and start (or stop early) the sampling
+    profiler on SIGUSR1. Must be called from the main thread.
+
+    Args:
+        tracer: The tracer to toggle.
+        profiler: The profiler to control.
+    """
+    if not hasattr(signal, "SIGUSR1"):
+        logger.warning("Signals are not supported on this platform; profiling disabled")
+        return
+
+    def handle_profile_signal(signum: int, frame: object) -> None:
+        if profiler.is_running():
+            profiler.stop()
+        else:
+            profiler.start()
+
+    signal.signal(signal.SIGUSR1, handle_profile_signal)
+    signal.signal(signal.SIGUSR2, lambda signum, frame: tracer.toggle())
@@ -0,0 +1,176 @@
+import gzip
+import json
+import base64
+import binascii
+import time
+import queue
+import struct
+import threading
+import logging
+from pathlib import Path
+from typing import Any, Iterator
+from server.metrics import TRAFFIC_RECORDED, TRAFFIC_DROPPED
+
+logger = logging.getLogger(__name__)
+
+# File signature and format version
+MAGIC: bytes = b"NCRTRAF1"
+
+# Record kinds
+OPENED: int = 0
+FRAME: int = 1
+CLOSED: int = 2
+
+# Kind, seconds since recording started, connection ID, payload length
+RECORD_HEADER: struct.Struct = struct.Struct(">BdII")
+
+# Fields blanked before a frame is written, by command. Resume frames also
+# get the (unverified) username from their session token, so that a replay
+# can log the same user in.
+SECRET_FIELDS: dict[str, tuple[str, ...]] = {
+    "login": ("password",),
+    "register": ("password",),
+    "resume": ("token",),
+    "batch_register": ("token",),
+}
+
+# A recorded event: (kind, seconds since start, connection ID, decoded frame)
+TrafficRecord = tuple[int, float, int, dict[str, Any] | None]
+
+
+class TrafficRecorder:
+    """
+    Records every decoded inbound frame, and when each connection opened and
+    closed, to a gzip-compressed file that `tools.replay_traffic` can replay
+    against a local server.
+
+    Handler threads only queue records; a writer thread compresses and writes
+    them, so a slow disk never delays request handling. If the queue fills
+    up, records are dropped and counted rather than blocking. Passwords,
+    session tokens and admin tokens are blanked before anything is written.
+    """
+
+    def __init__(self, filepath: Path, max_queued: int = 100_000) -> None:
+        """
+        Args:
+            filepath: Path of the recording; an existing file is overwritten.
+            max_queued: Maximum records waiting to be written before new ones
+                are dropped.
+        """
+        self.filepath: Path = filepath
+        self._queue: queue.Queue[tuple[int, float, int, bytes] | None] = queue.Queue(
+            max_queued
+        )
+        self._start: float = time.monotonic()
+        self._thread: threading.Thread = threading.Thread(
+            target=self._write_loop, name="Traffic recorder", daemon=True
+        )
+        self._thread.start()
+        logger.info(f"Recording traffic to {filepath}")
+
+    def opened(self, connection_id: int) -> None:
+        self._put(OPENED, connection_id, b"")
+
+    def closed(self, connection_id: int) -> None:
+        self._put(CLOSED, connection_id, b"")
+
+    def frame(self, connection_id: int, data: dict[str, Any], plaintext: bytes) -> None:
+        """
+        Record a frame received on a connection.
+
+        Args:
+            connection_id: The connection the frame arrived on.
+            data: The decoded frame.
+            plaintext: The frame's JSON, stored as is unless it holds secrets.
+        """
+        command: str = str(data.get("command", ""))
+        secrets: tuple[str, ...] = SECRET_FIELDS.get(command, ())
+        if secrets:
+            redacted: dict[str, Any] = dict(data)
+            if command == "resume":
+                redacted["username"] = _token_username(str(data.get("token", "")))
+            for field in secrets:
+                if field in redacted:
+                    redacted[field] = ""
+            if "accounts" in redacted:
+                redacted["accounts"] = [
+                    [account[0], ""] for account in redacted["accounts"] if account
+                ]
+            plaintext = json.dumps(redacted, separators=(",", ":")).encode("utf-8")
+        self._put(FRAME, connection_id, plaintext)
+
+    def close(self) -> None:
+        """Write the remaining records and close the file."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _put(self, kind: int, connection_id: int, payload: bytes) -> None:
+        try:
+            self._queue.put_nowait(
+                (kind, time.monotonic() - self._start, connection_id, payload)
+            )
+        except queue.Full:
+            TRAFFIC_DROPPED.inc()
+        else:
+            TRAFFIC_RECORDED.inc()
+
+    def _write_loop(self) -> None:
+        with gzip.open(self.filepath, "wb") as f:
+            f.write(MAGIC)
+            while True:
+                try:
+                    record = self._queue.get(timeout=1)
+                except queue.Empty:
+                    # Make what has been recorded so far readable
+                    f.flush()
+                    continue
+                if record is None:
+                    break
+                kind, elapsed, connection_id, payload = record
+                f.write(RECORD_HEADER.pack(kind, elapsed, connection_id, len(payload)))
+                f.write(payload)
+        logger.info(f"Stopped recording traffic to {self.filepath}")
+
+
+def _token_username(token: str) -> str:
+    # Session tokens start with the base64-encoded username
+    try:
+        return base64.urlsafe_b64decode(token.split(".")[0]).decode("utf-8")
+    except (binascii.Error, UnicodeDecodeError):
+        return ""
+
+
+def read_traffic(filepath: Path) -> Iterator[TrafficRecord]:
+    """
+    Read a recording made by `TrafficRecorder`. A recording cut short, such
+    as by the server being killed, is read up to its last complete record.
+
+    Args:
+        filepath: Path of the recording.
+
+    Yields:
+        (kind, seconds since start, connection ID, frame) tuples in the order
+        they were recorded; the frame is None for OPENED and CLOSED records.
+
+    Raises:
+        ValueError: If the file isn't a traffic recording.
+    """
+    with gzip.open(filepath, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{filepath} is not a traffic recording")
+        try:
+            while header := f.read(RECORD_HEADER.size):
+                if len(header) < RECORD_HEADER.size:
+                    break
+                kind, elapsed, connection_id, length = RECORD_HEADER.unpack(header)
+                payload: bytes = f.read(length)
+                if len(payload) < length:
+                    break
+                yield (
+                    kind,
+                    elapsed,
+                    connection_id,
+                    json.loads(payload) if kind == FRAME else None,
+                )
+        except EOFError:
+            logger.warning(f"{filepath} ends with an incomplete record")
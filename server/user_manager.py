@@ -1,10 +1,17 @@
 import os
+import json
+import time
+import zlib
+import hmac
+import hashlib
 import traceback
 import pickle
 import threading
 import logging
 from pathlib import Path
 from dotenv import load_dotenv
+from server.passwords import PasswordHasher
+from server.metrics import LOGIN_VALIDATIONS
 
 load_dotenv()
 
@@ -12,35 +19,161 @@ load_dotenv()
 STORAGE_DIR: Path = Path.cwd() / os.getenv("STORAGE_DIR", ".ncr-data")
 STORAGE_DIR.mkdir(exist_ok=True)
 
+PASSWORD_HASH_ITERATIONS = int(os.getenv("PASSWORD_HASH_ITERATIONS", 600_000))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", os.cpu_count() or 1))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", 256))
+LOGIN_CACHE_TTL = float(os.getenv("LOGIN_CACHE_TTL", 300))
+
 logger = logging.getLogger(__name__)
 
 
 class UserManager:
+    """
+    Stores user accounts with salted password hashes.
+
+    Accounts are kept in an append-only log of JSON lines, each with a CRC32
+    checksum, so registering a user writes a single line instead of rewriting
+    the whole store. Later lines for a user replace earlier ones. On load,
+    lines that fail their checksum are skipped, a partially written last line
+    is truncated, and the log is compacted if it has accumulated many
+    superseded lines.
+
+    Hashing is CPU-heavy, so it runs on the hasher's worker pool without
+    holding `self.lock`; the lock only guards reads and writes of the users
+    dict. Successful logins are remembered for `LOGIN_CACHE_TTL` seconds, so
+    a client that reconnects doesn't pay for another hash.
+    """
+
     def __init__(self) -> None:
         self.lock: threading.Lock = threading.Lock()
-        self.users_filepath: Path = STORAGE_DIR / "users.dat"
+        self.users_filepath: Path = STORAGE_DIR / "users.log"
+        # Pickled store used by earlier versions, migrated on first load
+        self.legacy_filepath: Path = STORAGE_DIR / "users.dat"
+        # Maps usernames to password hash records (or legacy plaintext passwords)
         self.users: dict[str, str] = self.load_users()
+        self._log = open(self.users_filepath, "a", encoding="utf-8")
+        self.hasher: PasswordHasher = PasswordHasher(
+            PASSWORD_HASH_ITERATIONS, PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING
+        )
+
+        # Maps usernames to (credential fingerprint, expiry time) of recent logins
+        self._login_cache: dict[str, tuple[bytes, float]] = {}
+        self._cache_key: bytes = os.urandom(32)
+        # A hash to check unknown usernames against, so they take as long as known ones
+        self._dummy_record: str = self.hasher.hash(os.urandom(16).hex())
 
         # Log absolute path of users file
         logger.debug(f"Users file path: {self.users_filepath.absolute()}")
 
     def load_users(self) -> dict[str, str]:
         """
-        Load user data from a file.
+        Load user data from the log, migrating the legacy pickled store if
+        there is no log yet.
 
         Returns:
-            A dictionary containing user data, or an empty dictionary if the file doesn't exist.
+            A dictionary containing user data, or an empty dictionary if there
+            is no stored data.
         """
-        try:
-            with open(self.users_filepath, "rb") as f:
-                users = pickle.load(f)
-            return users
-        except (FileNotFoundError, pickle.UnpicklingError) as e:
+        if not self.users_filepath.exists():
+            self._migrate_legacy_store()
+        if not self.users_filepath.exists():
             logger.warning(
                 f"Failed to load {self.users_filepath.name}; file will be created"
             )
             return {}
 
+        users: dict[str, str] = {}
+        lines: int = 0
+        corrupt: int = 0
+        torn_bytes: int = 0
+        with open(self.users_filepath, "rb") as f:
+            for line in f:
+                lines += 1
+                if not line.endswith(b"\n"):
+                    # Only the last line can be missing its newline
+                    torn_bytes = len(line)
+                    break
+                entry: tuple[str, str] | None = self._decode(line)
+                if entry is None:
+                    corrupt += 1
+                    logger.error(
+                        f"Skipping corrupt line {lines} in {self.users_filepath.name}"
+                    )
+                    continue
+                users[entry[0]] = entry[1]
+
+        if torn_bytes:
+            logger.warning(
+                f"Truncating partially written last line of {self.users_filepath.name}"
+            )
+            with open(self.users_filepath, "rb+") as f:
+                f.truncate(self.users_filepath.stat().st_size - torn_bytes)
+        if lines - corrupt > 2 * len(users) + 100:
+            self._rewrite(users)
+        logger.info(f"Loaded {len(users)} users from {self.users_filepath.name}")
+        return users
+
+    def _migrate_legacy_store(self) -> None:
+        try:
+            with open(self.legacy_filepath, "rb") as f:
+                users: dict[str, str] = pickle.load(f)
+        except (FileNotFoundError, pickle.UnpicklingError):
+            return
+        self._rewrite(users)
+        self.legacy_filepath.rename(self.legacy_filepath.with_suffix(".dat.migrated"))
+        logger.info(
+            f"Migrated {len(users)} users from {self.legacy_filepath.name} "
+            f"to {self.users_filepath.name}"
+        )
+
+    def _rewrite(self, users: dict[str, str]) -> None:
+        """Atomically replace the log with one line per user."""
+        temp_filepath: Path = self.users_filepath.with_suffix(".tmp")
+        with open(temp_filepath, "w", encoding="utf-8") as f:
+            f.writelines(self._encode(username, record) for username, record in users.items())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_filepath, self.users_filepath)
+
+    @staticmethod
+    def _checksum(username: str, record: str) -> int:
+        return zlib.crc32(f"{username}\0{record}".encode("utf-8"))
+
+    def _encode(self, username: str, record: str) -> str:
+        return (
+            json.dumps(
+                {
+                    "username": username,
+                    "record": record,
+                    "crc": self._checksum(username, record),
+                }
+            )
+            + "\n"
+        )
+
+    def _decode(self, line: bytes) -> tuple[str, str] | None:
+        try:
+            entry = json.loads(line)
+            username, record = entry["username"], entry["record"]
+            if entry["crc"] != self._checksum(username, record):
+                return None
+        except (ValueError, KeyError, TypeError):
+            return None
+        return username, record
+
+    def _append(self, entries: list[tuple[str, str]]) -> None:
+        """
+        Durably append records to the log. Must be called with the lock held.
+
+        Args:
+            entries: (username, record) pairs to write.
+        """
+        if not entries:
+            return
+        self._log.write("".join(self._encode(username, record) for username, record in entries))
+        self._log.flush()
+        os.fsync(self._log.fileno())
+
     def register(self, username: str, password: str) -> bool:
         """
         Register a new user.
@@ -53,14 +186,81 @@ class UserManager:
             True if registration is successful, False if the username already exists.
         """
         logger.debug(f"Attempting to register user: {username}")
-        with self.lock:
-            if username not in self.users:
-                self.users[username] = password
-                self.save_users()
-                logger.info(f"User {username} registered successfully")
-                return True
+        if self.exists(username):
             logger.warning(f"Registration failed: Username {username} already exists")
             return False
+        return self.add_record(username, self.hasher.hash(password))
+
+    def add_record(self, username: str, record: str) -> bool:
+        """
+        Add a user with an already-hashed password, as replicated from another
+        cluster node.
+
+        Args:
+            username: The username to register.
+            record: The password hash record.
+
+        Returns:
+            True if the user was added, False if the username already exists.
+        """
+        with self.lock:
+            if username in self.users:
+                logger.warning(
+                    f"Registration failed: Username {username} already exists"
+                )
+                return False
+            self.users[username] = record
+            self._append([(username, record)])
+        logger.info(f"User {username} registered successfully")
+        return True
+
+    def add_records(self, entries: list[tuple[str, str]]) -> list[tuple[str, str]]:
+        """
+        Add many users with already-hashed passwords in a single append.
+
+        Args:
+            entries: (username, record) pairs to add.
+
+        Returns:
+            The pairs that were added; usernames that already exist are skipped.
+        """
+        with self.lock:
+            added: list[tuple[str, str]] = []
+            for username, record in entries:
+                if username not in self.users:
+                    self.users[username] = record
+                    added.append((username, record))
+            self._append(added)
+        return added
+
+    def register_many(self, accounts: list[tuple[str, str]]) -> list[tuple[str, str]]:
+        """
+        Register many users at once, hashing their passwords in parallel and
+        writing them to the log in a single append.
+
+        Args:
+            accounts: (username, password) pairs to register.
+
+        Returns:
+            The (username, record) pairs that were added; usernames that already
+            exist or appear earlier in `accounts` are skipped.
+        """
+        seen: set[str] = set()
+        new: list[tuple[str, str]] = []
+        for username, password in accounts:
+            if username not in seen and not self.exists(username):
+                new.append((username, password))
+            seen.add(username)
+
+        records: list[str] = self.hasher.hash_many([password for _, password in new])
+        added: list[tuple[str, str]] = self.add_records(
+            [(username, record) for (username, _), record in zip(new, records)]
+        )
+        logger.info(f"Registered {len(added)} of {len(accounts)} users in bulk")
+        return added
+
+    def get_record(self, username: str) -> str:
+        return self.users.get(username, "")
 
     def validate(self, username: str, password: str) -> bool:
         """
@@ -72,15 +272,60 @@ class UserManager:
 
         Returns:
             True if credentials are valid, False otherwise.
+
+        Raises:
+            HasherBusyError: If too many logins are already being validated.
         """
+        fingerprint: bytes = hmac.digest(
+            self._cache_key, f"{username}\0{password}".encode("utf-8"), hashlib.sha256
+        )
+        cached: tuple[bytes, float] | None = self._login_cache.get(username)
+        if (
+            cached
+            and cached[1] > time.monotonic()
+            and hmac.compare_digest(cached[0], fingerprint)
+        ):
+            LOGIN_VALIDATIONS.labels("cached").inc()
+            logger.debug("Validating user %s: Success (cached)", username)
+            return True
+
         with self.lock:
-            is_valid = username in self.users and self.users[username] == password
-            logger.debug(
-                f"Validating user {username}: {'Success' if is_valid else 'Failed'}"
-            )
-            return is_valid
+            record: str | None = self.users.get(username)
+        try:
+            is_valid: bool = self.hasher.verify(password, record or self._dummy_record)
+        except Exception:
+            LOGIN_VALIDATIONS.labels("busy").inc()
+            raise
+        is_valid = is_valid and record is not None
+        LOGIN_VALIDATIONS.labels("ok" if is_valid else "fail").inc()
+        logger.debug(
+            "Validating user %s: %s", username, "Success" if is_valid else "Failed"
+        )
 
-    def save_users(self) -> None:
-        logger.debug("Saving users to file")
-        with open(self.users_filepath, "wb") as f:
-            pickle.dump(self.users, f)
+        if is_valid:
+            self._login_cache[username] = (fingerprint, time.monotonic() + LOGIN_CACHE_TTL)
+            if record is not None and self.hasher.needs_rehash(record):
+                self._rehash(username, password, record)
+        return is_valid
+
+    def _rehash(self, username: str, password: str, record: str) -> None:
+        """Upgrade a plaintext or outdated password record after a successful login."""
+        new_record: str = self.hasher.hash(password)
+        with self.lock:
+            # Skip if the record changed while we were hashing
+            if self.users.get(username) == record:
+                self.users[username] = new_record
+                self._append([(username, new_record)])
+                logger.info(f"Upgraded password hash for {username}")
+
+    def exists(self, username: str) -> bool:
+        """
+        Check whether a user is registered.
+
+        Args:
+            username: The username to look up.
+
+        Returns:
+            True if the user is registered, False otherwise.
+        """
+        return username in self.users
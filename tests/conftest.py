@@ -0,0 +1,6 @@
+import os
+import tempfile
+
+# Server modules create their storage directory on import, so point it
+# somewhere disposable before any of them are imported
+os.environ.setdefault("STORAGE_DIR", tempfile.mkdtemp(prefix="ncr-tests-"))
@@ -0,0 +1,208 @@
+import json
+import time
+from pathlib import Path
+from typing import Any, Iterator
+import pytest
+from utils.encryption import MAX_MESSAGE_SIZE
+from server.cluster import ClusterNode, LocalBus, TcpMeshBus
+from server.offline_inbox import OfflineInbox
+
+
+class FakeHistory:
+    """Answers history and search requests with canned messages."""
+
+    def __init__(self, messages: list[list[str]]) -> None:
+        self.messages: list[list[str]] = messages
+
+    def get_history(self, sender: str, receiver: str) -> list[list[str]]:
+        return self.messages
+
+    def search(
+        self, query: str, username: str, rooms: list[str], peers: list[str], limit: int
+    ) -> tuple[int, list[dict[str, Any]]]:
+        results: list[dict[str, Any]] = [
+            {"sender": sender, "message": message} for sender, _, message in self.messages
+        ]
+        return len(results) * 2, results[:limit]
+
+
+class FakeLocal:
+    """A local server with a fixed set of connected users."""
+
+    def __init__(
+        self,
+        usernames: list[str],
+        messages: list[list[str]],
+        offline_inbox: OfflineInbox | None = None,
+    ) -> None:
+        self.usernames: list[str] = usernames
+        self.chat_history: FakeHistory = FakeHistory(messages)
+        self.offline_inbox: OfflineInbox | None = offline_inbox
+        self.delivered: list[dict[str, Any]] = []
+
+    def local_usernames(self) -> list[str]:
+        return self.usernames
+
+    def deliver_to_user(self, username: str, data: dict[str, Any], file_peer: str = "") -> bool:
+        self.delivered.append(data)
+        return True
+
+    def deliver_to_all(self, data: dict[str, Any], exclude: str = "") -> None:
+        self.delivered.append(data)
+
+    def deliver_to_room(self, room: str, data: dict[str, Any], exclude: str = "") -> None:
+        self.delivered.append(data)
+
+
+# Enough messages that a response needs several frames
+MESSAGES: list[list[str]] = [
+    ["alice", "01/01 10:00", f"message {index} " + "x" * 100] for index in range(2000)
+]
+USERNAMES: list[str] = [f"user{index:05}" for index in range(10_000)]
+
+
+@pytest.fixture
+def nodes(tmp_path: Path) -> Iterator[tuple[ClusterNode, ClusterNode]]:
+    hub: dict[str, LocalBus] = {}
+    first: ClusterNode = ClusterNode(LocalBus("a", hub), FakeLocal([], []), timeout=5)  # type: ignore[arg-type]
+    inbox: OfflineInbox = OfflineInbox(tmp_path, 100, 60, 2)
+    second: ClusterNode = ClusterNode(
+        LocalBus("b", hub), FakeLocal(USERNAMES, MESSAGES, inbox), timeout=0.1  # type: ignore[arg-type]
+    )
+    first.start()
+    second.start()
+    yield first, second
+    first.bus.close()
+    second.bus.close()
+
+
+def owned_by(node: ClusterNode, node_id: str) -> tuple[str, str]:
+    """Find a conversation whose history is stored on the given node."""
+    for index in range(100):
+        sender, receiver = "alice", f"peer{index}"
+        if node.owner(node.conversation_partition(sender, receiver)) == node_id:
+            return sender, receiver
+    raise AssertionError(f"No conversation is owned by {node_id}")
+
+
+def inbox_owned_by(node: ClusterNode, node_id: str) -> str:
+    """Find a recipient whose offline inbox is stored on the given node."""
+    for index in range(100):
+        if node.owner(f"@peer{index}") == node_id:
+            return f"peer{index}"
+    raise AssertionError(f"No inbox is owned by {node_id}")
+
+
+def test_response_larger_than_a_frame_is_reassembled(
+    nodes: tuple[ClusterNode, ClusterNode],
+) -> None:
+    first, _ = nodes
+    assert len(json.dumps(MESSAGES)) > 2 * MAX_MESSAGE_SIZE
+    assert first.get_history(*owned_by(first, "b")) == MESSAGES
+    assert not first._pending
+
+
+def test_search_response_keeps_its_fields_across_batches(
+    nodes: tuple[ClusterNode, ClusterNode],
+) -> None:
+    first, _ = nodes
+    responses = first._request_many(
+        ["b"],
+        {
+            "kind": "search",
+            "query": "message",
+            "username": "alice",
+            "rooms": [],
+            "peers": [],
+            "limit": len(MESSAGES),
+        },
+    )
+    assert responses[0] is not None
+    assert responses[0]["total"] == 2 * len(MESSAGES)
+    assert len(responses[0]["data"]) == len(MESSAGES)
+    assert responses[0]["data"][-1]["message"] == MESSAGES[-1][2]
+
+
+def test_presence_of_many_users_is_synced_in_batches(
+    nodes: tuple[ClusterNode, ClusterNode],
+) -> None:
+    first, _ = nodes
+    deadline: float = time.monotonic() + 5
+    while len(first.remote_usernames()) < len(USERNAMES) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert sorted(first.remote_usernames()) == USERNAMES
+
+
+def test_request_to_a_silent_node_times_out() -> None:
+    hub: dict[str, LocalBus] = {}
+    node: ClusterNode = ClusterNode(LocalBus("a", hub), FakeLocal([], []), timeout=0.1)  # type: ignore[arg-type]
+    silent: LocalBus = LocalBus("b", hub)
+    node.start()
+    silent.start(lambda node_id, message: None, lambda node_id: None, lambda node_id: None)
+    try:
+        assert node._request("b", {"kind": "history_get", "sender": "a", "receiver": "b"}) == []
+        assert not node._pending
+    finally:
+        node.bus.close()
+        silent.close()
+
+
+def test_batches_fit_in_a_frame() -> None:
+    batches = ClusterNode._batches({"kind": "presence_sync"}, "usernames", USERNAMES)
+    assert len(batches) > 1
+    assert all(len(json.dumps(batch)) <= MAX_MESSAGE_SIZE for batch in batches)
+    assert [name for batch in batches for name in batch["usernames"]] == USERNAMES
+    assert ClusterNode._batches({"kind": "presence_sync"}, "usernames", []) == [
+        {"kind": "presence_sync", "usernames": []}
+    ]
+
+
+def test_local_bus_rejects_a_message_larger_than_a_frame(
+    nodes: tuple[ClusterNode, ClusterNode],
+) -> None:
+    first, _ = nodes
+    with pytest.raises(ValueError):
+        first.bus.send("b", {"kind": "broadcast", "data": "x" * MAX_MESSAGE_SIZE})
+
+
+def test_tcp_mesh_requires_a_secret() -> None:
+    with pytest.raises(ValueError):
+        TcpMeshBus("a", ("127.0.0.1", 0), {"b": ("127.0.0.1", 1)}, "")
+
+
+def test_offline_messages_drained_from_another_node_are_acknowledged(
+    nodes: tuple[ClusterNode, ClusterNode],
+) -> None:
+    first, second = nodes
+    recipient: str = inbox_owned_by(first, "b")
+    for index in range(3):
+        first.add_offline_message(recipient, "alice", f"message {index}")
+    time.sleep(0.05)
+    drained = first.drain_offline_messages(recipient)
+    assert [message for _, _, message in drained] == ["message 0", "message 1", "message 2"]
+
+    # Once acknowledged, the messages aren't put back
+    time.sleep(0.3)
+    assert not second._unacknowledged
+    assert second.local.offline_inbox.drain(recipient) == []
+
+
+def test_offline_messages_are_restored_if_the_drain_is_not_acknowledged(
+    nodes: tuple[ClusterNode, ClusterNode],
+) -> None:
+    _, second = nodes
+    inbox: OfflineInbox = second.local.offline_inbox
+    for index in range(3):
+        inbox.add("carol", "alice", f"message {index}")
+    # The requester has given up on this request, so it never acknowledges it
+    second._handle_message(
+        "a", {"kind": "inbox_drain", "recipient": "carol", "request_id": "lost"}
+    )
+    inbox.add("carol", "alice", "message 3")
+    time.sleep(0.3)
+    assert [message for _, _, message in inbox.drain("carol")] == [
+        "message 0",
+        "message 1",
+        "message 2",
+        "message 3",
+    ]
@@ -0,0 +1,86 @@
+from server.conversation_log import (
+    ConversationLog,
+    UserTable,
+    format_time,
+    message_times,
+)
+
+RECORDS: list[tuple[str, float, str]] = [
+    ("alice", 1_700_000_000.0, "hello"),
+    ("bob", 1_700_000_030.0, "héllo 🙂"),
+    ("alice", 1_700_000_090.0, ""),
+    ("carol", 1_700_003_600.5, "a longer message\nover two lines"),
+]
+
+
+def make_log(users: UserTable) -> ConversationLog:
+    log: ConversationLog = ConversationLog(users)
+    for record in RECORDS:
+        log.append(*record)
+    return log
+
+
+def test_records_round_trip() -> None:
+    log: ConversationLog = make_log(UserTable())
+    assert len(log) == len(RECORDS)
+    assert list(log.records()) == RECORDS
+    assert log.record(1) == RECORDS[1]
+    assert log.bodies(1, 3) == [RECORDS[1][2], RECORDS[2][2]]
+    assert list(log.times()) == [moment for _, moment, _ in RECORDS]
+
+
+def test_messages_are_formatted_for_clients() -> None:
+    log: ConversationLog = make_log(UserTable())
+    expected = [(sender, format_time(moment), body) for sender, moment, body in RECORDS]
+    assert log.messages() == expected
+    assert log.messages(2) == expected[2:]
+    assert log[3] == expected[3]
+
+
+def test_users_are_interned_once() -> None:
+    users: UserTable = UserTable()
+    make_log(users)
+    make_log(users)
+    assert users.names == ["alice", "bob", "carol"]
+    assert users.id("bob") == 1
+
+
+def test_dump_and_load_round_trip() -> None:
+    users: UserTable = UserTable()
+    log: ConversationLog = make_log(users)
+    loaded: ConversationLog = ConversationLog.load(
+        UserTable(list(users.names)), log.dump(len(log))
+    )
+    assert list(loaded.records()) == RECORDS
+
+    # A dump of a prefix leaves out later messages
+    partial: ConversationLog = ConversationLog.load(users, log.dump(2))
+    assert list(partial.records()) == RECORDS[:2]
+    partial.append("dave", 1_700_010_000.0, "appended after loading")
+    assert partial.record(2) == ("dave", 1_700_010_000.0, "appended after loading")
+
+
+def test_slice_and_extend() -> None:
+    users: UserTable = UserTable()
+    log: ConversationLog = make_log(users)
+    assert list(log.slice(1, 3).records()) == RECORDS[1:3]
+    assert list(log.slice(2).records()) == RECORDS[2:]
+
+    combined: ConversationLog = log.slice(3)
+    combined.extend(log, 0, 2)
+    combined.extend(log, 2, 2)
+    assert list(combined.records()) == RECORDS[3:] + RECORDS[:2]
+
+
+def test_messages_in_the_old_format_are_converted() -> None:
+    users: UserTable = UserTable()
+    messages = make_log(users).messages()
+    converted: ConversationLog = ConversationLog.from_messages(users, messages)
+    assert converted.messages() == messages
+
+
+def test_message_times_step_back_a_year_across_new_year() -> None:
+    now: float = message_times(["01/02 10:00"], 1_704_189_600.0)[0]
+    december, january = message_times(["12/31 23:59", "01/02 10:00"], now)
+    assert january == now
+    assert 0 < january - december < 3 * 24 * 60 * 60
@@ -0,0 +1,39 @@
+import socket
+from typing import Iterator
+import pytest
+from utils.encryption import receive
+from client.network_manager import NetworkManager
+
+
+@pytest.fixture
+def connected() -> Iterator[tuple[NetworkManager, socket.socket]]:
+    manager: NetworkManager = NetworkManager("127.0.0.1", 0)
+    client_side, server_side = socket.socketpair()
+    server_side.settimeout(5)
+    manager.socket = client_side
+    manager.start_send_loop()
+    yield manager, server_side
+    manager.close_connection()
+    server_side.close()
+
+
+def test_queued_messages_arrive_in_order(
+    connected: tuple[NetworkManager, socket.socket],
+) -> None:
+    manager, server_side = connected
+    for index in range(50):
+        manager.send({"command": "send_message", "message": str(index)})
+    assert [receive(server_side)["message"] for _ in range(50)] == [
+        str(index) for index in range(50)
+    ]
+
+
+def test_oversized_message_is_rejected_without_stopping_the_writer(
+    connected: tuple[NetworkManager, socket.socket],
+) -> None:
+    manager, server_side = connected
+    with pytest.raises(ValueError):
+        manager.send({"command": "send_message", "message": "x" * 60_000})
+    manager.send({"command": "send_message", "message": "small"})
+    assert receive(server_side)["message"] == "small"
+    assert manager.send_thread is not None and manager.send_thread.is_alive()
@@ -0,0 +1,145 @@
+import socket
+import threading
+import time
+from typing import Callable, Iterator
+import pytest
+from server.outbox import Outbox, OutboxWriter
+
+FRAME: bytes = b"x" * 16 * 1024
+
+
+@pytest.fixture
+def writer() -> OutboxWriter:
+    return OutboxWriter(check_interval=0.05)
+
+
+@pytest.fixture
+def sockets() -> Iterator[tuple[socket.socket, socket.socket]]:
+    server_side, client_side = socket.socketpair()
+    # Small buffers so that a client that doesn't read fills them quickly
+    server_side.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    client_side.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    yield server_side, client_side
+    server_side.close()
+    client_side.close()
+
+
+def wait_for(condition: Callable[[], bool], timeout: float = 5.0) -> bool:
+    deadline: float = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def fill(outbox: Outbox) -> None:
+    """Put frames until the socket is full and frames are left queued."""
+    while not outbox.queued_bytes:
+        assert outbox.put(FRAME)
+
+
+def read_all(sock: socket.socket) -> bytes:
+    sock.settimeout(5)
+    data: bytearray = bytearray()
+    while chunk := sock.recv(65536):
+        data += chunk
+    return bytes(data)
+
+
+def test_frames_are_written_straight_away(
+    writer: OutboxWriter, sockets: tuple[socket.socket, socket.socket]
+) -> None:
+    server_side, client_side = sockets
+    outbox: Outbox = Outbox(server_side, "client", 1024 * 1024, 10, writer)
+    assert outbox.put(b"first")
+    assert outbox.put(b"second")
+    assert outbox.queued_bytes == 0
+    client_side.settimeout(5)
+    assert client_side.recv(100) == b"firstsecond"
+    assert len(writer) == 0
+
+
+def test_writer_finishes_writes_once_the_client_reads(
+    writer: OutboxWriter, sockets: tuple[socket.socket, socket.socket]
+) -> None:
+    server_side, client_side = sockets
+    outbox: Outbox = Outbox(server_side, "client", 1024 * 1024, 10, writer)
+    fill(outbox)
+    frames: list[bytes] = [bytes([index]) * 1000 for index in range(20)]
+    for frame in frames:
+        assert outbox.put(frame)
+    sent: int = outbox.queued_bytes
+    assert wait_for(lambda: len(writer) == 1)
+
+    received: list[bytes] = []
+    reader: threading.Thread = threading.Thread(
+        target=lambda: received.append(read_all(client_side))
+    )
+    reader.start()
+    assert wait_for(lambda: outbox.queued_bytes == 0)
+    assert not outbox.closed
+    server_side.shutdown(socket.SHUT_WR)
+    reader.join(5)
+    assert received[0].endswith(b"".join(frames))
+    assert len(received[0]) >= sent
+
+
+def test_connection_is_evicted_once_its_queue_passes_max_bytes(
+    writer: OutboxWriter, sockets: tuple[socket.socket, socket.socket]
+) -> None:
+    server_side, client_side = sockets
+    outbox: Outbox = Outbox(server_side, "client", 4 * len(FRAME), 10, writer)
+    results: list[bool] = [outbox.put(FRAME) for _ in range(100)]
+    assert not results[-1]
+    assert outbox.closed
+    assert outbox.queued_bytes == 0
+    # The socket is shut down, so the client sees the connection end
+    read_all(client_side)
+    assert wait_for(lambda: len(writer) == 0)
+
+
+def test_connection_is_evicted_when_a_write_stalls(
+    writer: OutboxWriter, sockets: tuple[socket.socket, socket.socket]
+) -> None:
+    server_side, _ = sockets
+    outbox: Outbox = Outbox(server_side, "client", 1024 * 1024 * 1024, 0.2, writer)
+    fill(outbox)
+    assert not outbox.closed
+    # Nothing else is sent, so only the writer's stall check can notice
+    assert wait_for(lambda: outbox.closed, timeout=2)
+    assert not outbox.put(b"late")
+
+
+def test_failed_write_closes_the_outbox(
+    writer: OutboxWriter, sockets: tuple[socket.socket, socket.socket]
+) -> None:
+    server_side, client_side = sockets
+    outbox: Outbox = Outbox(server_side, "client", 1024 * 1024, 10, writer)
+    client_side.close()
+    assert not outbox.put(b"to nobody")
+    assert outbox.closed
+
+
+def test_failed_write_of_queued_frames_closes_the_outbox(
+    writer: OutboxWriter, sockets: tuple[socket.socket, socket.socket]
+) -> None:
+    server_side, client_side = sockets
+    outbox: Outbox = Outbox(server_side, "client", 1024 * 1024, 10, writer)
+    fill(outbox)
+    assert wait_for(lambda: len(writer) == 1)
+    client_side.close()
+    assert wait_for(lambda: outbox.closed)
+    assert wait_for(lambda: len(writer) == 0)
+
+
+def test_closing_discards_queued_frames(
+    writer: OutboxWriter, sockets: tuple[socket.socket, socket.socket]
+) -> None:
+    server_side, _ = sockets
+    outbox: Outbox = Outbox(server_side, "client", 1024 * 1024, 10, writer)
+    fill(outbox)
+    outbox.close()
+    assert outbox.queued_bytes == 0
+    assert not outbox.put(FRAME)
+    assert wait_for(lambda: len(writer) == 0)
@@ -0,0 +1,81 @@
+import time
+import pytest
+from server.rate_limit import RateLimiter, TokenBucket, parse_limit, parse_limits
+
+
+def test_bucket_allows_a_burst_then_refills() -> None:
+    bucket: TokenBucket = TokenBucket(rate=2, burst=3, now=100.0)
+    assert [bucket.take(100.0) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.take(100.0) == pytest.approx(0.5)
+
+    # Half a second adds one token at 2 a second
+    assert bucket.take(100.5) == 0.0
+    assert bucket.take(100.5) == pytest.approx(0.5)
+
+
+def test_bucket_refills_no_further_than_its_burst() -> None:
+    bucket: TokenBucket = TokenBucket(rate=10, burst=2, now=0.0)
+    bucket.take(0.0)
+    bucket.take(0.0)
+    assert bucket.full(60.0)
+    assert [bucket.take(60.0) for _ in range(3)][-1] > 0
+
+
+def test_bucket_ignores_a_clock_reading_behind_its_last_update() -> None:
+    bucket: TokenBucket = TokenBucket(rate=1, burst=1, now=10.0)
+    assert bucket.take(10.0) == 0.0
+    # A caller that read the clock earlier must not rewind the bucket
+    assert bucket.take(9.0) > 0
+    assert bucket.updated == 10.0
+    assert bucket.take(11.0) == 0.0
+
+
+def test_limiter_applies_the_command_limit_before_the_user_limit() -> None:
+    limiter: RateLimiter = RateLimiter((0.001, 100), {"search": (0.001, 2)})
+    assert limiter.check("alice", "search") == (0.0, "")
+    assert limiter.check("alice", "search") == (0.0, "")
+    retry_after, limit = limiter.check("alice", "search")
+    assert retry_after > 0
+    assert limit == "command"
+
+    # Other commands and other users have their own buckets
+    assert limiter.check("alice", "send_message") == (0.0, "")
+    assert limiter.check("bob", "search") == (0.0, "")
+
+
+def test_limiter_gives_back_the_command_token_when_the_user_limit_is_reached() -> None:
+    limiter: RateLimiter = RateLimiter((0.001, 2), {"search": (0.001, 10)})
+    limiter.check("alice", "send_message")
+    limiter.check("alice", "send_message")
+    retry_after, limit = limiter.check("alice", "search")
+    assert retry_after > 0
+    assert limit == "user"
+    assert limiter._users["alice"].commands["search"].tokens == pytest.approx(10)
+
+
+def test_limiter_forgets_disconnected_users_once_their_buckets_refill() -> None:
+    limiter: RateLimiter = RateLimiter((1000, 1), {}, sweep_interval=0)
+    limiter.connected("alice")
+    limiter.connected("bob")
+    limiter.check("alice", "send_message")
+    limiter.check("bob", "send_message")
+    # Long enough for the buckets to refill at 1000 tokens a second
+    time.sleep(0.01)
+    limiter.disconnected("alice")
+    assert "alice" not in limiter._users
+    assert "bob" in limiter._users
+
+
+def test_parse_limit() -> None:
+    assert parse_limit("20/100") == (20.0, 100.0)
+    assert parse_limit("5") == (5.0, 5.0)
+    assert parse_limit("0.5/0") == (0.5, 1.0)
+    assert parse_limit("0/100") is None
+    assert parse_limit("") is None
+
+
+def test_parse_limits() -> None:
+    assert parse_limits(" search=2/10, get_history=5/20,,login=0 ") == {
+        "search": (2.0, 10.0),
+        "get_history": (5.0, 20.0),
+    }
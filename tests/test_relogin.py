@@ -0,0 +1,74 @@
+import subprocess
+import time
+from typing import Any, Iterator
+import pytest
+from tools.harness import Client, ServerProcess, run_server
+from utils.encryption import receive
+
+
+@pytest.fixture(scope="module")
+def server() -> Iterator[ServerProcess]:
+    with run_server(subprocess.DEVNULL) as process:
+        setup: Client = Client(process.port)
+        for username in ("alice", "bob"):
+            setup.send({"command": "register", "username": username, "password": "secret"})
+            assert setup.receive("register_result")["response"] == "ok"
+        setup.close()
+        yield process
+
+
+def logged_in(port: int, username: str) -> Client:
+    client: Client = Client(port)
+    client.login(username, "secret")
+    return client
+
+
+def online_users(client: Client) -> tuple[list[str], list[dict[str, Any]]]:
+    """Get the users online, and the presence updates received before them."""
+    client.send({"command": "get_users"})
+    updates: list[dict[str, Any]] = []
+    while True:
+        data: dict[str, Any] = receive(client.socket)
+        if data.get("type") == "get_users":
+            return sorted(data["data"]), updates
+        if data.get("type") in ("peer_joined", "peer_left"):
+            updates.append(data)
+
+
+def test_relogin_replaces_the_earlier_connection(server: ServerProcess) -> None:
+    bob: Client = logged_in(server.port, "bob")
+    first: Client = logged_in(server.port, "alice")
+    second: Client = logged_in(server.port, "alice")
+    try:
+        users, _ = online_users(bob)
+        assert users == ["alice"]
+
+        # Closing the replaced connection doesn't log alice out
+        first.close()
+        time.sleep(0.5)
+        users, updates = online_users(bob)
+        assert users == ["alice"]
+        assert {"type": "peer_left", "peer": "alice"} not in updates
+
+        # Closing the current one does
+        second.close()
+        time.sleep(0.5)
+        users, updates = online_users(bob)
+        assert users == []
+        assert {"type": "peer_left", "peer": "alice"} in updates
+    finally:
+        for client in (bob, first, second):
+            client.close()
+
+
+def test_user_is_removed_when_their_only_connection_closes(server: ServerProcess) -> None:
+    bob: Client = logged_in(server.port, "bob")
+    alice: Client = logged_in(server.port, "alice")
+    try:
+        assert online_users(bob)[0] == ["alice"]
+        alice.close()
+        time.sleep(0.5)
+        assert online_users(bob)[0] == []
+    finally:
+        bob.close()
+        alice.close()
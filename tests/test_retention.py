@@ -0,0 +1,52 @@
+import json
+from pathlib import Path
+from server.retention import RetentionPolicy, load_overrides
+
+DAY: float = 24 * 60 * 60
+
+
+def write_overrides(tmp_path: Path, config: object) -> Path:
+    filepath: Path = tmp_path / "retention.json"
+    filepath.write_text(json.dumps(config), encoding="utf-8")
+    return filepath
+
+
+def test_overrides_are_keyed_like_the_chat_history(tmp_path: Path) -> None:
+    overrides = load_overrides(
+        write_overrides(
+            tmp_path,
+            {
+                "global": {"max_age_days": 30},
+                "#ops": {"max_messages": 1000},
+                "bob,alice": {"max_age_days": 7, "max_messages": 500},
+            },
+        )
+    )
+    assert overrides == {
+        ("", ""): RetentionPolicy(30 * DAY, 0),
+        ("#ops", ""): RetentionPolicy(0, 1000),
+        ("alice", "bob"): RetentionPolicy(7 * DAY, 500),
+    }
+
+
+def test_bad_entries_are_skipped(tmp_path: Path) -> None:
+    overrides = load_overrides(
+        write_overrides(
+            tmp_path,
+            {
+                "alice": {"max_messages": 10},
+                "alice,bob,carol": {"max_messages": 10},
+                "#ops": {"max_messages": "lots"},
+                "#dev": 5,
+                "alice,bob": {"max_messages": 10},
+            },
+        )
+    )
+    assert overrides == {("alice", "bob"): RetentionPolicy(0, 10)}
+
+
+def test_missing_or_invalid_file_has_no_overrides(tmp_path: Path) -> None:
+    assert load_overrides(tmp_path / "missing.json") == {}
+    assert load_overrides(write_overrides(tmp_path, ["not", "an", "object"])) == {}
+    (tmp_path / "broken.json").write_text("{", encoding="utf-8")
+    assert load_overrides(tmp_path / "broken.json") == {}
@@ -0,0 +1,58 @@
+import time
+from typing import Any
+import pytest
+from server.sessions import SessionTokens
+
+
+@pytest.fixture
+def tokens() -> SessionTokens:
+    return SessionTokens(b"secret", ttl=60)
+
+
+def test_issued_token_verifies(tokens: SessionTokens) -> None:
+    assert tokens.verify(tokens.issue("alice")) == "alice"
+    assert tokens.verify(tokens.issue("zoë.🙂")) == "zoë.🙂"
+
+
+def test_expired_token_is_rejected() -> None:
+    tokens: SessionTokens = SessionTokens(b"secret", ttl=-1)
+    assert tokens.verify(tokens.issue("alice")) is None
+
+
+def test_token_signed_with_another_secret_is_rejected(tokens: SessionTokens) -> None:
+    other: SessionTokens = SessionTokens(b"other secret", ttl=60)
+    assert tokens.verify(other.issue("alice")) is None
+
+
+def test_token_with_a_changed_username_is_rejected(tokens: SessionTokens) -> None:
+    _, expiry, signature = tokens.issue("alice").split(".")
+    forged_username: str = tokens.issue("admin").split(".")[0]
+    assert tokens.verify(f"{forged_username}.{expiry}.{signature}") is None
+
+
+@pytest.mark.parametrize(
+    "token",
+    [
+        None,
+        5,
+        1.5,
+        ["a", "b", "c"],
+        {"token": "x"},
+        b"YWxpY2U.1.abc",
+        "",
+        "no-dots",
+        "one.dot",
+        "too.many.dots.here",
+        "YWxpY2U.notanumber.abc",
+        "YWxpY2U.1.sïgnature",
+        "é" * 100,
+    ],
+)
+def test_malformed_token_is_rejected(tokens: SessionTokens, token: Any) -> None:
+    assert tokens.verify(token) is None
+
+
+def test_token_with_a_bad_username_encoding_is_rejected(tokens: SessionTokens) -> None:
+    # Correctly signed, but the username isn't valid base64 of UTF-8
+    payload: str = f"_w==.{int(time.time()) + 60}"
+    assert tokens.verify(f"{payload}.{tokens._sign(payload)}") is None
@@ -0,0 +1,103 @@
+"""
+Measure the memory and threads each idle connection costs the server, and
+each connected NetworkManager costs a client process, for capacity planning.
+
+    python -m tools.bench_connection_memory --connections 500
+
+Reads resident memory from /proc, so only runs on Linux.
+"""
+
+import os
+import gc
+import time
+import argparse
+from client.network_manager import NetworkManager
+from tools.harness import (
+    Client,
+    Drain,
+    ServerProcess,
+    process_status,
+    raise_fd_limit,
+    register_accounts,
+    run_server,
+)
+
+ADMIN_TOKEN: str = "bench"
+PASSWORD: str = "bench"
+
+
+def settle(server: ServerProcess, drain: Drain) -> tuple[int, int]:
+    """Wait for queued messages to be delivered and memory to stop growing."""
+    while time.perf_counter() - drain.last_frame < 1.0:
+        time.sleep(0.2)
+    rss, threads = server.status()
+    for _ in range(20):
+        time.sleep(0.5)
+        previous: int = rss
+        rss, threads = server.status()
+        if abs(rss - previous) < 64 * 1024:
+            break
+    return rss, threads
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--connections", type=int, default=500)
+    parser.add_argument("--clients", type=int, default=50, help="NetworkManagers")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    usernames: list[str] = [f"idle{i}" for i in range(args.connections)]
+
+    # Idle clients don't answer pings and aren't logged in at first, so
+    # disable the heartbeat and the login deadline
+    with run_server(
+        ADMIN_TOKENS=ADMIN_TOKEN, HEARTBEAT_INTERVAL=0, AUTH_TIMEOUT=0
+    ) as server:
+        register_accounts(server.port, ADMIN_TOKEN, [(name, PASSWORD) for name in usernames])
+        drain: Drain = Drain()
+        base_rss, base_threads = settle(server, drain)
+
+        clients: list[Client] = [Client(server.port) for _ in usernames]
+        connected_rss, connected_threads = settle(server, drain)
+
+        for client, username in zip(clients, usernames):
+            client.login(username, PASSWORD)
+            drain.add(client.socket)
+        authed_rss, authed_threads = settle(server, drain)
+
+        # Client side: connected NetworkManagers in this process
+        gc.collect()
+        client_rss, client_threads = process_status(os.getpid())
+        managers: list[NetworkManager] = []
+        for _ in range(args.clients):
+            manager: NetworkManager = NetworkManager("127.0.0.1", server.port)
+            manager.connect()
+            managers.append(manager)
+        time.sleep(1)
+        gc.collect()
+        manager_rss, manager_threads = process_status(os.getpid())
+        for manager in managers:
+            manager.close_connection()
+        for client in clients:
+            client.close()
+
+    count: int = args.connections
+    print(f"Server, per connection ({count} idle connections):")
+    print(
+        f"  Connected:   {(connected_rss - base_rss) / count / 1024:7.1f} KiB, "
+        f"{(connected_threads - base_threads) / count:.1f} threads"
+    )
+    print(
+        f"  Logged in:   {(authed_rss - base_rss) / count / 1024:7.1f} KiB, "
+        f"{(authed_threads - base_threads) / count:.1f} threads"
+    )
+    print(f"Client, per connected NetworkManager ({args.clients}):")
+    print(
+        f"  Connected:   {(manager_rss - client_rss) / args.clients / 1024:7.1f} KiB, "
+        f"{(manager_threads - client_threads) / args.clients:.1f} threads"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Benchmark broadcast fan-out with many connected clients.
+
+Logs in a large number of idle clients, then has a few of them broadcast
+while others repeatedly log in and out, and reports delivery throughput and
+how long threads waited on the server's client registry lock.
+
+    python -m tools.bench_fanout --clients 1000 --senders 10 --messages 100
+"""
+
+import time
+import argparse
+import threading
+from tools.harness import Client, Drain, raise_fd_limit, register_accounts, run_server
+
+ADMIN_TOKEN: str = "bench"
+PASSWORD: str = "bench"
+LOCK_WAIT: str = 'ncr_lock_wait_seconds_{}{{lock="clients"}}'
+
+
+def churn(port: int, username: str, logins: int) -> None:
+    """Repeatedly log a client in and out."""
+    for _ in range(logins):
+        client: Client = Client(port)
+        client.login(username, PASSWORD)
+        client.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--senders", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=100, help="Per sender")
+    parser.add_argument("--churners", type=int, default=4, help="Login/logout loops")
+    parser.add_argument("--logins", type=int, default=25, help="Per churner")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    usernames: list[str] = [f"bench{i}" for i in range(args.clients)]
+    churn_names: list[str] = [f"churn{i}" for i in range(args.churners)]
+
+    # Idle clients don't answer pings, so disable the heartbeat
+    with run_server(
+        ADMIN_TOKENS=ADMIN_TOKEN,
+        OUTBOX_MAX_BYTES=64 * 1024 * 1024,
+        HEARTBEAT_INTERVAL=0,
+        # Senders broadcast as fast as they can
+        RATE_LIMIT_USER=0,
+    ) as server:
+        register_accounts(
+            server.port,
+            ADMIN_TOKEN,
+            [(name, PASSWORD) for name in usernames + churn_names],
+        )
+
+        drain: Drain = Drain()
+        clients: list[Client] = []
+        start: float = time.perf_counter()
+        for username in usernames:
+            client: Client = Client(server.port)
+            client.login(username, PASSWORD)
+            drain.add(client.socket)
+            clients.append(client)
+        print(f"Logged in {len(clients)} clients in {time.perf_counter() - start:.1f}s")
+
+        # Let presence notifications from the logins settle
+        while time.perf_counter() - drain.last_frame < 1.0:
+            time.sleep(0.2)
+        before: dict[str, float] = server.metrics()
+        frames_before: int = drain.frames
+
+        churners: list[threading.Thread] = [
+            threading.Thread(target=churn, args=(server.port, name, args.logins))
+            for name in churn_names
+        ]
+
+        def broadcast(client: Client) -> None:
+            for i in range(args.messages):
+                client.send({"command": "chat", "peer": "", "message": f"m{i}"})
+
+        senders: list[threading.Thread] = [
+            threading.Thread(target=broadcast, args=(client,))
+            for client in clients[: args.senders]
+        ]
+        start = time.perf_counter()
+        for thread in churners + senders:
+            thread.start()
+        for thread in senders + churners:
+            thread.join()
+        while time.perf_counter() - drain.last_frame < 1.0:
+            time.sleep(0.2)
+        elapsed: float = drain.last_frame - start
+        after: dict[str, float] = server.metrics()
+
+    delivered: int = drain.frames - frames_before
+    acquisitions: float = after[LOCK_WAIT.format("count")] - before[LOCK_WAIT.format("count")]
+    waited: float = after[LOCK_WAIT.format("sum")] - before[LOCK_WAIT.format("sum")]
+    print(f"Broadcasts sent:        {args.senders * args.messages}")
+    print(f"Frames delivered:       {delivered} in {elapsed:.2f}s ({delivered / elapsed:,.0f}/s)")
+    print(f"Logins during fan-out:  {args.churners * args.logins}")
+    print(f"Registry lock acquired: {acquisitions:.0f} times")
+    print(
+        f"Registry lock wait:     {waited * 1000:.3f}ms total, "
+        f"{waited / max(acquisitions, 1) * 1e6:.1f}us mean"
+    )
+
+
+if __name__ == "__main__":
+    main()
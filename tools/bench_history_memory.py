@@ -0,0 +1,96 @@
+"""
+Compare the memory used by chat history stored as message tuples and as
+columnar conversation logs, on a synthetic history.
+
+    python -m tools.bench_history_memory --conversations 200 --messages 1000
+"""
+
+import time
+import random
+import string
+import argparse
+import tracemalloc
+from typing import Callable, TypeVar
+from server.conversation_log import ConversationLog, Message, UserTable, format_time
+
+T = TypeVar("T")
+
+
+def measure(build: Callable[[], T]) -> tuple[T, int]:
+    """Run a function and return its result and the memory it still holds."""
+    tracemalloc.start()
+    try:
+        result: T = build()
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, current
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--conversations", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=1000, help="Per conversation")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng: random.Random = random.Random(args.seed)
+    usernames: list[str] = [f"user{i}" for i in range(args.users)]
+    words: list[str] = [
+        "".join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 9)))
+        for _ in range(2000)
+    ]
+    start: float = time.time() - 30 * 24 * 60 * 60
+    conversations: list[list[tuple[str, float, str]]] = []
+    for _ in range(args.conversations):
+        pair: list[str] = rng.sample(usernames, 2)
+        moment: float = start
+        messages: list[tuple[str, float, str]] = []
+        for _ in range(args.messages):
+            moment += rng.expovariate(1 / 60)
+            messages.append(
+                (rng.choice(pair), moment, " ".join(rng.choices(words, k=rng.randint(1, 20))))
+            )
+        conversations.append(messages)
+    total: int = args.conversations * args.messages
+
+    def build_tuples() -> list[list[Message]]:
+        # Senders and timestamps are separate strings per message, as when
+        # they come from decoded requests and strftime
+        return [
+            [
+                ("".join(sender), format_time(moment), "".join(body))
+                for sender, moment, body in messages
+            ]
+            for messages in conversations
+        ]
+
+    def build_logs() -> list[ConversationLog]:
+        users: UserTable = UserTable()
+        logs: list[ConversationLog] = []
+        for messages in conversations:
+            log: ConversationLog = ConversationLog(users)
+            for sender, moment, body in messages:
+                log.append(sender, moment, body)
+            logs.append(log)
+        return logs
+
+    tuples, tuple_bytes = measure(build_tuples)
+    logs, log_bytes = measure(build_logs)
+
+    read_start: float = time.perf_counter()
+    for log, expected in zip(logs, tuples):
+        if log.messages() != expected:
+            raise AssertionError("Columnar history doesn't match the tuples")
+    read_seconds: float = time.perf_counter() - read_start
+
+    print(f"Messages:           {total:,}")
+    print(f"Tuples:             {tuple_bytes / 2**20:8.1f} MiB ({tuple_bytes / total:.0f} B/message)")
+    print(f"Conversation logs:  {log_bytes / 2**20:8.1f} MiB ({log_bytes / total:.0f} B/message)")
+    print(f"Reduction:          {tuple_bytes / log_bytes:8.1f}x")
+    print(f"Decode all:         {read_seconds:8.2f}s ({read_seconds / total * 1e6:.1f}us/message)")
+
+
+if __name__ == "__main__":
+    main()
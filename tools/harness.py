@@ -0,0 +1,255 @@
+import os
+import re
+import sys
+import time
+import socket
+import selectors
+import threading
+import resource
+import tempfile
+import subprocess
+import urllib.request
+from contextlib import contextmanager
+from typing import IO, Any, Iterator
+from utils.encryption import receive, send
+
+_SAMPLE_PATTERN: re.Pattern[str] = re.compile(r"^(\S+?)(\{.*\})?\s+(\S+)$")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def raise_fd_limit() -> int:
+    """Raise the soft open-file limit to the hard limit, and return it."""
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+class ServerProcess:
+    def __init__(self, process: subprocess.Popen, port: int, metrics_port: int) -> None:
+        self.process: subprocess.Popen = process
+        self.port: int = port
+        self.metrics_port: int = metrics_port
+
+    def status(self) -> tuple[int, int]:
+        """Get the server's resident memory in bytes and its thread count (Linux only)."""
+        return process_status(self.process.pid)
+
+    def open_fds(self) -> int:
+        """Count the server's open file descriptors (Linux only)."""
+        return len(os.listdir(f"/proc/{self.process.pid}/fd"))
+
+    def allocations(self, limit: int = 50) -> dict[str, tuple[int, int]]:
+        """
+        Get the memory held by the server's top allocating source lines. The
+        server must run with PYTHONTRACEMALLOC set.
+
+        Returns:
+            (bytes, blocks) per "file:line", plus the traced total under "total".
+        """
+        url: str = f"http://127.0.0.1:{self.metrics_port}/allocations?limit={limit}"
+        with urllib.request.urlopen(url, timeout=60) as response:
+            text: str = response.read().decode("utf-8")
+        allocations: dict[str, tuple[int, int]] = {}
+        for line in text.splitlines():
+            if line.startswith("total "):
+                _, size, count = line.split()
+                allocations["total"] = (int(size), int(count))
+            else:
+                size, count, where = line.split(" ", 2)
+                allocations[where] = (int(size), int(count))
+        return allocations
+
+    def metrics(self) -> dict[str, float]:
+        """
+        Scrape the server's metrics.
+
+        Returns:
+            Each sample's value, keyed by its name and labels as exposed,
+            e.g. 'ncr_lock_wait_seconds_count{lock="clients"}'.
+        """
+        url: str = f"http://127.0.0.1:{self.metrics_port}/metrics"
+        with urllib.request.urlopen(url, timeout=10) as response:
+            text: str = response.read().decode("utf-8")
+        samples: dict[str, float] = {}
+        for line in text.splitlines():
+            match = _SAMPLE_PATTERN.match(line)
+            if line.startswith("#") or not match:
+                continue
+            samples[match.group(1) + (match.group(2) or "")] = float(match.group(3))
+        return samples
+
+
+def process_status(pid: int) -> tuple[int, int]:
+    """Get a process's resident memory in bytes and its thread count (Linux only)."""
+    fields: dict[str, str] = {}
+    with open(f"/proc/{pid}/status", encoding="ascii") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            fields[name] = value.strip()
+    return int(fields["VmRSS"].split()[0]) * 1024, int(fields["Threads"])
+
+
+@contextmanager
+def run_server(output: IO | int | None = None, **env: Any) -> Iterator[ServerProcess]:
+    """
+    Run a server in a subprocess with its own empty storage directory.
+
+    Passwords are hashed with few iterations so that logging in thousands of
+    clients is quick; pass PASSWORD_HASH_ITERATIONS to override this, or any
+    other setting the server reads from the environment.
+
+    Args:
+        output: Where the server's console output goes, as for subprocess;
+            by default it is shared with this process.
+
+    Yields:
+        The running server.
+    """
+    port: int = free_port()
+    metrics_port: int = free_port()
+    with tempfile.TemporaryDirectory(prefix="ncr-bench-") as storage_dir:
+        environment: dict[str, str] = {
+            **os.environ,
+            "SERVER_PORT": str(port),
+            "METRICS_PORT": str(metrics_port),
+            "STORAGE_DIR": storage_dir,
+            "LOG_LEVEL": "ERROR",
+            "PASSWORD_HASH_ITERATIONS": "1000",
+            "PYTHONPATH": os.getcwd(),
+            **{key: str(value) for key, value in env.items()},
+        }
+        process: subprocess.Popen = subprocess.Popen(
+            [sys.executable, "-m", "server.server"],
+            # Run outside the working directory so a local .env doesn't apply
+            cwd=storage_dir,
+            env=environment,
+            stdout=output,
+            stderr=output,
+        )
+        try:
+            deadline: float = time.monotonic() + 30
+            while True:
+                try:
+                    socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                    break
+                except OSError:
+                    if process.poll() is not None or time.monotonic() > deadline:
+                        raise RuntimeError("Server failed to start")
+                    time.sleep(0.05)
+            yield ServerProcess(process, port, metrics_port)
+        finally:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+
+class Drain:
+    """
+    Reads and discards everything sent to a set of sockets on one thread,
+    counting whole frames by their length prefixes without decrypting them.
+    Sockets are closed once the server closes them.
+    """
+
+    def __init__(self) -> None:
+        self.selector: selectors.DefaultSelector = selectors.DefaultSelector()
+        self.frames: int = 0
+        self.last_frame: float = 0.0
+        self._lock: threading.Lock = threading.Lock()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def add(self, sock: socket.socket) -> None:
+        # Per-socket buffer of bytes not yet forming a whole frame
+        self.selector.register(sock, selectors.EVENT_READ, bytearray())
+
+    def _run(self) -> None:
+        while True:
+            if not self.selector.get_map():
+                time.sleep(0.01)
+                continue
+            for key, _ in self.selector.select(timeout=0.1):
+                try:
+                    data: bytes = key.fileobj.recv(65536)  # type: ignore[union-attr]
+                except OSError:
+                    data = b""
+                if not data:
+                    self.selector.unregister(key.fileobj)
+                    key.fileobj.close()  # type: ignore[union-attr]
+                    continue
+                buffer: bytearray = key.data
+                buffer += data
+                frames: int = 0
+                while len(buffer) >= 2:
+                    length: int = int.from_bytes(buffer[:2], "big")
+                    if len(buffer) < 2 + length:
+                        break
+                    del buffer[: 2 + length]
+                    frames += 1
+                if frames:
+                    with self._lock:
+                        self.frames += frames
+                        self.last_frame = time.perf_counter()
+
+
+class Client:
+    """A minimal blocking chat client for driving a server."""
+
+    def __init__(self, port: int, host: str = "127.0.0.1") -> None:
+        self.socket: socket.socket = socket.create_connection((host, port))
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def send(self, data: dict[str, Any]) -> None:
+        send(self.socket, data)
+
+    def receive(self, message_type: str) -> dict[str, Any]:
+        """Read messages until one of the given type arrives, answering pings."""
+        while True:
+            data: dict[str, Any] = receive(self.socket)
+            if data.get("type") == "ping":
+                self.send({"command": "pong"})
+            elif data.get("type") == message_type:
+                return data
+
+    def login(self, username: str, password: str) -> None:
+        self.send({"command": "login", "username": username, "password": password})
+        result: dict[str, Any] = self.receive("login_result")
+        if result.get("response") != "ok":
+            raise RuntimeError(f"Login failed for {username}: {result.get('reason')}")
+
+    def close(self) -> None:
+        self.socket.close()
+
+
+def register_accounts(
+    port: int, admin_token: str, accounts: list[tuple[str, str]]
+) -> None:
+    """Register accounts with the server's batch registration command."""
+    admin: Client = Client(port)
+    try:
+        # Keep each request well inside the frame size limit
+        for start in range(0, len(accounts), 500):
+            chunk: list[tuple[str, str]] = accounts[start : start + 500]
+            admin.send(
+                {
+                    "command": "batch_register",
+                    "token": admin_token,
+                    "accounts": [list(account) for account in chunk],
+                }
+            )
+            results: int = 0
+            while results < len(chunk):
+                batch: dict[str, Any] = admin.receive("batch_register_result")
+                if batch.get("response") != "ok":
+                    raise RuntimeError(
+                        f"Batch registration failed: {batch.get('reason')}"
+                    )
+                results += len(batch["data"])
+    finally:
+        admin.close()
@@ -0,0 +1,173 @@
+"""
+Replay traffic recorded by a server run with RECORD_TRAFFIC_PATH against a
+local server, with the recorded timing or as fast as possible.
+
+    python -m tools.replay_traffic traffic.ncr.gz
+    python -m tools.replay_traffic traffic.ncr.gz --fast
+    python -m tools.replay_traffic traffic.ncr.gz --port 8888 --admin-token secret
+
+Recordings don't contain passwords or session tokens, so every user is
+logged in with the same replay password: users who log in during the
+recording are registered first (unless they register on the connection
+they log in on), and resumed sessions become logins.
+
+Without --port, a throwaway server is started with heartbeats disabled,
+since replayed connections only send the pongs that were recorded.
+"""
+
+import time
+import socket
+import argparse
+from pathlib import Path
+from typing import Any
+from server.traffic import CLOSED, FRAME, OPENED, TrafficRecord, read_traffic
+from tools.harness import Drain, raise_fd_limit, register_accounts, run_server
+from utils.encryption import encode_frame
+
+ADMIN_TOKEN: str = "replay"
+PASSWORD: str = "replay"
+
+
+def prepare(
+    records: list[TrafficRecord], admin_token: str
+) -> tuple[list[tuple[int, float, int, bytes]], list[str]]:
+    """
+    Substitute the replay credentials for redacted ones and encode every
+    frame in advance, so that replaying only costs the writes.
+
+    Args:
+        records: The recording.
+        admin_token: Admin token for recorded batch registrations.
+
+    Returns:
+        The records with encoded frames, and the users who must be
+        registered before the replay. Users registered by a batch
+        registration are included, since replayed connections don't wait
+        for each other and their logins could otherwise arrive first.
+    """
+    prepared: list[tuple[int, float, int, bytes]] = []
+    logins: set[str] = set()
+    registered: set[str] = set()
+    for kind, elapsed, connection_id, data in records:
+        if kind != FRAME or data is None:
+            prepared.append((kind, elapsed, connection_id, b""))
+            continue
+        command: str = str(data.get("command", ""))
+        if command in ("login", "resume"):
+            data = {
+                "command": "login",
+                "username": data.get("username", ""),
+                "password": PASSWORD,
+            }
+            logins.add(data["username"])
+        elif command == "register":
+            data = {**data, "password": PASSWORD}
+            registered.add(str(data.get("username", "")))
+        elif command == "batch_register":
+            accounts: list[list[Any]] = [
+                [account[0], PASSWORD] for account in data.get("accounts", []) if account
+            ]
+            data = {**data, "token": admin_token, "accounts": accounts}
+        prepared.append((kind, elapsed, connection_id, encode_frame(data)))
+    return prepared, sorted(logins - registered)
+
+
+def replay(
+    port: int, records: list[tuple[int, float, int, bytes]], speed: float
+) -> tuple[Drain, float, float]:
+    """
+    Open, write to and close connections as recorded.
+
+    Args:
+        port: The server's port on localhost.
+        records: Prepared records.
+        speed: Playback speed relative to the recording, or 0 for as fast as
+            possible.
+
+    Returns:
+        The drain that read the server's responses, the seconds the replay
+        took, and the furthest it fell behind the recorded timing.
+    """
+    drain: Drain = Drain()
+    connections: dict[int, socket.socket] = {}
+    opened: list[socket.socket] = []
+    lag: float = 0.0
+    start: float = time.perf_counter()
+
+    def connect(connection_id: int) -> socket.socket:
+        sock: socket.socket = socket.create_connection(("127.0.0.1", port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connections[connection_id] = sock
+        opened.append(sock)
+        drain.add(sock)
+        return sock
+
+    for kind, elapsed, connection_id, frame in records:
+        if speed:
+            delay: float = start + elapsed / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                lag = max(lag, -delay)
+        if kind == OPENED:
+            connect(connection_id)
+        elif kind == FRAME:
+            sock: socket.socket = connections.get(connection_id) or connect(connection_id)
+            try:
+                sock.sendall(frame)
+            except OSError:
+                # The server dropped the connection, as it may have when recorded
+                connections.pop(connection_id, None)
+        elif kind == CLOSED and connection_id in connections:
+            # The server still reads what was sent before closing, and the
+            # drain stops reading the socket once the server closes it
+            connections.pop(connection_id).shutdown(socket.SHUT_WR)
+    elapsed_total: float = time.perf_counter() - start
+
+    # Let the server finish responding before closing everything
+    while time.perf_counter() - max(drain.last_frame, start + elapsed_total) < 1.0:
+        time.sleep(0.2)
+    for sock in opened:
+        sock.close()
+    return drain, elapsed_total, lag
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("recording", type=Path)
+    parser.add_argument("--speed", type=float, default=1.0, help="Playback speed")
+    parser.add_argument("--fast", action="store_true", help="Ignore recorded timing")
+    parser.add_argument("--port", type=int, default=0, help="Replay against a running server")
+    parser.add_argument("--admin-token", default=ADMIN_TOKEN, help="For --port")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    records: list[TrafficRecord] = list(read_traffic(args.recording))
+    prepared, accounts = prepare(records, args.admin_token)
+    frames: int = sum(1 for kind, *_ in records if kind == FRAME)
+    connections: int = sum(1 for kind, *_ in records if kind == OPENED)
+    duration: float = records[-1][1] if records else 0.0
+    speed: float = 0.0 if args.fast else args.speed
+
+    def run(port: int) -> tuple[Drain, float, float]:
+        if accounts:
+            register_accounts(
+                port, args.admin_token, [(name, PASSWORD) for name in accounts]
+            )
+        return replay(port, prepared, speed)
+
+    if args.port:
+        drain, elapsed, lag = run(args.port)
+    else:
+        with run_server(ADMIN_TOKENS=args.admin_token, HEARTBEAT_INTERVAL=0) as server:
+            drain, elapsed, lag = run(server.port)
+
+    print(f"Recorded:   {frames} frames on {connections} connections over {duration:.1f}s")
+    print(f"Replayed:   {elapsed:.2f}s ({frames / max(elapsed, 1e-9):,.0f} frames/s)")
+    print(f"Responses:  {drain.frames} frames")
+    if speed:
+        print(f"Max lag:    {lag * 1000:.1f}ms behind the recorded timing")
+
+
+if __name__ == "__main__":
+    main()
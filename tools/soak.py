@@ -0,0 +1,280 @@
+"""
+Soak test a server with hours of connect/chat/disconnect churn, watching
+for resources that keep growing.
+
+    python -m tools.soak --duration 14400 --interval 60
+
+Workers repeatedly connect, log in, send a mix of commands and disconnect.
+The server's memory, threads, open files, connection counts and log queue
+are sampled at each interval, and the Python source lines holding the most
+memory are compared between the end of the warm-up and the end of the run.
+The run fails (exit status 1) if anything grew by more than its threshold,
+or if connections or registered clients are left behind once the churn
+stops. Reads process statistics from /proc, so only runs on Linux.
+"""
+
+import sys
+import time
+import random
+import socket
+import argparse
+import threading
+import subprocess
+from typing import Any, Callable
+from tools.harness import (
+    Client,
+    Drain,
+    ServerProcess,
+    raise_fd_limit,
+    register_accounts,
+    run_server,
+)
+
+ADMIN_TOKEN: str = "soak"
+PASSWORD: str = "soak"
+ROOMS: int = 5
+MIB: int = 1024 * 1024
+
+
+class Sample:
+    """The server's resource usage at one point in the run."""
+
+    __slots__ = (
+        "elapsed",
+        "rss",
+        "threads",
+        "fds",
+        "clients",
+        "connections",
+        "log_queue",
+        "traced",
+    )
+
+    def __init__(self, server: ServerProcess, elapsed: float) -> None:
+        metrics: dict[str, float] = server.metrics()
+        self.elapsed: float = elapsed
+        self.rss, self.threads = server.status()
+        self.fds: int = server.open_fds()
+        self.clients: int = int(metrics["ncr_connected_clients"])
+        self.connections: int = int(metrics["ncr_open_connections"])
+        self.log_queue: int = int(metrics["ncr_log_queue_records"])
+        self.traced: int = int(metrics["ncr_traced_memory_bytes"])
+
+    def __str__(self) -> str:
+        minutes, seconds = divmod(int(self.elapsed), 60)
+        return (
+            f"{minutes:5d}:{seconds:02d}  rss {self.rss / MIB:7.1f} MiB  "
+            f"threads {self.threads:4d}  fds {self.fds:5d}  "
+            f"clients {self.clients:4d}  connections {self.connections:4d}  "
+            f"log queue {self.log_queue:5d}  traced {self.traced / MIB:7.1f} MiB"
+        )
+
+
+class Churn:
+    """Worker threads that log in, send a random mix of commands and log out."""
+
+    def __init__(self, port: int, usernames: list[str], actions: int, think: float) -> None:
+        self.port: int = port
+        self.usernames: list[str] = usernames
+        self.actions: int = actions
+        self.think: float = think
+        self.drain: Drain = Drain()
+        self.sessions: int = 0
+        self.errors: int = 0
+        self._lock: threading.Lock = threading.Lock()
+        self._stop: threading.Event = threading.Event()
+        self._threads: list[threading.Thread] = []
+
+    def start(self, workers: int) -> None:
+        for index in range(workers):
+            thread = threading.Thread(target=self._work, args=(random.Random(index),))
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self) -> None:
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+
+    def _work(self, rng: random.Random) -> None:
+        while not self._stop.is_set():
+            try:
+                self._session(rng)
+                with self._lock:
+                    self.sessions += 1
+            except (OSError, RuntimeError):
+                with self._lock:
+                    self.errors += 1
+                time.sleep(1)
+
+    def _session(self, rng: random.Random) -> None:
+        username: str = rng.choice(self.usernames)
+        client: Client = Client(self.port)
+        try:
+            client.login(username, PASSWORD)
+        except BaseException:
+            client.close()
+            raise
+        # The drain reads the responses from here on, and closes the socket
+        # once the server has closed its side
+        self.drain.add(client.socket)
+        room: str = f"room{rng.randrange(ROOMS)}"
+        commands: list[Callable[[], dict[str, Any]]] = [
+            lambda: {"command": "chat", "peer": "", "message": f"hello {rng.random()}"},
+            lambda: {
+                "command": "chat",
+                "peer": rng.choice(self.usernames),
+                "message": f"hi {rng.random()}",
+            },
+            lambda: {"command": "get_history", "peer": rng.choice(self.usernames)},
+            lambda: {"command": "get_history", "peer": ""},
+            lambda: {"command": "get_users"},
+            lambda: {"command": "get_offline"},
+            lambda: {"command": "room_chat", "room": room, "message": f"hey {rng.random()}"},
+            lambda: {"command": "list_rooms"},
+            lambda: {"command": "search", "query": "hello"},
+        ]
+        client.send({"command": "join_room", "room": room})
+        for _ in range(self.actions):
+            client.send(rng.choice(commands)())
+            time.sleep(self.think)
+        if rng.random() < 0.5:
+            client.send({"command": "leave_room", "room": room})
+        client.socket.shutdown(socket.SHUT_WR)
+
+
+def growth_per_hour(samples: list[Sample], value: Callable[[Sample], float]) -> float:
+    """Least-squares slope of a sampled value, per hour."""
+    if len(samples) < 2:
+        return 0.0
+    mean_time: float = sum(sample.elapsed for sample in samples) / len(samples)
+    mean_value: float = sum(value(sample) for sample in samples) / len(samples)
+    covariance: float = sum(
+        (sample.elapsed - mean_time) * (value(sample) - mean_value) for sample in samples
+    )
+    variance: float = sum((sample.elapsed - mean_time) ** 2 for sample in samples)
+    return covariance / variance * 3600 if variance else 0.0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--duration", type=float, default=3600, help="Seconds of churn")
+    parser.add_argument("--warmup", type=float, default=300, help="Seconds before the baseline")
+    parser.add_argument("--interval", type=float, default=60, help="Seconds between samples")
+    parser.add_argument("--workers", type=int, default=10)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--actions", type=int, default=20, help="Commands per session")
+    parser.add_argument("--think", type=float, default=0.2, help="Seconds between commands")
+    parser.add_argument(
+        "--history-limit", type=int, default=1000, help="Messages kept per conversation"
+    )
+    parser.add_argument("--max-rss-growth", type=float, default=64, help="MiB")
+    parser.add_argument("--max-traced-growth", type=float, default=32, help="MiB")
+    parser.add_argument("--max-thread-growth", type=int, default=10)
+    parser.add_argument("--max-fd-growth", type=int, default=20)
+    parser.add_argument("--top", type=int, default=10, help="Allocation sites to report")
+    parser.add_argument(
+        "--no-tracemalloc", action="store_true", help="Skip allocation tracking"
+    )
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    usernames: list[str] = [f"soak{i}" for i in range(args.users)]
+    env: dict[str, Any] = {
+        "ADMIN_TOKENS": ADMIN_TOKEN,
+        # Exercise the log queue without printing every connection
+        "LOG_LEVEL": "INFO",
+        # Keep history bounded, so that it only grows if something leaks
+        "HISTORY_RETENTION_MESSAGES": args.history_limit,
+        "HISTORY_COMPACT_INTERVAL": max(args.interval, 10),
+    }
+    if not args.no_tracemalloc:
+        env["PYTHONTRACEMALLOC"] = 1
+
+    failures: list[str] = []
+    with run_server(subprocess.DEVNULL, **env) as server:
+        register_accounts(server.port, ADMIN_TOKEN, [(name, PASSWORD) for name in usernames])
+        churn: Churn = Churn(server.port, usernames, args.actions, args.think)
+        start: float = time.monotonic()
+        churn.start(args.workers)
+
+        samples: list[Sample] = []
+        baseline: Sample | None = None
+        baseline_allocations: dict[str, tuple[int, int]] = {}
+        while (elapsed := time.monotonic() - start) < args.duration:
+            time.sleep(min(args.interval, args.duration - elapsed))
+            sample: Sample = Sample(server, time.monotonic() - start)
+            print(sample, flush=True)
+            if sample.elapsed >= args.warmup:
+                samples.append(sample)
+                if baseline is None:
+                    baseline = sample
+                    if not args.no_tracemalloc:
+                        baseline_allocations = server.allocations(1000)
+        final_allocations: dict[str, tuple[int, int]] = (
+            server.allocations(1000) if baseline_allocations else {}
+        )
+
+        churn.stop()
+        while time.perf_counter() - churn.drain.last_frame < 2.0:
+            time.sleep(0.5)
+        # Give the server a moment to clean up the last connections
+        time.sleep(2)
+        idle: Sample = Sample(server, time.monotonic() - start)
+
+    print()
+    print(f"Sessions: {churn.sessions:,} ({churn.errors} failed)")
+    print(f"Idle after churn: {idle}")
+    if idle.clients:
+        failures.append(f"{idle.clients} clients still registered after every client left")
+    if idle.connections:
+        failures.append(f"{idle.connections} connections still open after every client left")
+    if idle.log_queue:
+        failures.append(f"{idle.log_queue} log records still queued")
+
+    if baseline is None or len(samples) < 2:
+        print("Run too short to measure growth; increase --duration or lower --warmup")
+    else:
+        last: Sample = samples[-1]
+        if last.connections > 2 * args.workers:
+            # Sessions are finishing slower than they start, so everything
+            # per connection grows; that's overload rather than a leak
+            print(
+                f"Warning: {last.connections} connections open for {args.workers} "
+                "workers; the server can't keep up, so lower --workers or raise --think"
+            )
+        print(f"Growth over {(last.elapsed - baseline.elapsed) / 3600:.2f}h after warm-up:")
+
+        def check(name: str, value: Callable[[Sample], float], limit: float) -> None:
+            growth: float = value(last) - value(baseline)
+            rate: float = growth_per_hour(samples, value)
+            print(f"  {name + ':':15s}{growth:+9.1f} ({rate:+.1f}/h, limit {limit:g})")
+            if growth > limit:
+                failures.append(f"{name} grew by {growth:.1f}, over the limit of {limit:g}")
+
+        check("RSS MiB", lambda sample: sample.rss / MIB, args.max_rss_growth)
+        check("Threads", lambda sample: sample.threads, args.max_thread_growth)
+        check("Open files", lambda sample: sample.fds, args.max_fd_growth)
+        if not args.no_tracemalloc:
+            check("Traced MiB", lambda sample: sample.traced / MIB, args.max_traced_growth)
+
+        if final_allocations:
+            growth_by_line: list[tuple[int, int, str]] = []
+            for where, (size, count) in final_allocations.items():
+                size_before, count_before = baseline_allocations.get(where, (0, 0))
+                if where != "total":
+                    growth_by_line.append((size - size_before, count - count_before, where))
+            growth_by_line.sort(reverse=True)
+            print(f"Top {args.top} allocation sites by growth:")
+            for size, count, where in growth_by_line[: args.top]:
+                print(f"  {size / 1024:+10.1f} KiB {count:+8d} blocks  {where}")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+    print("PASS")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,14 +3,27 @@
 
 import base64
 import os
+import time
+import select
 import struct
 import json
 import socket
 import logging
 from typing import Tuple, Any
+from utils.logger import frame_dump_enabled
 
 logger = logging.getLogger(__name__)
 
+# Largest frame payload that fits behind the 2-byte length prefix
+MAX_FRAME_SIZE: int = 0xFFFF
+
+# Largest JSON message that still fits in one frame once the key and IV are
+# prepended and the ciphertext is base64-encoded
+MAX_MESSAGE_SIZE: int = (MAX_FRAME_SIZE - 48) // 4 * 3
+
+# Seconds allowed for the rest of a frame to arrive once its length prefix has
+PAYLOAD_TIMEOUT: float = 5.0
+
 
 def generate_key() -> bytes:
     """Generate a random 32-byte key for encryption."""
@@ -70,17 +83,21 @@ def pack(data: bytes) -> bytes:
         Packed data with length prefix.
     """
     packed_data = struct.pack(">H", len(data)) + data
-    logger.debug(f"Packed data: {packed_data!r}")
+    if frame_dump_enabled(logger):
+        logger.debug("Packed data: %r", packed_data)
     return packed_data
 
 
-def send(socket: socket.socket, data_dict: dict[str, Any]) -> None:
+def encode_frame(data_dict: dict[str, Any]) -> bytes:
     """
-    Encrypt and send data to a socket.
+    Serialize, encrypt and length-prefix a dictionary so it is ready to be
+    written to a socket.
 
     Args:
-        socket: The socket to send data through.
         data_dict: The dictionary containing data to be sent.
+
+    Returns:
+        The packed frame.
     """
     # Generate a random 32-byte binary encryption key
     key: bytes = generate_key()
@@ -95,54 +112,169 @@ def send(socket: socket.socket, data_dict: dict[str, Any]) -> None:
     data_to_send = key + encrypt_result[1] + encrypt_result[0]
 
     # Pack the data to send
-    packed_data = pack(data_to_send)
+    return pack(data_to_send)
+
+
+def send(socket: socket.socket, data_dict: dict[str, Any]) -> None:
+    """
+    Encrypt and send data to a socket.
 
-    logger.debug(f"Sending data: {packed_data!r}")
+    Args:
+        socket: The socket to send data through.
+        data_dict: The dictionary containing data to be sent.
+    """
+    packed_data = encode_frame(data_dict)
+
+    if frame_dump_enabled(logger):
+        logger.debug("Sending data: %r", packed_data)
     # Use sendall to ensure all data is sent
     socket.sendall(packed_data)
 
 
-def receive(socket: socket.socket, max_buff_size: int = 1024) -> dict[str, Any]:
+def _wait_readable(sock: socket.socket, deadline: float | None) -> None:
     """
-    Receive and decrypt data from a socket.
+    Wait until a socket has data (or has been closed) without changing its
+    timeout, which a writer thread sharing the socket may rely on.
+
+    Raises:
+        TimeoutError: If the deadline passes first.
+    """
+    timeout: float | None = None if deadline is None else deadline - time.monotonic()
+    if timeout is not None and timeout <= 0:
+        raise TimeoutError("Timed out waiting for the rest of the frame")
+    if hasattr(select, "poll"):
+        # Unlike select, poll works with file descriptors above FD_SETSIZE
+        poller = select.poll()
+        poller.register(sock, select.POLLIN)
+        ready: bool = bool(poller.poll(None if timeout is None else timeout * 1000))
+    else:
+        ready = bool(select.select([sock], [], [], timeout)[0])
+    if not ready:
+        raise TimeoutError("Timed out waiting for the rest of the frame")
+
+
+def _receive_exactly(
+    socket: socket.socket, length: int, max_buff_size: int, deadline: float | None
+) -> bytes:
+    """
+    Receive exactly `length` bytes. Works with blocking sockets, whose own
+    timeout still applies, and with non-blocking ones.
 
     Args:
         socket: The socket to receive data from.
+        length: The number of bytes to receive.
         max_buff_size: Maximum buffer size for receiving data chunks.
-
-    Returns:
-        Decrypted and parsed data as a Python object.
+        deadline: time.monotonic() time by which all the data must have
+            arrived, or None to wait indefinitely.
     """
+    nonblocking: bool = socket.gettimeout() == 0.0
     data: bytes = b""
-
-    # Receive the length of the incoming data (waits indefinitely until data is received)
-    socket.settimeout(None)
-    length_prefix: bytes = socket.recv(2)
-
-    # Raise an error if bytes object is empty, as this means socket disconnected
-    if not length_prefix:
-        raise ConnectionError("Connection closed by remote host")
-
-    # Unpack the length prefix to get the total length of the message
-    surplus: int = struct.unpack(">H", length_prefix)[0]
-
-    # Receive data in chunks until we have the full message
-    socket.settimeout(5)
+    surplus: int = length
     while surplus:
-        receive_data: bytes = socket.recv(
-            max_buff_size if surplus > max_buff_size else surplus
-        )
+        if deadline is not None and not nonblocking:
+            _wait_readable(socket, deadline)
+        try:
+            receive_data: bytes = socket.recv(min(surplus, max_buff_size))
+        except BlockingIOError:
+            _wait_readable(socket, deadline)
+            continue
         if not receive_data:
             raise ConnectionError("Connection closed by remote host")
         data += receive_data
         surplus -= len(receive_data)
+    return data
+
+
+def receive_length_prefix(socket: socket.socket) -> int:
+    """
+    Wait for the next frame and read its length prefix.
+
+    Args:
+        socket: The socket to receive data from.
+
+    Returns:
+        The length of the frame payload that follows.
+    """
+    # Wait indefinitely (or up to the socket's own timeout) for the next frame
+    length_prefix: bytes = _receive_exactly(socket, 2, 2, None)
+
+    # Unpack the length prefix to get the total length of the message
+    return struct.unpack(">H", length_prefix)[0]
+
 
+def receive_payload(
+    socket: socket.socket, length: int, max_buff_size: int = 1024
+) -> bytes:
+    """
+    Receive the payload of a frame whose length prefix has already been read.
+
+    Args:
+        socket: The socket to receive data from.
+        length: The payload length returned by `receive_length_prefix`.
+        max_buff_size: Maximum buffer size for receiving data chunks.
+
+    Returns:
+        The frame payload (key, IV, and encrypted data).
+
+    Raises:
+        TimeoutError: If the payload takes longer than `PAYLOAD_TIMEOUT` to
+            arrive.
+    """
+    data: bytes = _receive_exactly(
+        socket, length, max_buff_size, time.monotonic() + PAYLOAD_TIMEOUT
+    )
+
+    if frame_dump_enabled(logger):
+        logger.debug("Received data: %r", data)
+    return data
+
+
+def receive_frame(socket: socket.socket, max_buff_size: int = 1024) -> bytes:
+    """
+    Receive one length-prefixed frame from a socket without decrypting it.
+
+    Args:
+        socket: The socket to receive data from.
+        max_buff_size: Maximum buffer size for receiving data chunks.
+
+    Returns:
+        The frame payload (key, IV, and encrypted data).
+    """
+    length: int = receive_length_prefix(socket)
+    return receive_payload(socket, length, max_buff_size)
+
+
+def decrypt_frame(data: bytes) -> bytes:
+    """
+    Decrypt the payload of a frame returned by `receive_frame`.
+
+    Args:
+        data: The frame payload (key, IV, and encrypted data).
+
+    Returns:
+        The decrypted JSON data as bytes.
+    """
     # Extract key, IV, and encrypted data
-    logger.debug(f"Received data: {data!r}")
     key: bytes = data[:32]
     iv: bytes = data[32:48]
     encrypted_data: bytes = data[48:]
 
+    return decrypt(encrypted_data, key, iv)
+
+
+def receive(socket: socket.socket, max_buff_size: int = 1024) -> dict[str, Any]:
+    """
+    Receive and decrypt data from a socket.
+
+    Args:
+        socket: The socket to receive data from.
+        max_buff_size: Maximum buffer size for receiving data chunks.
+
+    Returns:
+        Decrypted and parsed data as a Python object.
+    """
+    data: bytes = receive_frame(socket, max_buff_size)
+
     # Decrypt and parse the data
-    decrypted_data: bytes = decrypt(encrypted_data, key, iv)
+    decrypted_data: bytes = decrypt_frame(data)
     return json.loads(decrypted_data)
@@ -1,12 +1,261 @@
+import os
+import json
 import hashlib
+import logging
+import threading
+from pathlib import Path
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+# Bytes hashed per read; large reads let hashlib release the GIL for longer
+HASH_READ_SIZE: int = 1024 * 1024
+
+# Files are split into fixed-size chunks for deduplicated transfers, each
+# identified by the lower-case hex digest of its contents
+CHUNK_SIZE: int = 1024 * 1024
+CHUNK_ALGORITHM: str = "sha256"
+
+# A file is identified by the SHA-256 of its chunks' SHA-256 digests,
+# concatenated. Deriving it from the chunk digests means a file being sent
+# is read and hashed only once, rather than again as a whole.
+CHUNK_LIST_ALGORITHM: str = "sha256-chunks"
+
+# Algorithms accepted for verifying file transfers, most preferred first.
+# OpenSSL's SHA-256 uses the SHA instructions of current x86 and ARM CPUs,
+# hashing about twice as fast as MD5; whole-file SHA-256 and MD5 are still
+# accepted from older senders.
+HASH_ALGORITHMS: tuple[str, ...] = (CHUNK_LIST_ALGORITHM, "sha256", "md5")
+
+
+def hash_file_chunks(filepath: str, chunk_size: int = CHUNK_SIZE) -> list[str]:
+    """
+    Hash each chunk of a file.
+
+    Args:
+        filepath: Path of the file.
+        chunk_size: Size of the chunks.
+
+    Returns:
+        The `CHUNK_ALGORITHM` digest of each chunk, in order.
+    """
+    chunks: list[str] = []
+    view: memoryview = memoryview(bytearray(chunk_size))
+    with open(filepath, "rb", buffering=0) as f:
+        while read := _read_fully(f, view):
+            chunks.append(hashlib.new(CHUNK_ALGORITHM, view[:read]).hexdigest())
+    return chunks
+
+
+def chunk_list_digest(chunks: list[str]) -> str:
+    """
+    Get a file's `CHUNK_LIST_ALGORITHM` digest from its chunk digests.
+
+    Returns:
+        The upper-case hex digest.
+    """
+    return (
+        hashlib.new(CHUNK_ALGORITHM, b"".join(bytes.fromhex(chunk) for chunk in chunks))
+        .hexdigest()
+        .upper()
+    )
+
+
+class ChunkListHasher:
+    """
+    Computes a `CHUNK_LIST_ALGORITHM` digest from a file's contents as they
+    arrive, with the same `update` and `hexdigest` methods as hashlib's
+    hashers.
+    """
+
+    def __init__(self, chunk_size: int) -> None:
+        """
+        Args:
+            chunk_size: Size of the chunks the sender hashed.
+        """
+        self.chunk_size: int = chunk_size
+        self._chunks: Any = hashlib.new(CHUNK_ALGORITHM)
+        self._chunk: Any = hashlib.new(CHUNK_ALGORITHM)
+        self._chunk_bytes: int = 0
+
+    def update(self, data: bytes | memoryview) -> None:
+        view: memoryview = memoryview(data)
+        while view:
+            take: int = min(len(view), self.chunk_size - self._chunk_bytes)
+            self._chunk.update(view[:take])
+            self._chunk_bytes += take
+            view = view[take:]
+            if self._chunk_bytes == self.chunk_size:
+                self._chunks.update(self._chunk.digest())
+                self._chunk = hashlib.new(CHUNK_ALGORITHM)
+                self._chunk_bytes = 0
+
+    def add_chunk(self, digest: str) -> None:
+        """Add a whole chunk that has already been checked against its digest."""
+        if self._chunk_bytes:
+            raise ValueError("Chunk added in the middle of another chunk")
+        self._chunks.update(bytes.fromhex(digest))
+
+    def hexdigest(self) -> str:
+        chunks: Any = self._chunks.copy()
+        if self._chunk_bytes:
+            # The file's last chunk may be short
+            chunks.update(self._chunk.digest())
+        return chunks.hexdigest()
+
+
+def new_hasher(algorithm: str, chunk_size: int = 0) -> Any:
+    """
+    Create a hasher for an algorithm in `HASH_ALGORITHMS`.
+
+    Args:
+        algorithm: The algorithm.
+        chunk_size: The sender's chunk size, for `CHUNK_LIST_ALGORITHM`.
+    """
+    if algorithm == CHUNK_LIST_ALGORITHM:
+        return ChunkListHasher(chunk_size)
+    return hashlib.new(algorithm)
+
+
+def hash_file(filepath: str, algorithms: tuple[str, ...] = ("sha256",)) -> dict[str, str]:
+    """
+    Hash a whole file with several algorithms in one pass.
+
+    Args:
+        filepath: Path of the file.
+        algorithms: Names of hashlib algorithms to use.
+
+    Returns:
+        Upper-case hex digests, by algorithm.
+    """
+    hashers: list[tuple[str, Any]] = [(name, hashlib.new(name)) for name in algorithms]
+    view: memoryview = memoryview(bytearray(HASH_READ_SIZE))
+    with open(filepath, "rb", buffering=0) as f:
+        while read := f.readinto(view):
+            for _, hasher in hashers:
+                hasher.update(view[:read])
+    return {name: hasher.hexdigest().upper() for name, hasher in hashers}
+
+
+def _read_fully(f: Any, view: memoryview) -> int:
+    # Unbuffered reads may return less than asked for before the end of the
+    # file, which would shift every later chunk boundary
+    total: int = 0
+    while total < len(view):
+        read: int = f.readinto(view[total:])
+        if not read:
+            break
+        total += read
+    return total
 
 
 def get_file_md5(filepath: str) -> str:
-    md5_hash = hashlib.md5()
-    with open(filepath, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            md5_hash.update(chunk)
-    return md5_hash.hexdigest().upper()
+    return hash_file(filepath, ("md5",))["md5"]
+
+
+def preferred_hash(hashes: dict[str, str], chunk_size: int = 0) -> tuple[str, str]:
+    """
+    Choose the algorithm to verify a transfer with from those offered.
+
+    Args:
+        hashes: Hex digests by algorithm, as offered by the sender.
+        chunk_size: The sender's chunk size, or 0 if it didn't offer a valid
+            one, in which case `CHUNK_LIST_ALGORITHM` can't be used.
+
+    Returns:
+        The most preferred algorithm this client supports and its digest, or
+        ("", "") if none of them are supported.
+    """
+    for name in HASH_ALGORITHMS:
+        if name == CHUNK_LIST_ALGORITHM and not chunk_size:
+            continue
+        if hashes.get(name):
+            return name, str(hashes[name]).upper()
+    return "", ""
+
+
+class FileHashCache:
+    """
+    Remembers the chunk digests of files that have been sent,
+    keyed by path, size and modification time, so sending an unchanged file
+    again doesn't read it again. The cache is saved to a JSON file after
+    each new entry, and the least recently used entries are dropped beyond
+    `max_entries`.
+    """
+
+    def __init__(self, filepath: Path | None, max_entries: int = 1000) -> None:
+        """
+        Args:
+            filepath: Where the cache is saved, or None to keep it in memory.
+            max_entries: Maximum number of files remembered.
+        """
+        self.filepath: Path | None = filepath
+        self.max_entries: int = max_entries
+        self._lock: threading.Lock = threading.Lock()
+        self._entries: dict[str, dict] = self._load()
+
+    def digests(self, filepath: str) -> list[str]:
+        """
+        Get the digests of a file's `CHUNK_SIZE` chunks, from the cache if
+        the file is unchanged.
+
+        Args:
+            filepath: Path of the file.
+
+        Returns:
+            The chunk digests, in order.
+        """
+        path: str = os.path.realpath(filepath)
+        stat: os.stat_result = os.stat(path)
+        with self._lock:
+            entry: dict | None = self._entries.pop(path, None)
+            if (
+                entry
+                and entry["size"] == stat.st_size
+                and entry["mtime_ns"] == stat.st_mtime_ns
+                and entry.get("chunk_size") == CHUNK_SIZE
+            ):
+                # Re-insert to mark the entry as recently used
+                self._entries[path] = entry
+                return list(entry["chunks"])
+
+        chunks: list[str] = hash_file_chunks(path, CHUNK_SIZE)
+        with self._lock:
+            self._entries[path] = {
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "chunk_size": CHUNK_SIZE,
+                "chunks": chunks,
+            }
+            while len(self._entries) > self.max_entries:
+                del self._entries[next(iter(self._entries))]
+            self._save()
+        return list(chunks)
+
+    def _load(self) -> dict[str, dict]:
+        if not self.filepath:
+            return {}
+        try:
+            with open(self.filepath, "r", encoding="utf-8") as f:
+                entries: dict[str, dict] = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to load file hash cache {self.filepath}: {e}")
+            return {}
+        return entries if isinstance(entries, dict) else {}
+
+    def _save(self) -> None:
+        if not self.filepath:
+            return
+        temp_filepath: Path = self.filepath.with_suffix(".tmp")
+        try:
+            self.filepath.parent.mkdir(parents=True, exist_ok=True)
+            with open(temp_filepath, "w", encoding="utf-8") as f:
+                json.dump(self._entries, f)
+            os.replace(temp_filepath, self.filepath)
+        except OSError as e:
+            logger.warning(f"Failed to save file hash cache {self.filepath}: {e}")
 
 
 def format_file_size(size: int | float, suffix: str = "B") -> str:
@@ -1,25 +1,125 @@
+import json
 import logging
 import queue
+import itertools
+from typing import Callable
 from logging.handlers import QueueHandler, QueueListener
 
+# Only one in every `_frame_sample_rate` frame dumps is logged at DEBUG level
+_frame_sample_rate: int = 1
+_frame_counter: itertools.count = itertools.count()
+
+# Queue between logging threads and the listener that writes the records
+_log_queue: queue.Queue | None = None
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Queue handler for a bounded queue that drops records when the queue is
+    full, instead of blocking the logging thread or growing without limit
+    when the console can't keep up.
+    """
+
+    def __init__(
+        self, log_queue: queue.Queue, on_drop: Callable[[], None] | None = None
+    ) -> None:
+        """
+        Args:
+            log_queue: The bounded queue read by the listener.
+            on_drop: Called for each dropped record, such as to count drops.
+        """
+        super().__init__(log_queue)
+        self.on_drop: Callable[[], None] | None = on_drop
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if self.on_drop:
+                self.on_drop()
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Format each log record as a single-line JSON object."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: dict[str, object] = {
+            "time": self.formatTime(record),
+            "logger": record.name,
+            "level": record.levelname,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+def frame_dump_enabled(logger: logging.Logger) -> bool:
+    """
+    Check whether a debug dump of a network frame should be logged.
+
+    Call this before building any expensive log arguments, so that hot paths
+    cost nothing when DEBUG is off and only a sample of frames is dumped when
+    it is on.
+
+    Args:
+        logger: The logger the dump would be written to.
+
+    Returns:
+        True if DEBUG is enabled for the logger and this frame is sampled.
+    """
+    return (
+        logger.isEnabledFor(logging.DEBUG)
+        and next(_frame_counter) % _frame_sample_rate == 0
+    )
+
+
+def queued_log_records() -> int:
+    """Get the number of log records waiting to be written."""
+    return _log_queue.qsize() if _log_queue else 0
+
+
+def configure_logger(
+    level: str | int = logging.INFO,
+    json_lines: bool = False,
+    frame_sample_rate: int = 1,
+    max_queued: int = 10_000,
+    on_drop: Callable[[], None] | None = None,
+) -> None:
+    """
+    Configure the root logger to write to the console from a background thread.
+
+    Args:
+        level: The minimum level to log.
+        json_lines: Whether to write each record as a JSON object instead of text.
+        frame_sample_rate: Log only one in this many network frame dumps at DEBUG level.
+        max_queued: Maximum records waiting to be written; further records are
+            dropped until the console catches up. 0 leaves the queue unbounded.
+        on_drop: Called for each record dropped because the queue was full.
+    """
+    global _frame_sample_rate, _log_queue
+    _frame_sample_rate = max(1, frame_sample_rate)
 
-def configure_logger(level: str | int = logging.INFO) -> None:
     # Configure the root logger
     root: logging.Logger = logging.getLogger()
     root.setLevel(level)
 
     # Create handlers
     console_handler: logging.StreamHandler = logging.StreamHandler()
-    formatter: logging.Formatter = logging.Formatter(
-        "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    formatter: logging.Formatter = (
+        JsonLinesFormatter()
+        if json_lines
+        else logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
     )
     console_handler.setFormatter(formatter)
 
-    # Create a queue for sharing log messages across threads
-    log_queue: queue.Queue = queue.Queue(-1)
+    # Create a bounded queue for sharing log messages across threads
+    log_queue: queue.Queue = queue.Queue(max(0, max_queued))
+    _log_queue = log_queue
 
     # Set up the queue handler
-    queue_handler: QueueHandler = QueueHandler(log_queue)
+    queue_handler: QueueHandler = DroppingQueueHandler(log_queue, on_drop)
     root.addHandler(queue_handler)
 
     # Set up the listener